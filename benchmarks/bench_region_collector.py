@@ -0,0 +1,177 @@
+"""Benchmarks for the region collector.
+
+Run with::
+
+    python benchmarks/bench_region_collector.py
+
+"""
+
+import argparse
+import datetime as dt
+import os
+import random
+import tempfile
+import time
+
+from pyresample import create_area_def
+from trollsched.satpass import Pass
+
+from pytroll_collectors.region_collector import FootprintCache, OrbitCache, RegionCollector
+
+TLE = """METOP-C
+1 43689U 18087A   21101.60865186  .00000002  00000-0  20894-4 0  9998
+2 43689  98.6928 163.0161 0002296 181.8672 178.2497 14.21491657125954
+"""
+
+START_TIME = dt.datetime(2021, 4, 11, tzinfo=dt.timezone.utc)
+GRANULE_DURATION = dt.timedelta(minutes=3)
+
+
+def create_regions(num_regions=50, size=2000000):
+    """Create square stereographic regions spread over the globe."""
+    rows = 5
+    columns = num_regions // rows
+    regions = []
+    for row in range(rows):
+        lat = -72 + 144 * row / (rows - 1)
+        for column in range(columns):
+            lon = -180 + 360 * (column + 0.5 * (row % 2)) / columns
+            regions.append(create_area_def(f"region_{row}_{column}",
+                                           {"proj": "stere", "lat_0": lat, "lon_0": lon, "ellps": "WGS84"},
+                                           width=500, height=500, units="m",
+                                           area_extent=(-size / 2, -size / 2, size / 2, size / 2)))
+    return regions
+
+
+def _coverages(footprint_cache, regions, start_time):
+    """Get the coverage of the regions by a granule."""
+    return [footprint_cache.get_coverage("Metop-C", start_time, start_time + GRANULE_DURATION, "avhrr", region)
+            for region in regions]
+
+
+def bench_prefilter(num_regions=50, hours=24, sample=5, seed=0):
+    """Time the region prefilter on a day of global granules.
+
+    The exact coverage of all the regions is computed for a sample of the
+    granules, to estimate the time without the prefilter and to check that no
+    covered region is rejected.
+    """
+    regions = create_regions(num_regions)
+    granule_times = [START_TIME + i * GRANULE_DURATION for i in range(int(hours * 60 / 3))]
+    print(f"{len(granule_times)} granules of Metop-C over {len(regions)} regions")
+
+    footprint_cache = FootprintCache(maxsize=len(granule_times))
+    for region in regions:
+        footprint_cache.add_region(region)
+    start = time.perf_counter()
+    covered = sum(coverage > 0 for start_time in granule_times
+                  for coverage in _coverages(footprint_cache, regions, start_time))
+    prefiltered = time.perf_counter() - start
+    pairs = len(granule_times) * len(regions)
+    exact = pairs - footprint_cache.rejected
+    print(f"Rejected by the prefilter: {footprint_cache.rejected / pairs:.1%} of the granule/region pairs")
+    print(f"Covered regions: {covered} of the {exact} exact coverages computed")
+    print(f"With the prefilter: {prefiltered:.1f} s")
+
+    unfiltered_cache = FootprintCache()
+    sample_times = random.Random(seed).sample(granule_times, sample)
+    start = time.perf_counter()
+    for start_time in sample_times:
+        unfiltered = _coverages(unfiltered_cache, regions, start_time)
+        filtered = _coverages(footprint_cache, regions, start_time)
+        missed = [region.area_id for region, coverage, filtered_coverage in zip(regions, unfiltered, filtered)
+                  if coverage > 0 and not filtered_coverage > 0]
+        if missed:
+            print(f"Covered regions rejected for the granule at {start_time}: {', '.join(missed)}")
+    per_granule = (time.perf_counter() - start) / sample
+    print(f"Without the prefilter: {per_granule * len(granule_times):.1f} s (estimated from {sample} granules)")
+
+
+def bench_prediction(durations=(60, 180), repeat=3):
+    """Time the planning of a collection with and without the batch prediction."""
+    region = create_area_def("europe", {"proj": "stere", "lat_0": 60, "lon_0": 20, "ellps": "WGS84"},
+                             width=500, height=500, units="m", area_extent=(-4e6, -4e6, 4e6, 4e6))
+    print("Planning of a Metop-C pass over Europe, seconds per collection")
+    print(f"{'duration s':>10} {'granules':>10} {'stepwise':>10} {'batch':>10}")
+    for duration in durations:
+        granule_duration = dt.timedelta(seconds=duration)
+        start_time = START_TIME + dt.timedelta(hours=10, minutes=6)
+        granule = {"platform_name": "Metop-C", "sensor": "avhrr", "uri": "granule",
+                   "start_time": start_time, "end_time": start_time + granule_duration}
+        timings = {}
+        for batch_prediction in (False, True):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                collector = RegionCollector(region, granule_duration=granule_duration,
+                                            batch_prediction=batch_prediction)
+                collector({**granule})
+            timings[batch_prediction] = (time.perf_counter() - start) / repeat
+        print(f"{duration:>10} {len(collector.planned_granule_times):>10} "
+              f"{timings[False]:>10.2f} {timings[True]:>10.2f}")
+
+
+def bench_orbits(num_granules=200):
+    """Time the creation of the granule passes with and without the orbit cache."""
+    granule_times = [START_TIME + i * GRANULE_DURATION for i in range(num_granules)]
+    start = time.perf_counter()
+    for start_time in granule_times:
+        Pass("Metop-C", start_time, start_time + GRANULE_DURATION, instrument="avhrr")
+    uncached = time.perf_counter() - start
+    orbit_cache = OrbitCache()
+    footprint_cache = FootprintCache(orbit_cache=orbit_cache)
+    start = time.perf_counter()
+    for start_time in granule_times:
+        footprint_cache.get_pass("Metop-C", start_time, start_time + GRANULE_DURATION, "avhrr")
+    cached = time.perf_counter() - start
+    print(f"Creation of {num_granules} passes, milliseconds per pass")
+    print(f"{'uncached':>10} {'cached':>10} {'hits':>6} {'misses':>6}")
+    print(f"{uncached / num_granules * 1000:>10.2f} {cached / num_granules * 1000:>10.2f} "
+          f"{orbit_cache.hits:>6} {orbit_cache.misses:>6}")
+
+
+def bench_coverage_cache(num_granules=10, repeat=3):
+    """Time the coverage of granules sent several times, with and without the coverage cache."""
+    region = create_regions(10)[7]
+    granule_times = [START_TIME + dt.timedelta(hours=10) + i * GRANULE_DURATION for i in range(num_granules)]
+    print(f"Coverage of {num_granules} granules sent {repeat} times, seconds")
+    print(f"{'cache size':>10} {'time':>10} {'hits':>6} {'misses':>6}")
+    for coverage_cache_size in (0, 4096):
+        footprint_cache = FootprintCache(coverage_cache_size=coverage_cache_size)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for start_time in granule_times:
+                _coverages(footprint_cache, [region], start_time)
+        elapsed = time.perf_counter() - start
+        print(f"{coverage_cache_size:>10} {elapsed:>10.2f} "
+              f"{footprint_cache.coverage_hits:>6} {footprint_cache.coverage_misses:>6}")
+
+
+BENCHMARKS = {
+    "prefilter": bench_prefilter,
+    "prediction": bench_prediction,
+    "orbits": bench_orbits,
+    "coverage_cache": bench_coverage_cache,
+}
+
+
+def main(args=None):
+    """Run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="Benchmarks to run, all by default. Choose from: " + ", ".join(BENCHMARKS))
+    opts = parser.parse_args(args)
+    unknown = set(opts.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: " + ", ".join(sorted(unknown)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tle_file = os.path.join(tmp_dir, "tle.txt")
+        with open(tle_file, "w") as fd:
+            fd.write(TLE)
+        os.environ["TLES"] = tle_file
+        for name in opts.benchmarks or BENCHMARKS:
+            BENCHMARKS[name]()
+            print()
+
+
+if __name__ == "__main__":
+    main()
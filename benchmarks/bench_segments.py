@@ -0,0 +1,393 @@
+"""Benchmarks for the segment gatherer.
+
+Run with::
+
+    python benchmarks/bench_segments.py
+
+"""
+
+import argparse
+import datetime as dt
+import os
+import random
+import time
+import timeit
+import tracemalloc
+from queue import Queue
+from types import SimpleNamespace
+
+import trollsift
+from posttroll.message import Message
+
+from pytroll_collectors.segments import Message as SegmentMessage
+from pytroll_collectors.segments import SegmentGatherer, ShardedSegmentGatherer
+from pytroll_collectors.segments import _copy_without_ignore_items, _create_segment_list
+from pytroll_collectors.scripts.segment_gatherer_replay import SYNTHETIC_STREAMS, replay
+
+BASE_TIME = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+
+MSG_CONFIG = {
+    "patterns": {
+        "msg": {
+            "pattern": ("H-000-{hrit_format:4s}__-{platform_shortname:4s}________-"
+                        "{channel_name:_<9s}-{segment:_<9s}-{start_time:%Y%m%d%H%M}-__"),
+            "critical_files": ":EPI,:PRO",
+            "wanted_files": "VIS006:000001-000008,:PRO,:EPI",
+            "all_files": "VIS006:000001-000008,:PRO,:EPI",
+            "is_critical_set": True,
+            "variable_tags": [],
+        },
+    },
+    "timeliness": 900,
+    "time_name": "start_time",
+    "time_tolerance": 30,
+    "posttroll": {"topics": ["/foo/bar"], "publish_topic": "/bar", "nameservers": False},
+}
+
+HIMAWARI_CHANNELS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08",
+                     "B09", "B10", "B11", "B12", "B13", "B14", "B15", "B16"]
+HIMAWARI_FILES = ",".join(f"{channel}:001-010" for channel in HIMAWARI_CHANNELS)
+HIMAWARI_CONFIG = {
+    "patterns": {
+        "himawari": {
+            "pattern": "IMG_DK01{channel_name:3s}_{start_time:%Y%m%d%H%M}_{segment:0>3s}",
+            "critical_files": HIMAWARI_FILES,
+            "wanted_files": HIMAWARI_FILES,
+            "all_files": HIMAWARI_FILES,
+            "is_critical_set": True,
+            "variable_tags": [],
+        },
+    },
+    "timeliness": 1200,
+    "time_name": "start_time",
+    "group_by_minutes": 10,
+    "posttroll": {"topics": ["/foo/bar"], "publish_topic": "/bar", "nameservers": False},
+}
+
+
+def msg_message(start_time, channel_name="VIS006", segment="000001"):
+    """Create a posttroll message for an MSG HRIT segment."""
+    uid = (f"H-000-MSG4__-MSG4________-{channel_name:_<9s}-{segment:_<9s}-"
+           f"{start_time:%Y%m%d%H%M}-__")
+    return Message("/foo/bar", "file", {"uid": uid, "uri": "/data/" + uid, "sensor": ["seviri"],
+                                        "platform_name": "Meteosat-11"})
+
+
+def create_gatherer_with_slots(num_slots, config=MSG_CONFIG):
+    """Create a gatherer with *num_slots* open slots."""
+    gatherer = SegmentGatherer(config)
+    for i in range(num_slots):
+        gatherer.process(msg_message(BASE_TIME + dt.timedelta(minutes=15 * i)))
+    return gatherer
+
+
+def _linear_find_time_slot(gatherer, time_obj):
+    """Find the time slot the way it was done before the time index."""
+    for slot in gatherer.slots:
+        time_slot = gatherer.slots[slot].output_metadata[gatherer.time_name]
+        if abs((time_obj - time_slot).total_seconds()) < gatherer._time_tolerance:
+            return slot
+    return str(time_obj)
+
+
+def bench_find_time_slot(slot_counts=(10, 100, 1000, 10000), lookups=2000):
+    """Time the slot lookup for a growing number of open slots."""
+    print("Slot lookup, microseconds per message")
+    print(f"{'slots':>8} {'indexed':>10} {'linear':>10}")
+    rng = random.Random(0)
+    for num_slots in slot_counts:
+        gatherer = SegmentGatherer(MSG_CONFIG)
+        for i in range(num_slots):
+            slot_time = BASE_TIME + dt.timedelta(minutes=15 * i)
+            gatherer.slots[str(slot_time)] = SimpleNamespace(output_metadata={"start_time": slot_time})
+        times = [BASE_TIME + dt.timedelta(seconds=rng.uniform(0, 900 * num_slots)) for _ in range(lookups)]
+
+        indexed = timeit.timeit(lambda: [gatherer._find_time_slot(t) for t in times], number=1)
+        linear = timeit.timeit(lambda: [_linear_find_time_slot(gatherer, t) for t in times], number=1)
+        print(f"{num_slots:>8} {1e6 * indexed / lookups:>10.2f} {1e6 * linear / lookups:>10.2f}")
+
+
+def _full_triage(gatherer):
+    """Check the status of all the slots, as done before the event-driven triage."""
+    for slot in gatherer.slots.copy().values():
+        slot.get_status()
+
+
+def bench_triage(slot_counts=(10, 100, 1000), messages=200):
+    """Time the slot triage done after each message for a growing number of open slots."""
+    print("Triage after a message, microseconds per message")
+    print(f"{'slots':>8} {'event':>10} {'all slots':>10}")
+    for num_slots in slot_counts:
+        gatherer = create_gatherer_with_slots(num_slots)
+        gatherer.triage_slots()
+        keys = list(gatherer.slots)
+
+        def _event_triage():
+            for i in range(messages):
+                gatherer._mark_dirty(keys[i % num_slots])
+                gatherer.triage_slots()
+
+        event = timeit.timeit(_event_triage, number=1)
+        full = timeit.timeit(lambda: [_full_triage(gatherer) for _ in range(messages)], number=1)
+        print(f"{num_slots:>8} {1e6 * event / messages:>10.2f} {1e6 * full / messages:>10.2f}")
+
+
+def himawari_message(start_time, channel_name="B01", segment="001"):
+    """Create a posttroll message for a Himawari HSD segment."""
+    uid = f"IMG_DK01{channel_name}_{start_time:%Y%m%d%H%M}_{segment}"
+    return Message("/foo/bar", "file", {"uid": uid, "uri": "/data/" + uid, "sensor": ["ahi"],
+                                        "platform_name": "Himawari-9"})
+
+
+def _trollsift_compose_filenames(slot, parser, itm_str):
+    """Compose the file masks with one trollsift globify call per item, as done before the templates."""
+    meta = _copy_without_ignore_items(slot.output_metadata, ignored_keys=parser.variable_tags)
+    result = set()
+    for itm in itm_str.split(','):
+        channel_name, segments = itm.split(':')
+        meta['channel_name'] = channel_name
+        for seg in _create_segment_list(segments):
+            meta['segment'] = seg
+            result.add(trollsift.globify(parser.fmt, meta))
+    return result
+
+
+def bench_slot_creation(slots=50):
+    """Time the composition of the file masks at slot creation."""
+    gatherer = SegmentGatherer(HIMAWARI_CONFIG)
+    pattern = gatherer._patterns["himawari"]
+    gatherer.process(himawari_message(BASE_TIME))
+    slot = next(iter(gatherer.slots.values()))
+    itm_strs = [pattern[key] for key in ("critical_files", "wanted_files", "all_files")]
+    num_masks = sum(len(slot.compose_filenames(pattern.parser, itm_str)) for itm_str in itm_strs)
+    assert all(slot.compose_filenames(pattern.parser, itm_str) ==
+               _trollsift_compose_filenames(slot, pattern.parser, itm_str) for itm_str in itm_strs)
+
+    template = timeit.timeit(
+        lambda: [slot.compose_filenames(pattern.parser, itm_str) for itm_str in itm_strs], number=slots)
+    globify = timeit.timeit(
+        lambda: [_trollsift_compose_filenames(slot, pattern.parser, itm_str) for itm_str in itm_strs], number=slots)
+    print(f"Slot creation file masks ({num_masks} masks per slot), milliseconds per slot")
+    print(f"{'template':>10} {'globify':>10}")
+    print(f"{1e3 * template / slots:>10.2f} {1e3 * globify / slots:>10.2f}")
+
+
+def bench_segment_keys(num_slots=100):
+    """Compare file masks and structured segment keys for full Himawari slots."""
+    print(f"Himawari slots with all segments ({num_slots} slots)")
+    print(f"{'mode':>8} {'us/file':>10} {'kB/slot':>10}")
+    messages = [himawari_message(BASE_TIME + dt.timedelta(minutes=10 * i), channel, f"{segment:03d}")
+                for i in range(num_slots) for channel in HIMAWARI_CHANNELS for segment in range(1, 11)]
+    for mode, segment_keys in (("masks", False), ("keys", True)):
+        gatherer = SegmentGatherer(dict(HIMAWARI_CONFIG, segment_keys=segment_keys))
+        tracemalloc.start()
+        elapsed = timeit.timeit(lambda: [gatherer.process(msg) for msg in messages], number=1)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{mode:>8} {1e6 * elapsed / len(messages):>10.1f} {size / 1024 / num_slots:>10.1f}")
+
+
+def _multi_pattern_config():
+    """Create a config with several HRIT and polar patterns."""
+    patterns = {}
+    for name, shortname in (("msg", "MSG4________"), ("iodc", "MSG2_IODC___"), ("rss", "MSG3_RSS____")):
+        pattern = dict(MSG_CONFIG["patterns"]["msg"])
+        pattern["pattern"] = ("H-000-{hrit_format:4s}__-" + shortname +
+                              "-{channel_name:_<9s}-{segment:_<9s}-{start_time:%Y%m%d%H%M}-__")
+        patterns[name] = pattern
+    for name, fmt in (("hrpt", "hrpt_{platform_name}_{start_time:%Y%m%d_%H%M}_{orbit_number:05d}.l1b"),
+                      ("pps", "S_NWC_CMA_{platform_name}_{orbit_number:05d}_{start_time:%Y%m%dT%H%M%S}Z.nc")):
+        patterns[name] = {"pattern": fmt, "critical_files": None, "wanted_files": ":", "all_files": ":"}
+    return dict(MSG_CONFIG, patterns=patterns)
+
+
+def _try_all_patterns(gatherer, msg):
+    """Validate the message against every pattern, as done before the dispatch index."""
+    for pattern in gatherer._patterns.values():
+        if pattern.parser._ts_parser.validate(msg.data["uid"]):
+            return SegmentMessage(msg, pattern)
+
+
+def bench_dispatch(messages=2000):
+    """Time matching the messages to the patterns of a multi-pattern config."""
+    gatherer = SegmentGatherer(_multi_pattern_config())
+    msgs = []
+    for i in range(messages):
+        start_time = BASE_TIME + dt.timedelta(minutes=15 * i)
+        if i % 2:
+            uid = f"S_NWC_CMA_metopb_{i:05d}_{start_time:%Y%m%dT%H%M%S}Z.nc"
+        else:
+            uid = (f"H-000-MSG3__-MSG3_RSS____-VIS006___-000001___-{start_time:%Y%m%d%H%M}-__")
+        msgs.append(Message("/foo/bar", "file", {"uid": uid, "uri": "/data/" + uid, "sensor": ["seviri"]}))
+    indexed = timeit.timeit(lambda: [gatherer.message_from_posttroll(msg) for msg in msgs], number=1)
+    all_patterns = timeit.timeit(lambda: [_try_all_patterns(gatherer, msg) for msg in msgs], number=1)
+    print(f"Pattern dispatch ({len(gatherer._patterns)} patterns), microseconds per message")
+    print(f"{'indexed':>10} {'all':>10}")
+    print(f"{1e6 * indexed / messages:>10.1f} {1e6 * all_patterns / messages:>10.1f}")
+
+
+def bench_duplicates(num_slots=20, copies=3):
+    """Time processing a stream where every file arrives several times."""
+    print(f"Himawari stream with {copies} copies of each file, microseconds per message")
+    print(f"{'copies':>8} {'us/msg':>10}")
+    for num_copies in (1, copies):
+        gatherer = SegmentGatherer(HIMAWARI_CONFIG)
+        messages = [himawari_message(BASE_TIME + dt.timedelta(minutes=10 * i), channel, f"{segment:03d}")
+                    for i in range(num_slots) for channel in HIMAWARI_CHANNELS for segment in range(1, 11)
+                    for _ in range(num_copies)]
+        elapsed = timeit.timeit(lambda: [gatherer.process(msg) for msg in messages], number=1)
+        print(f"{num_copies:>8} {1e6 * elapsed / len(messages):>10.1f}")
+    print("Statistics:", gatherer.statistics())
+
+
+def _process_burst(gatherer, messages):
+    """Process a burst of queued messages like the main loop of the gatherer does.
+
+    Return the number of triage passes.
+    """
+    queue = Queue()
+    for msg in messages:
+        queue.put(msg)
+    gatherer._listener = SimpleNamespace(output_queue=queue)
+    gatherer._publisher = SimpleNamespace(send=lambda msg: None)
+    gatherer._subject = "/bar"
+    triages = 0
+    while not queue.empty():
+        gatherer.triage_slots()
+        triages += 1
+        for msg in gatherer._get_messages(0):
+            gatherer.process(msg)
+    gatherer.triage_slots()
+    return triages + 1
+
+
+def bench_burst(messages=1000, batch_sizes=(1, 10, 100, 1000), repeat=7):
+    """Time processing a burst of messages queued at once, like a full disk scan."""
+    burst = [himawari_message(BASE_TIME + dt.timedelta(minutes=10 * i), channel, f"{segment:03d}")
+             for i in range(messages // 160 + 1) for channel in HIMAWARI_CHANNELS
+             for segment in range(1, 11)][:messages]
+    timings = {batch_size: [] for batch_size in batch_sizes}
+    triages = {}
+    _process_burst(SegmentGatherer(HIMAWARI_CONFIG), burst)
+    for _ in range(repeat):
+        for batch_size in batch_sizes:
+            gatherer = SegmentGatherer(dict(HIMAWARI_CONFIG, batch_size=batch_size))
+            start = time.perf_counter()
+            triages[batch_size] = _process_burst(gatherer, burst)
+            timings[batch_size].append(time.perf_counter() - start)
+    print(f"Burst of {messages} queued messages, best of {repeat}")
+    print(f"{'batch':>8} {'triages':>8} {'msg/s':>10} {'us/msg':>10}")
+    for batch_size in batch_sizes:
+        elapsed = min(timings[batch_size])
+        print(f"{batch_size:>8} {triages[batch_size]:>8} {messages / elapsed:>10.0f} {1e6 * elapsed / messages:>10.1f}")
+
+
+def _bench_routing(messages, repeat=5):
+    """Time the choice of the worker in the front-end, compared to the processing in a worker."""
+    timings = {}
+    for shard_key in ("platform_name", "start_time"):
+        gatherer = ShardedSegmentGatherer(dict(HIMAWARI_CONFIG, workers=4, shard_key=shard_key))
+        timings[f"route {shard_key}"] = min(timeit.repeat(lambda: [gatherer.get_shard(msg) for msg in messages],
+                                                          number=1, repeat=repeat))
+
+    # The platforms share the file names, so a single worker gets only one platform's files
+    worker_messages = [msg for msg in messages if msg.data["platform_name"] == messages[0].data["platform_name"]]
+
+    def _process():
+        gatherer = SegmentGatherer(HIMAWARI_CONFIG)
+        for msg in worker_messages:
+            gatherer.process(msg)
+    timings["worker process"] = min(timeit.repeat(_process, number=1, repeat=repeat)) * len(messages) / len(
+        worker_messages)
+    print(f"{'step':>20} {'us/msg':>10}")
+    for name, elapsed in timings.items():
+        print(f"{name:>20} {1e6 * elapsed / len(messages):>10.1f}")
+
+
+def bench_sharding(worker_counts=(1, 2, 4), platforms=8, slots_per_platform=4):
+    """Time a stream of several platforms gathered by a growing number of worker processes."""
+    messages = []
+    for i in range(slots_per_platform):
+        for platform in range(platforms):
+            for channel in HIMAWARI_CHANNELS:
+                for segment in range(1, 11):
+                    msg = himawari_message(BASE_TIME + dt.timedelta(minutes=10 * i), channel, f"{segment:03d}")
+                    msg.data["platform_name"] = f"Himawari-{platform}"
+                    messages.append(msg)
+    num_collections = platforms * slots_per_platform
+    print(f"{len(messages)} messages of {platforms} platforms, {os.cpu_count()} CPUs")
+    _bench_routing(messages)
+    print(f"{'workers':>8} {'msg/s':>10}")
+    for num_workers in worker_counts:
+        gatherer = ShardedSegmentGatherer(dict(HIMAWARI_CONFIG, workers=num_workers))
+        published = []
+        gatherer._frontend._publisher = SimpleNamespace(send=published.append)
+        gatherer._start_workers()
+        start = time.perf_counter()
+        gatherer.distribute(messages)
+        while len(published) < num_collections:
+            gatherer._publish_results(timeout=0.01)
+        elapsed = time.perf_counter() - start
+        gatherer._stop_workers()
+        print(f"{num_workers:>8} {len(messages) / elapsed:>10.0f}")
+
+
+def bench_process(num_slots=10, repeat=5):
+    """Time the messages going through SegmentGatherer.process."""
+    configs = {"mask": HIMAWARI_CONFIG, "segment keys": dict(HIMAWARI_CONFIG, segment_keys=True)}
+    messages = [himawari_message(BASE_TIME + dt.timedelta(minutes=10 * i), channel, f"{segment:03d}")
+                for i in range(num_slots) for channel in HIMAWARI_CHANNELS for segment in range(1, 11)]
+    print(f"{len(messages)} messages through SegmentGatherer.process, best of {repeat}")
+    print(f"{'config':>14} {'msg/s':>10} {'us/msg':>10}")
+    for name, config in configs.items():
+        timings = []
+        for _ in range(repeat):
+            gatherer = SegmentGatherer(config)
+            start = time.perf_counter()
+            for msg in messages:
+                gatherer.process(msg)
+            timings.append(time.perf_counter() - start)
+        elapsed = min(timings)
+        print(f"{name:>14} {len(messages) / elapsed:>10.0f} {1e6 * elapsed / len(messages):>10.1f}")
+
+
+def bench_replay(slots=12, missing=0.01):
+    """Replay the synthetic streams in simulated time."""
+    print(f"Replay of the synthetic streams, {slots} slots, {missing:.0%} of the files missing")
+    print(f"{'stream':>10} {'msg/s':>10} {'published':>10} {'max delay s':>12}")
+    for name, (config, create_stream) in SYNTHETIC_STREAMS.items():
+        result = replay(config, create_stream(slots=slots, missing=missing))
+        latency = max(result["latencies"], default=0)
+        print(f"{name:>10} {result['messages'] / result['elapsed']:>10.0f} {result['published']:>10} {latency:>12.1f}")
+
+
+BENCHMARKS = {
+    "find_time_slot": bench_find_time_slot,
+    "triage": bench_triage,
+    "slot_creation": bench_slot_creation,
+    "segment_keys": bench_segment_keys,
+    "dispatch": bench_dispatch,
+    "duplicates": bench_duplicates,
+    "burst": bench_burst,
+    "sharding": bench_sharding,
+    "process": bench_process,
+    "replay": bench_replay,
+}
+
+
+def main(args=None):
+    """Run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="Benchmarks to run, all by default. Choose from: " + ", ".join(BENCHMARKS))
+    opts = parser.parse_args(args)
+    unknown = set(opts.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: " + ", ".join(sorted(unknown)))
+    for name in opts.benchmarks or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
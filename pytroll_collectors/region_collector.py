@@ -2,9 +2,16 @@
 
 import os
 import datetime as dt
+import glob
+import threading
+from collections import OrderedDict
 from datetime import timedelta, datetime
+
+import numpy as np
+from pyorbital.orbital import Orbital
+from pyproj import Transformer
 from pyresample import parse_area_file
-from trollsched.satpass import Pass
+from trollsched.satpass import JPSS_TLE_NAMES, Pass
 
 import logging
 
@@ -12,6 +19,320 @@ from pytroll_collectors.utils import ensure_utc_aware
 
 logger = logging.getLogger(__name__)
 
+# Angular margin in radians for the rounding errors of the cap overlap test
+CAP_MARGIN = 1e-6
+WHOLE_SPHERE = (np.array([0., 0., 1.]), np.pi)
+# Number of nadir points sampled along each granule in the batch prediction
+PREDICTION_SAMPLES = 10
+# Angular margin in radians for the swath width changes along the orbit
+PREDICTION_MARGIN = np.deg2rad(0.1)
+# Fraction of the region extent a nadir point must be inside to cover the region for sure
+PREDICTION_INSET = 0.01
+
+
+def _to_unit_vectors(lons, lats):
+    """Convert longitudes and latitudes in degrees to unit vectors."""
+    lons = np.deg2rad(lons)
+    lats = np.deg2rad(lats)
+    return np.stack((np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)), axis=-1)
+
+
+def _angular_distances(vectors, others):
+    """Get the angular distances in radians between unit vectors."""
+    return np.arccos(np.clip(vectors @ np.transpose(others), -1, 1))
+
+
+def _get_bounding_cap(lons, lats):
+    """Get the center unit vector and the angular radius of a spherical cap containing the points.
+
+    Caps smaller than a hemisphere are convex, so the cap also contains the
+    polygon with the points as vertices.  The whole sphere is returned when
+    the points are unknown or do not fit in a hemisphere.
+    """
+    lons = np.asarray(lons, dtype=np.float64).ravel()
+    lats = np.asarray(lats, dtype=np.float64).ravel()
+    if lons.size == 0 or not (np.isfinite(lons).all() and np.isfinite(lats).all()):
+        return WHOLE_SPHERE
+    points = _to_unit_vectors(lons, lats)
+    center = points.sum(axis=0)
+    norm = np.linalg.norm(center)
+    if norm == 0:
+        return WHOLE_SPHERE
+    center /= norm
+    radius = _angular_distances(points, center).max()
+    if radius >= np.pi / 2:
+        return WHOLE_SPHERE
+    return center, radius
+
+
+class RegionIndex:
+    """Index of the bounding spherical caps of the regions.
+
+    A granule can cover only the regions whose caps intersect the cap of its
+    footprint, so the exact coverage is needed for those regions only.
+    """
+
+    def __init__(self):
+        """Set up an empty index."""
+        self._area_ids = []
+        self._centers = np.empty((0, 3))
+        self._radii = np.empty(0)
+
+    def add(self, region):
+        """Add the region to the index."""
+        if region.area_id in self:
+            return
+        lons, lats = region.get_bbox_lonlats()
+        center, radius = _get_bounding_cap(np.concatenate(lons), np.concatenate(lats))
+        self._area_ids.append(region.area_id)
+        self._centers = np.vstack((self._centers, center))
+        self._radii = np.append(self._radii, radius)
+
+    def get_cap(self, area_id):
+        """Get the center unit vector and the angular radius of the bounding cap of a region."""
+        index = self._area_ids.index(area_id)
+        return self._centers[index], self._radii[index]
+
+    def __contains__(self, area_id):
+        """Check if the region is in the index."""
+        return area_id in self._area_ids
+
+    def __len__(self):
+        """Get the number of regions in the index."""
+        return len(self._area_ids)
+
+    def find_candidates(self, lons, lats):
+        """Find the ids of the regions a footprint with the given contour may cover."""
+        center, radius = _get_bounding_cap(lons, lats)
+        distances = _angular_distances(self._centers, center)
+        overlapping = distances <= self._radii + radius + CAP_MARGIN
+        return frozenset(area_id for area_id, overlaps in zip(self._area_ids, overlapping) if overlaps)
+
+
+def _utcnow():
+    """Get the current time in UTC."""
+    return dt.datetime.now(dt.timezone.utc)
+
+
+# Maximum age of the orbits read from TLEs that are not in a local file
+DEFAULT_TLE_MAX_AGE = timedelta(hours=24)
+# Interval between the listings of the TLE files
+TLE_LISTING_INTERVAL = timedelta(minutes=1)
+
+
+class OrbitCache:
+    """Cache of the orbits of the platforms, shared by the region collectors of the process.
+
+    The orbit of a platform is read again when the newest TLE file changes or
+    when the orbit is older than *max_age*.  With *tle_dir*, the TLEs are read
+    from the files of that directory only, newest first, so that they are
+    never downloaded.  Otherwise the TLEs are found as pyorbital does, from
+    the files matching the ``TLES`` environment variable or from internet.
+    Orbits not read from a local file are kept for at most
+    ``DEFAULT_TLE_MAX_AGE`` when *max_age* is not given.  A failed refresh is
+    tried again only when the orbit gets too old again or the TLE files change.
+    The TLE files are listed at most once every ``TLE_LISTING_INTERVAL``.
+    """
+
+    def __init__(self, tle_dir=None, max_age=None):
+        """Set up the cache."""
+        self.tle_dir = tle_dir
+        self.max_age = max_age
+        self._orbits = {}
+        self._tle_files = []
+        self._newest_tle_file = None
+        self._listing_time = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_orbital(self, platform_name):
+        """Get the orbit of the platform."""
+        with self._lock:
+            tle_files, source = self._get_tle_files()
+            try:
+                orbital, orbital_source, created = self._orbits[platform_name]
+            except KeyError:
+                pass
+            else:
+                if orbital_source == source and not self._is_too_old(created, source):
+                    self.hits += 1
+                    return orbital
+            self.misses += 1
+            try:
+                orbital = self._create_orbital(platform_name, tle_files)
+            except (KeyError, OSError):
+                if platform_name not in self._orbits:
+                    raise
+                logger.warning("Could not refresh the orbit of %s, using the previous one.",
+                               platform_name, exc_info=True)
+                orbital = self._orbits[platform_name][0]
+            self._orbits[platform_name] = (orbital, source, _utcnow())
+            return orbital
+
+    def _get_tle_files(self):
+        """Get the local TLE files, newest first, and the name and modification time of the newest one.
+
+        The files are listed again only after ``TLE_LISTING_INTERVAL``.
+        """
+        now = _utcnow()
+        if self._listing_time is None or now - self._listing_time >= TLE_LISTING_INTERVAL:
+            self._tle_files = self._list_tle_files()
+            self._newest_tle_file = _get_newest_file(self._tle_files)
+            self._listing_time = now
+        return self._tle_files, self._newest_tle_file
+
+    def _list_tle_files(self):
+        """List the local TLE files, newest first."""
+        if self.tle_dir is not None:
+            pattern = os.path.join(self.tle_dir, "*")
+        else:
+            pattern = os.environ.get("TLES")
+            if not pattern:
+                return []
+        files = [filename for filename in glob.glob(pattern) if os.path.isfile(filename)]
+        return sorted(files, key=os.path.getmtime, reverse=True)
+
+    def _is_too_old(self, created, source):
+        max_age = self.max_age
+        if max_age is None and source is None:
+            max_age = DEFAULT_TLE_MAX_AGE
+        return max_age is not None and _utcnow() - created > max_age
+
+    def _create_orbital(self, platform_name, tle_files):
+        """Create the orbit of the platform from the first TLE file that has it."""
+        names = [platform_name]
+        if platform_name in JPSS_TLE_NAMES:
+            names.append(JPSS_TLE_NAMES[platform_name])
+        if self.tle_dir is None:
+            tle_files = [None]
+        for tle_file in tle_files:
+            for name in names:
+                try:
+                    return Orbital(name, tle_file=tle_file)
+                except KeyError:
+                    continue
+        raise KeyError(f"Found no TLE for {platform_name} in {self.tle_dir or 'the TLE files'}")
+
+    def __len__(self):
+        """Get the number of cached orbits."""
+        return len(self._orbits)
+
+
+def _get_newest_file(filenames):
+    """Get the name and the modification time of the first file."""
+    if not filenames:
+        return None
+    return filenames[0], os.path.getmtime(filenames[0])
+
+
+_orbit_caches = {}
+
+
+def get_orbit_cache(tle_dir=None, max_age=None):
+    """Get the orbit cache of the process for the given TLE settings."""
+    key = (tle_dir, max_age)
+    if key not in _orbit_caches:
+        _orbit_caches[key] = OrbitCache(tle_dir, max_age)
+    return _orbit_caches[key]
+
+
+class FootprintCache:
+    """Least recently used cache of the granule passes, shared by the region collectors.
+
+    The swath boundary of a pass is computed the first time its coverage of
+    a region is needed and is kept in the pass, so the footprint of a granule
+    is computed once for all the regions.  The regions added to the cache are
+    indexed, so that the exact coverage is computed only for the regions close
+    to the footprint.  The orbits of the platforms are taken from
+    *orbit_cache*, by default the orbit cache of the process.
+
+    The last *coverage_cache_size* coverages are kept, so that a granule sent
+    again or already checked when predicting the granules does not need a new
+    intersection.
+    """
+
+    def __init__(self, maxsize=1024, orbit_cache=None, coverage_cache_size=4096):
+        """Set up the cache."""
+        self.maxsize = maxsize
+        if orbit_cache is None:
+            orbit_cache = get_orbit_cache()
+        self.orbit_cache = orbit_cache
+        self.coverage_cache_size = coverage_cache_size
+        self._passes = OrderedDict()
+        self._coverages = OrderedDict()
+        self.region_index = RegionIndex()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.coverage_hits = 0
+        self.coverage_misses = 0
+
+    def add_region(self, region):
+        """Add a region to the index of the regions."""
+        if region.area_id in self.region_index:
+            return
+        self.region_index.add(region)
+        for entry in self._passes.values():
+            entry[1] = None
+
+    def get_pass(self, platform_name, start_time, end_time, instrument):
+        """Get the pass of the granule."""
+        return self._get_entry((platform_name, start_time, end_time, instrument))[0]
+
+    def _get_entry(self, key):
+        """Get the pass of the granule and the candidate regions found so far."""
+        try:
+            entry = self._passes[key]
+        except KeyError:
+            self.misses += 1
+            platform_name, start_time, end_time, instrument = key
+            entry = [Pass(platform_name, start_time, end_time, instrument=instrument,
+                          orb=self.orbit_cache.get_orbital(platform_name)), None]
+            self._passes[key] = entry
+            if len(self._passes) > self.maxsize:
+                self._passes.popitem(last=False)
+        else:
+            self.hits += 1
+            self._passes.move_to_end(key)
+        return entry
+
+    def get_coverage(self, platform_name, start_time, end_time, instrument, region):
+        """Get the fraction of the region covered by the granule.
+
+        Indexed regions far from the footprint of the granule get zero
+        coverage without computing the intersection.
+        """
+        key = (platform_name, start_time, end_time, instrument, region.area_id)
+        try:
+            coverage = self._coverages[key]
+        except KeyError:
+            self.coverage_misses += 1
+            coverage = self._compute_coverage(platform_name, start_time, end_time, instrument, region)
+            if self.coverage_cache_size > 0:
+                self._coverages[key] = coverage
+                if len(self._coverages) > self.coverage_cache_size:
+                    self._coverages.popitem(last=False)
+        else:
+            self.coverage_hits += 1
+            self._coverages.move_to_end(key)
+        return coverage
+
+    def _compute_coverage(self, platform_name, start_time, end_time, instrument, region):
+        entry = self._get_entry((platform_name, start_time, end_time, instrument))
+        granule_pass = entry[0]
+        if region.area_id in self.region_index:
+            if entry[1] is None:
+                entry[1] = self.region_index.find_candidates(*granule_pass.boundary.contour())
+            if region.area_id not in entry[1]:
+                self.rejected += 1
+                return 0
+        return granule_pass.area_coverage(region)
+
+    def __len__(self):
+        """Get the number of cached passes."""
+        return len(self._passes)
+
 
 class RegionCollector(object):
     """This is the region collector.
@@ -21,13 +342,22 @@ class RegionCollector(object):
 
     *timeliness* defines the max allowed age of the granule.
 
+    The granule footprints are taken from *footprint_cache*, which can be
+    shared by the collectors of all the regions.
+
+    With *batch_prediction*, the granules covering the region are predicted
+    from one propagation of the orbit, and the exact coverage is computed only
+    for the granules at the edges of the region.
+
     """
 
     def __init__(self, region,
                  timeliness=None,
                  granule_duration=None,
                  schedule_cut=None,
-                 schedule_cut_method=None):
+                 schedule_cut_method=None,
+                 footprint_cache=None,
+                 batch_prediction=False):
         """Initialize the region collector."""
         self.region = region  # area def
         self.granule_times = set()
@@ -39,9 +369,14 @@ class RegionCollector(object):
         self.last_file_added = False
         self.schedule_cut = schedule_cut
         self.schedule_cut_method = schedule_cut_method
+        self.batch_prediction = batch_prediction
+        if footprint_cache is None:
+            footprint_cache = FootprintCache()
+        footprint_cache.add_region(region)
+        self.footprint_cache = footprint_cache
 
     @classmethod
-    def from_dict_config(cls, region, config_items):
+    def from_dict_config(cls, region, config_items, footprint_cache=None):
         """Create a instance of the class using a configuration dictionary to get the parameters."""
         timeliness = timedelta(minutes=int(config_items["timeliness"]))
 
@@ -53,8 +388,10 @@ class RegionCollector(object):
         schedule_cut = config_items.get('schedule_cut')
         # If you want to provide your own method to provide the schedule cut data
         schedule_cut_method = config_items.get('schedule_cut_method')
+        batch_prediction = str(config_items.get("batch_prediction", False)).lower() in ("1", "yes", "true", "on")
 
-        return cls(region, timeliness, duration, schedule_cut, schedule_cut_method)
+        return cls(region, timeliness, duration, schedule_cut, schedule_cut_method, footprint_cache,
+                   batch_prediction)
 
     def __call__(self, granule_metadata):
         """Perform the collection on the granule."""
@@ -99,7 +436,7 @@ class RegionCollector(object):
                      str(_get_sensor(granule_metadata)),
                      start_time.strftime('%Y%m%d %H:%M:%S'), end_time.strftime('%Y%m%d %H:%M:%S'))
 
-        if _granule_covers_region(granule_metadata, self.region):
+        if _granule_covers_region(granule_metadata, self.region, self.footprint_cache):
             self._predict_pass_granules(granule_metadata)
 
         # If last granule return swath and cleanup
@@ -194,10 +531,11 @@ class RegionCollector(object):
                         self.region.area_id)
             logger.debug("Predicting granules covering %s", self.region.area_id)
 
-            # Forward prediction
-            self._predict(granule_metadata, self.granule_duration)
-            # Backward prediction
-            self._predict(granule_metadata, -self.granule_duration)
+            if not (self.batch_prediction and self._predict_batch(granule_metadata)):
+                # Forward prediction
+                self._predict(granule_metadata, self.granule_duration)
+                # Backward prediction
+                self._predict(granule_metadata, -self.granule_duration)
             # Check whether schedule should be used
             self._check_schedule(granule_metadata)
 
@@ -233,13 +571,60 @@ class RegionCollector(object):
         gr_time = granule_metadata["start_time"]
         while True:
             gr_time += step
-            gr_pass = Pass(_get_platform_name(granule_metadata), gr_time,
-                           gr_time + self.granule_duration,
-                           instrument=_get_sensor(granule_metadata))
-            if not gr_pass.area_coverage(self.region) > 0:
+            coverage = self.footprint_cache.get_coverage(_get_platform_name(granule_metadata), gr_time,
+                                                         gr_time + self.granule_duration,
+                                                         _get_sensor(granule_metadata), self.region)
+            if not coverage > 0:
                 break
             self.planned_granule_times.add(gr_time)
 
+    def _predict_batch(self, granule_metadata):
+        """Predict the granules in both directions from one propagation of the orbit.
+
+        The nadir track is computed for half an orbit on both sides of the
+        granule.  The granules with a nadir point inside the region cover it,
+        the granules with the whole swath away from the bounding cap of the
+        region do not, and the exact coverage is computed for the others only.
+        Return False if the footprint of the granule is not known.
+        """
+        platform_name = _get_platform_name(granule_metadata)
+        sensor = _get_sensor(granule_metadata)
+        start_time = granule_metadata["start_time"]
+        granule_pass = self.footprint_cache.get_pass(platform_name, start_time, granule_metadata["end_time"], sensor)
+        contour_lons, contour_lats = granule_pass.boundary.contour()
+        if len(contour_lons) == 0:
+            return False
+
+        num_granules = int(np.ceil(granule_pass.orb.orbit_elements.period / 2 /
+                                   (self.granule_duration / timedelta(minutes=1))))
+        lons, lats = _get_nadir_track(granule_pass.orb, start_time, self.granule_duration, num_granules)
+        nadir = _to_unit_vectors(lons, lats)
+        received = nadir[num_granules]
+        swath_half_width = _angular_distances(_to_unit_vectors(contour_lons, contour_lats), received).min(axis=1).max()
+        sample_spacing = np.arccos(np.clip(np.sum(received[1:] * received[:-1], axis=-1), -1, 1)).max()
+        center, radius = self.footprint_cache.region_index.get_cap(self.region.area_id)
+        distances = _angular_distances(nadir, center)
+        may_cover = distances.min(axis=1) <= radius + swath_half_width + sample_spacing / 2 + PREDICTION_MARGIN
+        covers = ((distances <= radius) & _are_inside(self.region, lons, lats)).any(axis=1)
+
+        for step in (1, -1):
+            index = num_granules + step
+            while 0 <= index < len(nadir):
+                gr_time = start_time + (index - num_granules) * self.granule_duration
+                if not may_cover[index]:
+                    break
+                if not covers[index]:
+                    coverage = self.footprint_cache.get_coverage(platform_name, gr_time,
+                                                                 gr_time + self.granule_duration,
+                                                                 sensor, self.region)
+                    if not coverage > 0:
+                        break
+                self.planned_granule_times.add(gr_time)
+                index += step
+            else:
+                self._predict({**granule_metadata, "start_time": gr_time}, step * self.granule_duration)
+        return True
+
     def _check_schedule(self, granule_metadata):
         """Check overpass schedule for the satellite and clean the planned granules.
 
@@ -286,6 +671,31 @@ class RegionCollector(object):
                         self.planned_granule_times.remove(pgt)
 
 
+def _get_nadir_track(orb, start_time, granule_duration, num_granules):
+    """Get the nadir longitudes and latitudes of the granules around a granule.
+
+    The orbit is propagated in one call for the *num_granules* granules on
+    both sides of the granule starting at *start_time*, sampled along each
+    granule, so the given granule is at index *num_granules*.
+    """
+    offsets = (np.arange(-num_granules, num_granules + 1)[:, np.newaxis] +
+               np.linspace(0, 1, PREDICTION_SAMPLES + 1)) * (granule_duration / timedelta(microseconds=1))
+    start = np.datetime64(start_time.astimezone(dt.timezone.utc).replace(tzinfo=None), "us")
+    lons, lats, _ = orb.get_lonlatalt(start + offsets.astype("timedelta64[us]").ravel())
+    return lons.reshape(offsets.shape), lats.reshape(offsets.shape)
+
+
+def _are_inside(region, lons, lats):
+    """Check which points are inside the region, away from its edges."""
+    transformer = Transformer.from_crs("EPSG:4326", region.crs, always_xy=True)
+    x, y = transformer.transform(lons, lats)
+    xmin, ymin, xmax, ymax = region.area_extent
+    x_inset = PREDICTION_INSET * (xmax - xmin)
+    y_inset = PREDICTION_INSET * (ymax - ymin)
+    with np.errstate(invalid="ignore"):
+        return (x > xmin + x_inset) & (x < xmax - x_inset) & (y > ymin + y_inset) & (y < ymax - y_inset)
+
+
 def _ensure_granule_metadata_utc_aware(granule_metadata):
     """Make sure the granule metadata dict contains utc-aware datetimes."""
     if "start_time" in granule_metadata:
@@ -328,12 +738,11 @@ def _get_sensor(granule_metadata):
     return sensor
 
 
-def _granule_covers_region(granule_metadata, region):
-    granule_pass = Pass(_get_platform_name(granule_metadata),
-                        granule_metadata["start_time"],
-                        granule_metadata["end_time"],
-                        instrument=_get_sensor(granule_metadata))
-    coverage = granule_pass.area_coverage(region)
+def _granule_covers_region(granule_metadata, region, footprint_cache):
+    coverage = footprint_cache.get_coverage(_get_platform_name(granule_metadata),
+                                            granule_metadata["start_time"],
+                                            granule_metadata["end_time"],
+                                            _get_sensor(granule_metadata), region)
     if coverage > 0:
         coverage_str = f"is overlapping region {region.description:s} by fraction {coverage:.5f}"
         _log_overlap_message(granule_metadata, coverage_str)
@@ -370,8 +779,18 @@ def get_regions_from_config_dict(config_items):
 
 
 def create_collectors_from_config_dict(config_items):
-    """Create region collectors for a configuration dictionary."""
+    """Create region collectors for a configuration dictionary.
+
+    The collectors share the granule footprints, and the orbits with all the
+    collectors of the process using the same TLE settings.
+    """
     regions = get_regions_from_config_dict(config_items)
+    try:
+        tle_max_age = timedelta(hours=float(config_items["tle_max_age"]))
+    except KeyError:
+        tle_max_age = None
+    footprint_cache = FootprintCache(orbit_cache=get_orbit_cache(config_items.get("tle_dir"), tle_max_age),
+                                     coverage_cache_size=int(config_items.get("coverage_cache_size", 4096)))
 
-    return [RegionCollector.from_dict_config(region, config_items)
+    return [RegionCollector.from_dict_config(region, config_items, footprint_cache)
             for region in regions]
@@ -1,10 +1,11 @@
 """Segment gatherer."""
 
 import argparse
+import glob
 import os
 import time
 
-from pytroll_collectors.segments import SegmentGatherer
+from pytroll_collectors.segments import MultiSegmentGatherer, SegmentGatherer, ShardedSegmentGatherer
 from pytroll_collectors.segments import ini_to_dict
 from pytroll_collectors.helper_functions import read_yaml
 from pytroll_collectors.logging import setup_logging
@@ -22,21 +23,45 @@ def arg_parse(args=None):
                         default=None)
     parser.add_argument("-v", "--verbose", help="print debug messages too",
                         action="store_true")
-    parser.add_argument("-c", "--config", help="config file to be used")
-    parser.add_argument("-C", "--config_item",
-                        help="config item to use with .ini files")
+    parser.add_argument("-c", "--config", action="append",
+                        help="config file or directory of YAML config files to be used. "
+                             "Can be given several times to run several gatherers in one process.")
+    parser.add_argument("-C", "--config_item", action="append",
+                        help="config item to use with .ini files. Can be given several times.")
 
     return parser.parse_args(args)
 
 
+def read_configs(paths, config_items=None):
+    """Read the gatherer configs from the given files and directories.
+
+    A directory is expanded to the YAML files in it, and a YAML file can hold
+    a list of configs.  With *config_items*, the paths are .ini files and
+    each of the items is read from each of them.
+    """
+    configs = []
+    for path in paths:
+        if config_items:
+            configs.extend(ini_to_dict(path, item) for item in config_items)
+            continue
+        if os.path.isdir(path):
+            fnames = sorted(glob.glob(os.path.join(path, "*.yaml")) + glob.glob(os.path.join(path, "*.yml")))
+        else:
+            fnames = [path]
+        for fname in fnames:
+            config = read_yaml(fname)
+            if isinstance(config, list):
+                configs.extend(config)
+            else:
+                configs.append(config)
+    return configs
+
+
 def main():
     """Parse cmdline, read config etc."""
     args = arg_parse()
 
-    if args.config_item:
-        config = ini_to_dict(args.config, args.config_item)
-    else:
-        config = read_yaml(args.config)
+    configs = read_configs(args.config, args.config_item)
 
     print("Setting timezone to UTC")
     os.environ["TZ"] = "UTC"
@@ -44,7 +69,12 @@ def main():
 
     setup_logging(args, "segment_gatherer")
 
-    gatherer = SegmentGatherer(config)
+    if len(configs) == 1 and configs[0].get("workers", 1) > 1:
+        gatherer = ShardedSegmentGatherer(configs[0])
+    elif len(configs) == 1:
+        gatherer = SegmentGatherer(configs[0])
+    else:
+        gatherer = MultiSegmentGatherer(configs)
 
     try:
         gatherer.run()
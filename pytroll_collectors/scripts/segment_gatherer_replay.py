@@ -0,0 +1,384 @@
+"""Replay a recorded stream of posttroll messages through the segment gatherer.
+
+The messages are fed to the gatherer without any messaging, and the time
+of the gatherer is simulated from the receive times of the messages, so
+that the slots time out as they would have in operations.  Throughput,
+publication latency and peak memory are reported.
+"""
+
+import argparse
+import datetime as dt
+import json
+import logging
+import random
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from posttroll.message import Message
+
+from pytroll_collectors import segments
+from pytroll_collectors.scripts.segment_gatherer import read_configs
+from pytroll_collectors.utils import ensure_utc_aware
+
+BASE_TIME = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+# The timeouts are checked with a strict comparison
+TICK = dt.timedelta(microseconds=1)
+
+POSTTROLL_CONFIG = {"topics": ["/segment"], "publish_topic": "/dataset", "nameservers": False}
+
+MSG_CHANNELS = ["VIS006", "VIS008", "IR_016", "IR_039", "WV_062", "WV_073",
+                "IR_087", "IR_097", "IR_108", "IR_120", "IR_134"]
+MSG_FILES = ",".join(f"{channel}:000001-000008" for channel in MSG_CHANNELS) + ",:PRO,:EPI"
+MSG_CONFIG = {
+    "patterns": {
+        "msg": {
+            "pattern": ("H-000-{hrit_format:4s}__-{platform_shortname:4s}________-"
+                        "{channel_name:_<9s}-{segment:_<9s}-{start_time:%Y%m%d%H%M}-__"),
+            "critical_files": ":EPI,:PRO",
+            "wanted_files": MSG_FILES,
+            "all_files": MSG_FILES,
+            "variable_tags": [],
+        },
+    },
+    "timeliness": 300,
+    "time_name": "start_time",
+    "time_tolerance": 30,
+    "posttroll": POSTTROLL_CONFIG,
+}
+
+FCI_CONFIG = {
+    "patterns": {
+        "fci": {
+            "pattern": ("W_XX-EUMETSAT-Darmstadt,IMG+SAT,{platform_name:4s}+FCI-1C-RRAD-FDHSI-FD--CHK-"
+                        "{segment_type}--{locality}-NC4E_C_EUMT_{processing_time}_{processor}_{processor_status}_"
+                        "{start_time:%Y%m%d%H%M%S}_{end_time:%Y%m%d%H%M%S}_N_{special_compression}_"
+                        "{service_status}_{repeat_cycle_in_day:>04d}_{segment:0>4s}.nc"),
+            "critical_files": None,
+            "wanted_files": ":0001-0040",
+            "all_files": ":0001-0040",
+            "variable_tags": ["processing_time", "end_time", "segment_type"],
+            "group_by_minutes": 10,
+            "time_tolerance": 600,
+        },
+    },
+    "timeliness": 900,
+    "time_name": "start_time",
+    "posttroll": POSTTROLL_CONFIG,
+}
+
+HIMAWARI_CHANNELS = [f"B{band:02d}" for band in range(1, 17)]
+HIMAWARI_FILES = ",".join(f"{channel}:001-010" for channel in HIMAWARI_CHANNELS)
+HIMAWARI_CONFIG = {
+    "patterns": {
+        "himawari": {
+            "pattern": "IMG_DK01{channel_name:3s}_{start_time:%Y%m%d%H%M}_{segment:0>3s}",
+            "critical_files": HIMAWARI_FILES,
+            "wanted_files": HIMAWARI_FILES,
+            "all_files": HIMAWARI_FILES,
+            "is_critical_set": True,
+            "variable_tags": [],
+        },
+    },
+    "timeliness": 300,
+    "time_name": "start_time",
+    "group_by_minutes": 10,
+    "posttroll": POSTTROLL_CONFIG,
+}
+
+
+def _file_message(uid, metadata):
+    """Create a posttroll file message."""
+    data = {"uid": uid, "uri": "/data/" + uid}
+    data.update(metadata)
+    return Message("/segment", "file", data)
+
+
+def _sort_and_drop(stream, missing, rng):
+    """Sort the stream by receive time and drop the given fraction of the messages."""
+    return sorted(((receive_time, msg) for receive_time, msg in stream if rng.random() >= missing),
+                  key=lambda item: item[0])
+
+
+def msg_stream(slots=4, missing=0.0, seed=0):
+    """Create a stream of MSG HRIT segments, one slot every 15 minutes.
+
+    The prologue arrives first, 12 minutes after the nominal time, followed
+    by the channel segments in the next two minutes and the epilogue.
+    """
+    rng = random.Random(seed)
+    stream = []
+    for i in range(slots):
+        start_time = BASE_TIME + dt.timedelta(minutes=15 * i)
+        arrival = start_time + dt.timedelta(minutes=12)
+        items = [("", "PRO")] + [(channel, f"{segment:06d}") for segment in range(1, 9)
+                                 for channel in MSG_CHANNELS] + [("", "EPI")]
+        for j, (channel_name, segment) in enumerate(items):
+            uid = (f"H-000-MSG4__-MSG4________-{channel_name:_<9s}-{segment:_<9s}-"
+                   f"{start_time:%Y%m%d%H%M}-__")
+            receive_time = arrival + dt.timedelta(seconds=j * 120 / len(items) + rng.uniform(0, 0.5))
+            stream.append((receive_time, _file_message(uid, {"sensor": ["seviri"], "platform_name": "Meteosat-11"})))
+    return _sort_and_drop(stream, missing, rng)
+
+
+def fci_stream(slots=4, missing=0.0, seed=0):
+    """Create a stream of FCI FDHSI chunks, one repeat cycle every 10 minutes.
+
+    The 40 chunks of the cycle are scanned during the cycle and each arrives
+    about half a minute after its end time.
+    """
+    rng = random.Random(seed)
+    stream = []
+    for i in range(slots):
+        cycle_start = BASE_TIME + dt.timedelta(minutes=10 * i)
+        for chunk in range(1, 41):
+            start_time = cycle_start + dt.timedelta(seconds=8 + 14 * (chunk - 1))
+            end_time = start_time + dt.timedelta(seconds=14)
+            receive_time = end_time + dt.timedelta(seconds=30 + rng.uniform(0, 5))
+            uid = ("W_XX-EUMETSAT-Darmstadt,IMG+SAT,MTI1+FCI-1C-RRAD-FDHSI-FD--CHK-BODY--DIS-NC4E_C_EUMT_"
+                   f"{receive_time:%Y%m%d%H%M%S}_IDPFI_OPE_{start_time:%Y%m%d%H%M%S}_{end_time:%Y%m%d%H%M%S}_"
+                   f"N_JLS_O_{i + 1:04d}_{chunk:04d}.nc")
+            stream.append((receive_time, _file_message(uid, {"sensor": ["fci"], "platform_name": "MTI1"})))
+    return _sort_and_drop(stream, missing, rng)
+
+
+def himawari_stream(slots=4, missing=0.0, seed=0):
+    """Create a stream of Himawari HSD segments, one slot every 10 minutes.
+
+    The segments of all the bands arrive in the two minutes after the end
+    of the full disk scan.
+    """
+    rng = random.Random(seed)
+    stream = []
+    for i in range(slots):
+        start_time = BASE_TIME + dt.timedelta(minutes=10 * i)
+        arrival = start_time + dt.timedelta(minutes=10)
+        items = [(channel, f"{segment:03d}") for segment in range(1, 11) for channel in HIMAWARI_CHANNELS]
+        for j, (channel_name, segment) in enumerate(items):
+            uid = f"IMG_DK01{channel_name}_{start_time:%Y%m%d%H%M}_{segment}"
+            receive_time = arrival + dt.timedelta(seconds=j * 120 / len(items) + rng.uniform(0, 0.5))
+            stream.append((receive_time, _file_message(uid, {"sensor": ["ahi"], "platform_name": "Himawari-9"})))
+    return _sort_and_drop(stream, missing, rng)
+
+
+SYNTHETIC_STREAMS = {
+    "msg": (MSG_CONFIG, msg_stream),
+    "fci": (FCI_CONFIG, fci_stream),
+    "himawari": (HIMAWARI_CONFIG, himawari_stream),
+}
+
+
+def read_stream(fname):
+    """Read a recorded stream of messages.
+
+    Each line of the file is a JSON object with the receive time of the
+    message as an ISO 8601 string in ``received`` and the encoded posttroll
+    message in ``message``.
+    """
+    stream = []
+    with open(fname) as fid:
+        for line in fid:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            receive_time = ensure_utc_aware(dt.datetime.fromisoformat(record["received"]))
+            stream.append((receive_time, Message(rawstr=record["message"])))
+    return stream
+
+
+def write_stream(fname, stream):
+    """Write a stream of messages in the format read by :func:`read_stream`."""
+    with open(fname, "w") as fid:
+        for receive_time, msg in stream:
+            fid.write(json.dumps({"received": receive_time.isoformat(), "message": msg.encode()}) + "\n")
+
+
+class SimulatedClock:
+    """Clock for the gatherer, moved forward by the replay.
+
+    With a *speed* of zero the clock jumps to the given times, otherwise the
+    replay sleeps so that the simulated time passes *speed* times faster than
+    the wall clock.
+    """
+
+    def __init__(self, start, speed=0):
+        """Initialize the clock at the *start* time."""
+        self.now = start
+        self._speed = speed
+
+    def __call__(self):
+        """Get the current simulated time."""
+        return self.now
+
+    def set(self, time_obj):
+        """Move the clock forward to the given time."""
+        if time_obj <= self.now:
+            return
+        if self._speed:
+            time.sleep((time_obj - self.now).total_seconds() / self._speed)
+        self.now = time_obj
+
+
+class ReplayPublisher:
+    """Publisher keeping the sent messages with the simulated time of sending."""
+
+    def __init__(self, clock):
+        """Initialize the publisher."""
+        self._clock = clock
+        self.sent = []
+
+    def send(self, msg):
+        """Keep the message."""
+        self.sent.append((self._clock(), msg))
+
+    def stop(self):
+        """Stop the publisher."""
+
+
+@contextmanager
+def simulated_time(clock):
+    """Run the gatherer with the given clock."""
+    utcnow = segments._utcnow
+    segments._utcnow = clock
+    try:
+        yield clock
+    finally:
+        segments._utcnow = utcnow
+
+
+def _advance(gatherer, clock, time_obj):
+    """Move the clock to *time_obj*, triaging the slots at each timeout on the way."""
+    timeout = gatherer.get_next_timeout()
+    while timeout is not None and timeout < time_obj:
+        clock.set(timeout + TICK)
+        gatherer._check_slots()
+        timeout = gatherer.get_next_timeout()
+    clock.set(time_obj)
+
+
+def replay(config, stream, speed=0):
+    """Feed the stream of (receive time, message) pairs to a gatherer using simulated time.
+
+    The slots that are still open at the end of the stream are left to time
+    out.  Return the statistics of the replay.
+    """
+    if not stream:
+        raise ValueError("Nothing to replay, the message stream is empty")
+    clock = SimulatedClock(stream[0][0], speed)
+    publisher = ReplayPublisher(clock)
+    receive_times = {}
+    with simulated_time(clock):
+        gatherer = segments.SegmentGatherer(config)
+        gatherer._subject = config["posttroll"]["publish_topic"]
+        gatherer._publisher = publisher
+        gatherer._start()
+        start = time.perf_counter()
+        for receive_time, msg in stream:
+            _advance(gatherer, clock, receive_time)
+            receive_times[msg.data.get("uid")] = receive_time
+            gatherer._process_messages([msg])
+            gatherer._check_slots()
+        if gatherer.slots:
+            _advance(gatherer, clock, max(slot["timeout"] for slot in gatherer.slots.values()) + TICK)
+        elapsed = time.perf_counter() - start
+        gatherer._finish()
+    latencies = [_get_latency(sent_time, msg, receive_times) for sent_time, msg in publisher.sent]
+    return {"messages": len(stream),
+            "elapsed": elapsed,
+            "published": len(publisher.sent),
+            "latencies": [latency for latency in latencies if latency is not None],
+            "gatherer": gatherer.statistics()}
+
+
+def _get_latency(sent_time, rawstr, receive_times):
+    """Get the seconds from the last file of a published message to its publication."""
+    data = Message(rawstr=rawstr).data
+    datasets = list(data.get("dataset", []))
+    collection = data.get("collection", {})
+    for item in (collection.values() if isinstance(collection, dict) else collection):
+        datasets.extend(item.get("dataset", []))
+    times = [receive_times[dataset["uid"]] for dataset in datasets if dataset.get("uid") in receive_times]
+    if not times:
+        return None
+    return (sent_time - max(times)).total_seconds()
+
+
+def format_report(result, peak_memory=None):
+    """Format the statistics of a replay."""
+    lines = [f"Messages: {result['messages']}",
+             f"Elapsed: {result['elapsed']:.3f} s",
+             f"Throughput: {result['messages'] / max(result['elapsed'], 1e-9):.0f} msg/s",
+             f"Published: {result['published']}"]
+    latencies = sorted(result["latencies"])
+    if latencies:
+        p95 = latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]
+        lines.append(f"Latency after the last file: mean {statistics.mean(latencies):.1f} s, "
+                     f"median {statistics.median(latencies):.1f} s, p95 {p95:.1f} s, max {latencies[-1]:.1f} s")
+    if peak_memory is not None:
+        lines.append(f"Peak memory: {peak_memory / 1024 ** 2:.1f} MiB")
+    lines.append(f"Gatherer: {result['gatherer']}")
+    return "\n".join(lines)
+
+
+def arg_parse(args=None):
+    """Handle input arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-s", "--stream",
+                        help="JSON lines file of recorded messages, with the receive time in 'received' "
+                             "and the encoded posttroll message in 'message'.")
+    source.add_argument("--synthetic", choices=sorted(SYNTHETIC_STREAMS),
+                        help="Replay a synthetic stream, with its own gatherer config.")
+    parser.add_argument("-c", "--config",
+                        help="Gatherer config file, required for a recorded stream.")
+    parser.add_argument("-C", "--config_item",
+                        help="Config item to use with .ini files.")
+    parser.add_argument("--slots", type=int, default=12,
+                        help="Number of slots in a synthetic stream. Default: %(default)s")
+    parser.add_argument("--missing", type=float, default=0.0,
+                        help="Fraction of the files dropped from a synthetic stream. Default: %(default)s")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed of a synthetic stream. Default: %(default)s")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Replay speed relative to the recorded times, 0 for as fast as possible. "
+                             "Default: %(default)s")
+    parser.add_argument("--record",
+                        help="Write the replayed stream to this file.")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="Do not replay a second time to measure the peak memory.")
+    parser.add_argument("-v", "--verbose", help="print the gatherer logs",
+                        action="store_true")
+    opts = parser.parse_args(args)
+    if opts.stream and not opts.config:
+        parser.error("A config file is needed to replay a recorded stream")
+    return opts
+
+
+def main(args=None):
+    """Replay the messages and print the statistics."""
+    opts = arg_parse(args)
+    logging.basicConfig(level=logging.INFO if opts.verbose else logging.WARNING)
+
+    if opts.synthetic:
+        config, create_stream = SYNTHETIC_STREAMS[opts.synthetic]
+        stream = create_stream(slots=opts.slots, missing=opts.missing, seed=opts.seed)
+    else:
+        stream = read_stream(opts.stream)
+    if opts.config:
+        config = read_configs([opts.config], [opts.config_item] if opts.config_item else None)[0]
+    if opts.record:
+        write_stream(opts.record, stream)
+
+    result = replay(config, stream, speed=opts.speed)
+    peak_memory = None
+    if opts.memory:
+        tracemalloc.start()
+        replay(config, stream)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print(format_report(result, peak_memory))
+
+
+if __name__ == "__main__":
+    main()
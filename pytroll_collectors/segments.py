@@ -35,18 +35,30 @@ module/script should be used.  This is the case if a polar satellite
 reception system produces multiple files for the same overpass.
 """
 
+import bisect
 import datetime as dt
+import heapq
+import inspect
+import itertools
 import logging.handlers
+import multiprocessing
 import os
+import pickle
 import signal
+import string
+import threading
+import time
+import zlib
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
 from enum import Enum
+from functools import cached_property, lru_cache
 
 import trollsift
+from trollsift.parser import globify_formatter
 from posttroll import message as pmessage
 from posttroll.listener import ListenerContainer
-from queue import Empty
+from queue import Empty, Queue
 from urllib.parse import urlparse, urlunparse
 
 from pytroll_collectors.utils import check_nameserver_options
@@ -70,15 +82,226 @@ class Status(Enum):
 
 DO_NOT_COPY_KEYS = ("uid", "uri", "channel_name", "segment", "sensor", "filesystem", "path")
 REMOVE_TAGS = {'path', 'segment'}
+SNAPSHOT_VERSION = 2
+EXISTING_FILES_BATCH_SIZE = 100
+RESULT_POLL_INTERVAL = 0.1
+# Number of slot times the front-end of the sharded gatherer remembers to shard the files by
+MAX_SHARD_SLOT_TIMES = 1000
+EVICTION_POLICIES = ('oldest', 'farthest')
+FILE_ITEM_KEYS = ('channel_name', 'segment')
+
+
+class MaskTemplate:
+    """Precompiled trollsift format for creating file masks.
+
+    The format string is split into its literal parts and fields once, so
+    that creating a mask only needs the formatting of the field values.
+    The result is identical to :func:`trollsift.globify`.
+    """
+
+    def __init__(self, fmt):
+        """Compile the format."""
+        self.fmt = fmt
+        self._parts = []
+        self.compiled = True
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(fmt):
+            if field_name is not None and (conversion or not field_name.isidentifier() or '{' in format_spec):
+                # Fall back to trollsift for nested or converted fields
+                self.compiled = False
+            self._parts.append((literal, field_name, format_spec))
+        self._item_cache = {}
+        self._item_specs = {}
+        for _, field_name, format_spec in self._parts:
+            if field_name in FILE_ITEM_KEYS:
+                self._item_specs.setdefault(field_name, format_spec)
+        self.segment_bits = {}
+        self.file_key_names = {}
+
+    def globify(self, mda):
+        """Create a file mask for the metadata."""
+        if not self.compiled:
+            return globify_formatter.format(self.fmt, **mda)
+        chunks = []
+        for literal, field_name, format_spec in self._parts:
+            chunks.append(literal)
+            if field_name is not None:
+                chunks.append(self._format_field(mda, field_name, format_spec))
+        return ''.join(chunks)
+
+    def bind(self, mda, item_keys=FILE_ITEM_KEYS):
+        """Format all the fields except *item_keys* from the metadata.
+
+        Return a function creating the file mask from a tuple of values for
+        the *item_keys*, or None if the format could not be compiled.
+        """
+        if not self.compiled:
+            return None
+        parts = []
+        chunk = ''
+        for literal, field_name, format_spec in self._parts:
+            chunk += literal
+            if field_name is None:
+                continue
+            if field_name in item_keys:
+                parts.extend((chunk, (item_keys.index(field_name), format_spec)))
+                chunk = ''
+            else:
+                chunk += self._format_field(mda, field_name, format_spec)
+        parts.append(chunk)
+        if len(parts) == 1:
+            return lambda item: parts[0]
+
+        def _fill(item):
+            return ''.join(part if isinstance(part, str) else self._format_item(item[part[0]], part[1])
+                           for part in parts)
+        return _fill
+
+    def file_key(self, channel_name, segment):
+        """Get the structured key of a configured (channel_name, segment) item."""
+        key = self._file_key({'channel_name': channel_name, 'segment': segment})
+        self.segment_bits.setdefault(key[1], len(self.segment_bits))
+        self.file_key_names.setdefault(key, channel_name + ':' + segment)
+        return key
+
+    def file_key_from_metadata(self, mda):
+        """Get the structured (channel_name, segment) key of a file from its metadata."""
+        return self._file_key(mda)
+
+    def _file_key(self, mda):
+        return tuple(self._format_item(mda.get(field_name, globify_formatter.UNPROVIDED_VALUE),
+                                       self._item_specs[field_name])
+                     if field_name in self._item_specs else ''
+                     for field_name in FILE_ITEM_KEYS)
+
+    def signature(self, mda):
+        """Get the formatted values of the fields not identifying the file within the slot."""
+        return tuple((field_name, format_spec, value, globify_formatter.format_field(value, format_spec))
+                     for field_name, format_spec, value in self._signature_values(mda))
+
+    def matches_signature(self, mda, signature):
+        """Check that the metadata formats to the same *signature*."""
+        for field_name, format_spec, value, chunk in signature:
+            msg_value = mda.get(field_name, globify_formatter.UNPROVIDED_VALUE)
+            if msg_value is value or msg_value == value:
+                continue
+            if globify_formatter.format_field(msg_value, format_spec) != chunk:
+                return False
+        return True
+
+    def _signature_values(self, mda):
+        for _, field_name, format_spec in self._parts:
+            if field_name is None or field_name in FILE_ITEM_KEYS:
+                continue
+            yield field_name, format_spec, mda.get(field_name, globify_formatter.UNPROVIDED_VALUE)
+
+    @staticmethod
+    def _format_field(mda, field_name, format_spec):
+        value = mda.get(field_name, globify_formatter.UNPROVIDED_VALUE)
+        return globify_formatter.format_field(value, format_spec)
+
+    def _format_item(self, value, format_spec):
+        try:
+            return self._item_cache[(value, format_spec)]
+        except KeyError:
+            res = self._item_cache[(value, format_spec)] = globify_formatter.format_field(value, format_spec)
+            return res
+
+
+class SegmentKeySet:
+    """Compact set of structured (channel_name, segment) file keys.
+
+    The segments of each channel are stored as bits of an integer, the bit
+    positions being given by the *segment_bits* of the mask template
+    the keys come from.
+    """
+
+    def __init__(self, template, keys=()):
+        """Set up the key set."""
+        self._template = template
+        self._bits = {}
+        self._len = 0
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        """Add a key."""
+        channel, segment = key
+        bit = 1 << self._template.segment_bits[segment]
+        bits = self._bits.get(channel, 0)
+        if not bits & bit:
+            self._bits[channel] = bits | bit
+            self._len += 1
+
+    def update(self, keys):
+        """Add several keys."""
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        """Check if the key is in the set."""
+        try:
+            channel, segment = key
+            bit = self._template.segment_bits[segment]
+        except (KeyError, TypeError, ValueError):
+            return False
+        return bool(self._bits.get(channel, 0) >> bit & 1)
+
+    def __len__(self):
+        """Get the number of keys."""
+        return self._len
+
+    def __iter__(self):
+        """Iterate over the keys."""
+        segments = {bit: segment for segment, bit in self._template.segment_bits.items()}
+        for channel, bits in self._bits.items():
+            for bit, segment in segments.items():
+                if bits >> bit & 1:
+                    yield channel, segment
+
+    def __or__(self, other):
+        """Get the union of two key sets."""
+        res = SegmentKeySet(self._template, self)
+        res.update(other)
+        return res
+
+    def difference(self, other):
+        """Get the "channel_name:segment" names of the keys not in *other*."""
+        return {self._template.file_key_names.get(key, ':'.join(key)) for key in self if key not in other}
+
+    def __repr__(self):
+        """Represent the key set."""
+        return "SegmentKeySet(" + ", ".join(sorted(self._template.file_key_names.get(key, ':'.join(key))
+                                                   for key in self)) + ")"
 
 
 class Parser(metaclass=ABCMeta):
     """Abstract class for parsing messages."""
 
+    supports_segment_keys = False
+    # Whether the parsed metadata depends only on the uid
+    parses_uid = False
+
     @abstractmethod
     def globify(self, mda):
         """Globify the message."""
 
+    def globify_items(self, mda, items):
+        """Globify the metadata for each (channel_name, segment) item."""
+        mda = mda.copy()
+        result = set()
+        for channel_name, segment in items:
+            if channel_name == '' and segment == '':
+                # If the filename pattern has no segments/channels,
+                # add the "plain" globified filename to the filename
+                # set
+                if 'channel_name' not in self.fmt and 'segment' not in self.fmt:
+                    result.add(self.globify(mda))
+                continue
+            mda['channel_name'] = channel_name
+            mda['segment'] = segment
+            result.add(self.globify(mda))
+        return result
+
     @abstractmethod
     def parse(self, msg):
         """Parse the message."""
@@ -87,29 +310,86 @@ class Parser(metaclass=ABCMeta):
     def matches(self, msg):
         """Check if the message matches."""
 
+    def parse_if_matches(self, msg):
+        """Parse the message if it matches, else return None."""
+        if not self.matches(msg):
+            return None
+        return self.parse(msg.data)
+
 
 class UIDParser(Parser):
     """Wrapper around trollsifts parser."""
 
+    parses_uid = True
+
     def __init__(self, config, pattern_name):
         """Set up the UID parser."""
         self._ts_parser = trollsift.Parser(config['pattern'])
+        self._mask_template = MaskTemplate(config['pattern'])
+        self.prefix, self.suffix = _get_literal_affixes(config['pattern'])
         self.variable_tags = config.get('variable_tags', [])
         self._pattern_name = pattern_name
 
     def globify(self, mda):
         """Globify for the metadata."""
-        return self._ts_parser.globify(mda)
+        return self._mask_template.globify(mda)
+
+    def globify_items(self, mda, items):
+        """Globify the metadata for each (channel_name, segment) item.
+
+        The fields not depending on the items are formatted only once.
+        """
+        fill = self._mask_template.bind(mda)
+        if fill is None:
+            return super().globify_items(mda, items)
+        plain = 'channel_name' not in self.fmt and 'segment' not in self.fmt
+        return {fill(item) for item in items if plain or item != ('', '')}
+
+    @property
+    def supports_segment_keys(self):
+        """Check if the files can be identified by structured segment keys."""
+        return self._mask_template.compiled
+
+    def segment_keys(self, items):
+        """Get the structured keys of the (channel_name, segment) items."""
+        plain = 'channel_name' not in self.fmt and 'segment' not in self.fmt
+        return SegmentKeySet(self._mask_template,
+                             (self._mask_template.file_key(*item) for item in items if plain or item != ('', '')))
+
+    def segment_key(self, mda):
+        """Get the structured key of the file."""
+        return self._mask_template.file_key_from_metadata(mda)
+
+    def signature(self, mda):
+        """Get the signature identifying the slot of the file."""
+        return self._mask_template.signature(_copy_without_ignore_items(mda, ignored_keys=self.variable_tags))
+
+    def matches_signature(self, mda, signature):
+        """Check if the file belongs to the slot with the *signature*."""
+        if self.variable_tags:
+            mda = _copy_without_ignore_items(mda, ignored_keys=self.variable_tags)
+        return self._mask_template.matches_signature(mda, signature)
 
     def parse(self, metadata):
         """Parse the uid of the message."""
-        uid = metadata['uid']
-        return self._ts_parser.parse(uid)
+        return self._ts_parser.parse(metadata['uid'])
 
     def matches(self, msg):
         """Check that the message matches."""
+        return self.parse_if_matches(msg) is not None
+
+    def parse_if_matches(self, msg):
+        """Parse the uid of the message if it matches the pattern, else return None.
+
+        The uid is parsed only once for matching and parsing.
+        """
         uid = msg.data['uid']
-        return self._ts_parser.validate(uid)
+        if not uid.startswith(self.prefix) or not uid.endswith(self.suffix):
+            return None
+        try:
+            return self._ts_parser.parse(uid)
+        except ValueError:
+            return None
 
     @property
     def fmt(self):
@@ -128,6 +408,7 @@ class MessageParser(Parser):
         """Set up the message parser."""
         self._message_keys = config['message_keys']
         self._topic = config['topic']
+        self.topic = self._topic
         self.variable_tags = config.get('variable_tags', [])
         self._pattern_name = pattern_name
 
@@ -158,19 +439,129 @@ class MessageParser(Parser):
         return '_'.join(str(metadata[key]) for key in self._message_keys)
 
 
+def parse_metadata(parser, message_data):
+    """Parse the metadata of a message with fixed and utc aware times."""
+    return _ensure_mda_utc_aware(fix_start_end_time(parser.parse(message_data)))
+
+
+class ArrivalDelays:
+    """Rolling window of the arrival delays of the files, relative to the opening of their slots."""
+
+    def __init__(self, window=1000):
+        """Set up the window."""
+        self._delays = deque(maxlen=window)
+
+    def add(self, delay):
+        """Add a delay in seconds."""
+        self._delays.append(delay)
+
+    def __len__(self):
+        """Get the number of delays in the window."""
+        return len(self._delays)
+
+    def quantile(self, quantile):
+        """Get the given quantile of the delays."""
+        delays = sorted(self._delays)
+        return delays[min(int(quantile * len(delays)), len(delays) - 1)]
+
+
+class ProviderArrivals:
+    """First arrivals of the files from several providing servers, and the lag of each server.
+
+    The lag of a server is the time from the first arrival of a file to its
+    arrival from that server, zero for the files it provided first.
+    """
+
+    def __init__(self, hosts, window=1000):
+        """Set up the lag windows of the *hosts*."""
+        self._arrivals = OrderedDict()
+        self._lags = {host: ArrivalDelays(window) for host in hosts}
+        self._num_first = dict.fromkeys(hosts, 0)
+        self._num_duplicates = dict.fromkeys(hosts, 0)
+
+    def add(self, uid, host, now):
+        """Add the arrival of a file from a host.
+
+        Return None for the first arrival of the file, otherwise the host of
+        the copy in use.
+        """
+        arrival = self._arrivals.get(uid)
+        if arrival is None:
+            self._arrivals[uid] = [host, now]
+            self._lags[host].add(0.0)
+            self._num_first[host] += 1
+            return None
+        self._lags[host].add((now - arrival[1]).total_seconds())
+        self._num_duplicates[host] += 1
+        return arrival[0]
+
+    def set_host(self, uid, host):
+        """Set the host of the copy of the file in use."""
+        self._arrivals[uid][0] = host
+
+    def expire(self, before):
+        """Forget the files that first arrived before the given time."""
+        while self._arrivals and next(iter(self._arrivals.values()))[1] < before:
+            self._arrivals.popitem(last=False)
+
+    def is_faster(self, host, other):
+        """Check if the median lag of *host* is smaller than that of *other*."""
+        lags, other_lags = self._lags[host], self._lags[other]
+        return len(lags) > 0 and len(other_lags) > 0 and lags.quantile(0.5) < other_lags.quantile(0.5)
+
+    def __len__(self):
+        """Get the number of remembered files."""
+        return len(self._arrivals)
+
+    def statistics(self):
+        """Get the number of first arrivals and duplicates and the median lag of each host."""
+        return {host: {'first': self._num_first[host],
+                       'duplicates': self._num_duplicates[host],
+                       'median_lag': lags.quantile(0.5) if len(lags) else None}
+                for host, lags in self._lags.items()}
+
+
+class RepeatCycle:
+    """Calendar of the nominal slot times of a repeat cycle."""
+
+    def __init__(self, config, time_tolerance=0):
+        """Set up the calendar.
+
+        The *config* has the cycle length in ``minutes``, the ``offset`` of the
+        nominal times in minutes from the full cycles, and optionally the
+        number of seconds to ``precreate`` the slots before their nominal times.
+        """
+        self.cycle = int(config['minutes'] * 60)
+        self.offset = int(config.get('offset', 0) * 60)
+        self.precreate = config.get('precreate')
+        self._tolerance = int(time_tolerance)
+
+    def get_nominal_time(self, time_obj):
+        """Get the nominal time of the slot the time belongs to.
+
+        Times up to the time tolerance before a nominal time belong to that slot.
+        """
+        seconds = int(time_obj.timestamp()) - self.offset + self._tolerance
+        return dt.datetime.fromtimestamp(seconds - seconds % self.cycle + self.offset, dt.timezone.utc)
+
+
 class Message:
     """A message object."""
 
-    def __init__(self, posttroll_message, pattern, drop_scheme=False):
-        """Set up the message."""
+    def __init__(self, posttroll_message, pattern, drop_scheme=False, parsed_metadata=None):
+        """Set up the message.
+
+        The *parsed_metadata* of the uid can be given if already known.
+        """
         self.pattern = pattern
         self._drop_scheme = drop_scheme
-        posttroll_message = self._handle_scheme(posttroll_message)
-        self.message_data = fix_start_end_time(posttroll_message.data)
+        self.message_data = fix_start_end_time(self._handle_scheme(posttroll_message.data.copy()))
         self.type = posttroll_message.type
         self._posttroll_message = posttroll_message
-        mda_fixed = fix_start_end_time(pattern.parser.parse(self.message_data))
-        self.metadata = _ensure_mda_utc_aware(mda_fixed)
+        if parsed_metadata is None:
+            self.metadata = parse_metadata(pattern.parser, self.message_data)
+        else:
+            self.metadata = parsed_metadata.copy()
 
         self._time_name = self.pattern.time_name
         self.adjust_time_by_flooring()
@@ -192,15 +583,9 @@ class Message:
         if group_by_minutes is None:
             return
 
-        time_item = metadata[time_name]
-        seconds_this_year = (time_item - dt.datetime(time_item.year, 1, 1, tzinfo=time_item.tzinfo)).total_seconds()
-        group_by_seconds = dt.timedelta(minutes=group_by_minutes).total_seconds()
-        rounded_seconds = seconds_this_year - (seconds_this_year % group_by_seconds)
-        metadata[time_name] = dt.datetime(time_item.year, 1, 1, tzinfo=time_item.tzinfo) + \
-            dt.timedelta(seconds=rounded_seconds)
+        metadata[time_name] = _floor_time(metadata[time_name], group_by_minutes)
 
-    def _handle_scheme(self, posttroll_message):
-        message_data = posttroll_message.data.copy()
+    def _handle_scheme(self, message_data):
         if self._drop_scheme:
             url_parts = urlparse(message_data['uri'])
             uri = urlunparse(
@@ -214,18 +599,42 @@ class Message:
                 )
             )
             message_data['uri'] = uri
-            posttroll_message.data = message_data
-        return posttroll_message
+        return message_data
 
-    @property
+    @cached_property
     def filtered_metadata(self):
         """Merge the metadata."""
         meta = filter_metadata(self.metadata, self.message_data,
                                keep_parsed_keys=self.pattern._global_keep_parsed_keys,
                                local_keep_parsed_keys=self.pattern._local_keep_parsed_keys)
-        self._adjust_time_by_flooring(meta, self.pattern.group_by_minutes, self.pattern.time_name)
+        # The parsed time is floored already, only a time given in the message needs flooring
+        if meta.get(self._time_name) is not self.metadata.get(self._time_name):
+            self._adjust_time_by_flooring(meta, self.pattern.group_by_minutes, self.pattern.time_name)
         return meta
 
+    @cached_property
+    def mask(self):
+        """Get the file mask of the message, with the variable tags replaced by wildcards."""
+        ignored_keys = self.pattern.get('variable_tags', [])
+        return self.pattern.parser.globify(_copy_without_ignore_items(self.metadata, ignored_keys=ignored_keys))
+
+
+def _utcnow():
+    """Get the current time in UTC.
+
+    All the timeouts of the gatherer are computed from this clock, so that
+    the replay tool can run the gatherer in simulated time.
+    """
+    return dt.datetime.now(dt.timezone.utc)
+
+
+def _floor_time(time_item, group_by_minutes):
+    """Floor the time to the start of its *group_by_minutes* interval."""
+    seconds_this_year = (time_item - dt.datetime(time_item.year, 1, 1, tzinfo=time_item.tzinfo)).total_seconds()
+    group_by_seconds = dt.timedelta(minutes=group_by_minutes).total_seconds()
+    rounded_seconds = seconds_this_year - (seconds_this_year % group_by_seconds)
+    return dt.datetime(time_item.year, 1, 1, tzinfo=time_item.tzinfo) + dt.timedelta(seconds=rounded_seconds)
+
 
 class Slot:
     """A time slot class."""
@@ -238,6 +647,8 @@ class Slot:
         self._num_files_premature_publish = num_files_premature_publish
         self._pattern_keys = patterns.keys()
         self.output_metadata = _ensure_mda_utc_aware(metadata)
+        self._published_counts = {}
+        self._sequence_number = 0
         self['timeout'] = None
         # Critical files that are required, otherwise production will fail.
         # If there are no critical files, empty set([]) is used.
@@ -261,15 +672,34 @@ class Slot:
         """Set the item."""
         return self._info.__setitem__(key, value)
 
+    def __getstate__(self):
+        """Get the state of the slot for pickling."""
+        state = self.__dict__.copy()
+        state['_pattern_keys'] = list(self._pattern_keys)
+        return state
+
+    def relink_patterns(self, patterns):
+        """Share the expected files of the keyed patterns again after unpickling."""
+        for key in self._pattern_keys:
+            pattern = patterns[key]
+            if 'signature' not in self[key]:
+                continue
+            key_sets = pattern.segment_key_sets
+            for name in ('critical_files', 'wanted_files', 'all_files'):
+                self[key][name] = key_sets[name]
+            self[key]['received_files'].required = key_sets['required_files']
+            self[key]['received_files'].critical = key_sets['critical_files']
+
     def create_slot_pattern(self, pattern):
         """Create slot pattern."""
+        if pattern.segment_keys:
+            return self._create_keyed_slot_pattern(pattern)
         slot_pattern = dict()
         is_critical_set = pattern.get("is_critical_set", False)
         slot_pattern['is_critical_set'] = is_critical_set
         slot_pattern['critical_files'] = set([])
         slot_pattern['wanted_files'] = set([])
         slot_pattern['all_files'] = set([])
-        slot_pattern['received_files'] = set([])
         slot_pattern['delayed_files'] = dict()
         slot_pattern['missing_files'] = set([])
         slot_pattern['files_till_premature_publish'] = self._num_files_premature_publish
@@ -296,8 +726,25 @@ class Slot:
         all_segments = pattern.get("all_files", None)
         slot_pattern['all_files'].update(
             self.compose_filenames(pattern.parser, all_segments))
+        slot_pattern['received_files'] = ReceivedFiles(
+            required=slot_pattern['wanted_files'] | slot_pattern['critical_files'],
+            critical=slot_pattern['critical_files'])
         return slot_pattern
 
+    def _create_keyed_slot_pattern(self, pattern):
+        """Create slot pattern using the structured segment keys of the pattern."""
+        key_sets = pattern.segment_key_sets
+        return {'is_critical_set': pattern.get("is_critical_set", False),
+                'critical_files': key_sets['critical_files'],
+                'wanted_files': key_sets['wanted_files'],
+                'all_files': key_sets['all_files'],
+                'received_files': ReceivedFiles(required=key_sets['required_files'],
+                                                critical=key_sets['critical_files']),
+                'delayed_files': dict(),
+                'missing_files': set([]),
+                'files_till_premature_publish': self._num_files_premature_publish,
+                'signature': pattern.parser.signature(self.output_metadata)}
+
     def compose_filenames(self, parser, itm_str):
         """Compose filename set()s based on a pattern and item string.
 
@@ -307,40 +754,21 @@ class Slot:
         if itm_str in (None, ''):
             itm_str = ':'
 
-        # Get copy of metadata
-        meta = self.output_metadata.copy()
-
         # Replace variable tags (such as processing time) with
         # wildcards, as these can't be forecasted.
-        var_tags = parser.variable_tags
-        meta = _copy_without_ignore_items(meta,
-                                          ignored_keys=var_tags)
-
-        result = set()
-        for itm in itm_str.split(','):
-            channel_name, segments = itm.split(':')
-            if channel_name == '' and segments == '':
-                # If the filename pattern has no segments/channels,
-                # add the "plain" globified filename to the filename
-                # set
-                if ('channel_name' not in parser.fmt and
-                        'segment' not in parser.fmt):
-                    result.add(parser.globify(meta))
-                continue
-
-            segments = _create_segment_list(segments)
+        meta = _copy_without_ignore_items(self.output_metadata,
+                                          ignored_keys=parser.variable_tags)
 
-            meta['channel_name'] = channel_name
-            for seg in segments:
-                meta['segment'] = seg
-                fname = parser.globify(meta)
+        return parser.globify_items(meta, _parse_file_items(itm_str))
 
-                result.add(fname)
-        return result
+    @property
+    def opening_time(self):
+        """Get the time the slot was opened."""
+        return self['timeout'] - self._timeliness
 
     def update_timeout(self):
         """Update the timeout."""
-        timeout = dt.datetime.now(dt.timezone.utc) + self._timeliness
+        timeout = _utcnow() + self._timeliness
         self['timeout'] = timeout
         logger.info("Setting timeout to %s for slot %s.",
                     str(timeout), self.timestamp)
@@ -360,10 +788,9 @@ class Slot:
         slot_pattern = self[pattern.name]
         # If critical files have been received but the slot is
         # not complete, add the file to list of delayed files
-        timeout = self['timeout']
         if len(slot_pattern['critical_files']) > 0 and \
-           slot_pattern['critical_files'].issubset(slot_pattern['received_files']):
-            delay = dt.datetime.now(dt.timezone.utc) - (timeout - self._timeliness)
+           slot_pattern['received_files'].all_critical_received:
+            delay = _utcnow() - self.opening_time
             if delay.total_seconds() > 0:
                 slot_pattern['delayed_files'][uid] = delay.total_seconds()
 
@@ -411,6 +838,39 @@ class Slot:
         else:
             raise NotImplementedError('Cannot handle message of type: ' + str(message.type))
 
+    @property
+    def slot_id(self):
+        """Get an identifier of the slot, made of the pattern names and the slot time."""
+        slot_time = dt.datetime.fromisoformat(self.timestamp)
+        return "+".join(sorted(self._pattern_keys)) + slot_time.strftime("_%Y%m%d%H%M%S")
+
+    def get_increment(self, final):
+        """Get the output metadata with only the files added since the previous publication.
+
+        The slot and the order of the publications are identified by the
+        ``slot_id`` and ``sequence_number`` items, and the last publication
+        of the slot has ``final`` set.
+        """
+        metadata = self.output_metadata.copy()
+        if 'collection' in metadata:
+            metadata['collection'] = {key: dict(collection, dataset=self._get_new_datasets(key, collection['dataset']))
+                                      for key, collection in metadata['collection'].items()}
+        else:
+            metadata['dataset'] = self._get_new_datasets(None, metadata['dataset'])
+        metadata.update(slot_id=self.slot_id, sequence_number=self._sequence_number, incremental=True, final=final)
+        self._sequence_number += 1
+        return metadata
+
+    @property
+    def has_increments(self):
+        """Check if increments of the slot have been published."""
+        return self._sequence_number > 0
+
+    def _get_new_datasets(self, key, datasets):
+        num_published = self._published_counts.get(key, 0)
+        self._published_counts[key] = len(datasets)
+        return datasets[num_published:]
+
     def _update_metadata_times(self, metadata, message):
         """Update start/end time when message added to metadata."""
         if "start_time" in metadata and "start_time" in message.message_data:
@@ -421,12 +881,12 @@ class Slot:
     def is_relevant(self, message):
         """Check if the message is relevant to this slot."""
         slot_pattern = self[message.pattern.name]
+        if 'signature' in slot_pattern:
+            return self._is_relevant_by_key(message, slot_pattern)
         should_be_added = True
-        # Replace variable tags (such as processing time) with
-        # wildcards, as these can't be forecasted.
-        ignored_keys = message.pattern.get('variable_tags', [])
-        metadata = _copy_without_ignore_items(message.metadata, ignored_keys=ignored_keys)
-        mask = message.pattern.parser.globify(metadata)
+        # Variable tags (such as processing time) are replaced with
+        # wildcards in the mask, as these can't be forecasted.
+        mask = message.mask
         if mask in slot_pattern['received_files']:
             logger.debug("File already received")
             should_be_added = False
@@ -435,6 +895,19 @@ class Slot:
             should_be_added = False
         return mask, should_be_added
 
+    def _is_relevant_by_key(self, message, slot_pattern):
+        """Check if the message is relevant to this slot using structured segment keys."""
+        parser = message.pattern.parser
+        key = parser.segment_key(message.metadata)
+        if key in slot_pattern['received_files']:
+            logger.debug("File already received")
+            return key, False
+        if key not in slot_pattern['all_files'] or not parser.matches_signature(message.metadata,
+                                                                                   slot_pattern['signature']):
+            logger.debug("%s not in %s", message.uid(), slot_pattern['all_files'])
+            return key, False
+        return key, True
+
     def get_status(self):
         """Determine if slot is complete."""
         status = {}
@@ -445,23 +918,33 @@ class Slot:
             if not self[key]['is_critical_set']:
                 status[key] = Status.SLOT_NONCRITICAL_NOT_READY
 
-            wanted_and_critical_files = self[key][
-                'wanted_files'].union(self[key]['critical_files'])
-            num_wanted_and_critical = len(
-                wanted_and_critical_files & self[key]['received_files'])
+            received_files = self[key]['received_files']
+            num_wanted_and_critical = received_files.num_required
 
             num_files[key] = num_wanted_and_critical
 
-            if num_wanted_and_critical == self[key]['files_till_premature_publish']:
+            files_till_premature_publish = self[key]['files_till_premature_publish']
+            if files_till_premature_publish != -1 and num_wanted_and_critical >= files_till_premature_publish:
                 self[key]['files_till_premature_publish'] = -1
                 status[key] = Status.SLOT_READY_BUT_WAIT_FOR_MORE
 
-            if wanted_and_critical_files.issubset(self[key]['received_files']):
+            if received_files.all_required_received:
                 status[key] = Status.SLOT_READY
 
         # Determine overall status
         return self.get_collection_status(status, self['timeout'])
 
+    def num_datasets(self):
+        """Get the number of datasets in the slot."""
+        if 'collection' in self.output_metadata:
+            return sum(len(collection['dataset']) for collection in self.output_metadata['collection'].values())
+        return len(self.output_metadata['dataset'])
+
+    def all_critical_received(self):
+        """Check if the critical files of all the patterns have been received."""
+        return (any(len(self[key]['critical_files']) > 0 for key in self._pattern_keys) and
+                all(self[key]['received_files'].all_critical_received for key in self._pattern_keys))
+
     def get_collection_status(self, status, timeout):
         """Determine the overall status of the collection."""
         if len(status) == 0:
@@ -473,7 +956,7 @@ class Slot:
                         "for slot %s.", self.timestamp)
             return Status.SLOT_READY
 
-        if dt.datetime.now(dt.timezone.utc) > timeout:
+        if _utcnow() > timeout:
             if (Status.SLOT_NONCRITICAL_NOT_READY in status_values and
                 (Status.SLOT_READY in status_values or
                     Status.SLOT_READY_BUT_WAIT_FOR_MORE in status_values)):
@@ -502,6 +985,142 @@ class Slot:
             return Status.SLOT_READY_BUT_WAIT_FOR_MORE
 
 
+class ReceivedFiles(set):
+    """Set of received file masks counting the required and critical files.
+
+    The counts of the received required (wanted or critical) and critical
+    files are kept up to date as masks are added or removed, so the slot
+    completeness can be checked without set operations.
+    """
+
+    def __init__(self, iterable=(), required=(), critical=()):
+        """Set up the counters."""
+        super().__init__()
+        self.required = required if isinstance(required, SegmentKeySet) else frozenset(required)
+        self.critical = critical if isinstance(critical, SegmentKeySet) else frozenset(critical)
+        self.num_required = 0
+        self.num_critical = 0
+        self.update(iterable)
+
+    @property
+    def all_required_received(self):
+        """Check if all the wanted and critical files have been received."""
+        return self.num_required == len(self.required)
+
+    @property
+    def all_critical_received(self):
+        """Check if all the critical files have been received."""
+        return self.num_critical == len(self.critical)
+
+    def _count(self, item, step):
+        if item in self.required:
+            self.num_required += step
+        if item in self.critical:
+            self.num_critical += step
+
+    def add(self, item):
+        """Add a file mask."""
+        if item not in self:
+            super().add(item)
+            self._count(item, 1)
+
+    def update(self, *iterables):
+        """Add several file masks."""
+        for iterable in iterables:
+            for item in iterable:
+                self.add(item)
+
+    def __ior__(self, other):
+        """Add the file masks of *other*."""
+        self.update(other)
+        return self
+
+    def discard(self, item):
+        """Remove a file mask if present."""
+        if item in self:
+            super().discard(item)
+            self._count(item, -1)
+
+    def remove(self, item):
+        """Remove a file mask."""
+        if item not in self:
+            raise KeyError(item)
+        self.discard(item)
+
+    def pop(self):
+        """Remove and return an arbitrary file mask."""
+        item = super().pop()
+        self._count(item, -1)
+        return item
+
+    def clear(self):
+        """Remove all the file masks."""
+        super().clear()
+        self.num_required = 0
+        self.num_critical = 0
+
+    def difference_update(self, *iterables):
+        """Remove the file masks of all *iterables*."""
+        for iterable in iterables:
+            for item in iterable:
+                self.discard(item)
+
+    def __isub__(self, other):
+        """Remove the file masks of *other*."""
+        self.difference_update(other)
+        return self
+
+    def intersection_update(self, *iterables):
+        """Keep only the file masks found in all *iterables*."""
+        super().intersection_update(*iterables)
+        self._recount()
+
+    def __iand__(self, other):
+        """Keep only the file masks found in *other*."""
+        self.intersection_update(other)
+        return self
+
+    def symmetric_difference_update(self, other):
+        """Keep the file masks found in either, but not both, sets."""
+        super().symmetric_difference_update(other)
+        self._recount()
+
+    def __ixor__(self, other):
+        """Keep the file masks found in either, but not both, sets."""
+        self.symmetric_difference_update(other)
+        return self
+
+    def _recount(self):
+        self.num_required = sum(1 for item in self if item in self.required)
+        self.num_critical = sum(1 for item in self if item in self.critical)
+
+
+def _get_literal_affixes(fmt):
+    """Get the literal prefix and suffix of a trollsift format."""
+    parts = list(string.Formatter().parse(fmt))
+    if len(parts) == 1 and parts[0][1] is None:
+        return fmt, fmt
+    prefix = parts[0][0]
+    suffix = parts[-1][0] if parts[-1][1] is None else ''
+    return prefix, suffix
+
+
+@lru_cache(maxsize=None)
+def _parse_file_items(itm_str):
+    """Parse an item string into a tuple of (channel_name, segment) items.
+
+    An empty item (``':'``) is kept as ``('', '')``.
+    """
+    items = []
+    for itm in itm_str.split(','):
+        channel_name, segments = itm.split(':')
+        if channel_name == '' and segments == '':
+            items.append(('', ''))
+            continue
+        items.extend((channel_name, seg) for seg in _create_segment_list(segments))
+    return tuple(items)
+
+
 def _create_segment_list(segments):
     segments = segments.split('-')
     if len(segments) == 2:
@@ -520,6 +1139,118 @@ def _create_segment_list(segments):
     return segments
 
 
+class SlotIndex(OrderedDict):
+    """Ordered mapping of open slots with a sorted index of the slot times.
+
+    The mapping behaves like the :class:`~collections.OrderedDict` it
+    replaces, but additionally keeps the slot times (``time_name`` item of
+    the slot output metadata) in a sorted list so that the slot closest to
+    a given time can be found with a binary search instead of a scan over
+    all the open slots.  Values without output metadata are stored, but not
+    indexed.
+    """
+
+    def __init__(self, time_name='start_time'):
+        """Set up the index."""
+        super().__init__()
+        self._time_name = time_name
+        self._times = []
+        self._key_times = {}
+
+    def __setitem__(self, key, value):
+        """Set the slot and index its time."""
+        if key in self:
+            self._unindex(key)
+        super().__setitem__(key, value)
+        self._index(key, value)
+
+    def __delitem__(self, key):
+        """Delete the slot and remove it from the time index."""
+        super().__delitem__(key)
+        self._unindex(key)
+
+    def pop(self, key, *args):
+        """Remove the slot and return it."""
+        if key in self:
+            self._unindex(key)
+        return super().pop(key, *args)
+
+    def popitem(self, last=True):
+        """Remove and return a (key, slot) pair."""
+        key, value = super().popitem(last=last)
+        self._unindex(key)
+        return key, value
+
+    def clear(self):
+        """Remove all the slots."""
+        super().clear()
+        self._times = []
+        self._key_times = {}
+
+    def copy(self):
+        """Get a shallow copy of the slots."""
+        new = self.__class__(self._time_name)
+        for key, value in self.items():
+            new[key] = value
+        return new
+
+    def _index(self, key, value):
+        try:
+            slot_time = value.output_metadata[self._time_name]
+        except (AttributeError, KeyError):
+            return
+        self._key_times[key] = slot_time
+        bisect.insort(self._times, (slot_time, key))
+
+    def _unindex(self, key):
+        slot_time = self._key_times.pop(key, None)
+        if slot_time is None:
+            return
+        pos = bisect.bisect_left(self._times, (slot_time, key))
+        del self._times[pos]
+
+    def reindex(self, key):
+        """Update the index if the time of the slot *key* has changed."""
+        try:
+            slot_time = self[key].output_metadata[self._time_name]
+        except (AttributeError, KeyError):
+            return
+        if self._key_times.get(key) != slot_time:
+            self._unindex(key)
+            self._index(key, self[key])
+
+    def find_oldest(self):
+        """Find the key of the slot with the earliest time, or None if there are no slots."""
+        if self._times:
+            return self._times[0][1]
+        return next(iter(self), None)
+
+    def find_farthest(self, time_obj):
+        """Find the key of the slot with the time farthest from *time_obj*, or None if there are no slots."""
+        if not self._times:
+            return next(iter(self), None)
+        (first_time, first), (last_time, last) = self._times[0], self._times[-1]
+        if abs(time_obj - first_time) >= abs(last_time - time_obj):
+            return first
+        return last
+
+    def find_nearest(self, time_obj, tolerance):
+        """Find the key of the slot nearest to *time_obj*.
+
+        Only slots closer than *tolerance* seconds are considered.  If two
+        slots are equally close, the earlier one is returned.  Return None
+        if no slot is close enough.
+        """
+        pos = bisect.bisect_left(self._times, (time_obj,))
+        best = None
+        best_diff = tolerance
+        for slot_time, key in self._times[max(pos - 1, 0):pos + 1]:
+            diff = abs((time_obj - slot_time).total_seconds())
+            if diff < best_diff:
+                best, best_diff = key, diff
+        return best
+
+
 class Pattern:
     """A pattern to watch for."""
 
@@ -540,6 +1271,32 @@ class Pattern:
         self._local_keep_parsed_keys = pattern_config.get('keep_parsed_keys', [])
         self._group_by_minutes = self._config.get('group_by_minutes', defaults.get('group_by_minutes'))
         self.time_name = self._config.get('time_name', defaults.get('time_name', 'start_time'))
+        self.segment_keys = self._config.get('segment_keys', defaults.get('segment_keys', False))
+        if self.segment_keys and not self.parser.supports_segment_keys:
+            logger.warning("Segment keys are not supported for pattern %s, using file masks", name)
+            self.segment_keys = False
+
+    @cached_property
+    def segment_key_sets(self):
+        """Get the structured segment keys of the critical, wanted and all files, shared by all slots."""
+        critical_segments = self.get("critical_files", None)
+        plain_keys = self.parser.segment_keys(_parse_file_items(':'))
+        critical_files = SegmentKeySet(self.parser._mask_template)
+        wanted_files = SegmentKeySet(self.parser._mask_template)
+        all_files = SegmentKeySet(self.parser._mask_template)
+        if critical_segments:
+            critical_files.update(self.parser.segment_keys(_parse_file_items(critical_segments)))
+        else:
+            if self.get("is_critical_set", False):
+                critical_files.update(plain_keys)
+            wanted_files.update(plain_keys)
+            all_files.update(plain_keys)
+        wanted_files.update(self.parser.segment_keys(_parse_file_items(self.get("wanted_files", None) or ':')))
+        all_files.update(self.parser.segment_keys(_parse_file_items(self.get("all_files", None) or ':')))
+        return {'critical_files': critical_files,
+                'wanted_files': wanted_files,
+                'all_files': all_files,
+                'required_files': wanted_files | critical_files}
 
     @property
     def group_by_minutes(self):
@@ -582,6 +1339,8 @@ class Pattern:
             interval["end"] += 24 * 60
             interval["midnight"] = True
         self["_start_time_pattern"] = interval
+        self["_start_time_minutes"] = frozenset(minute for minute in range(24 * 60)
+                                                if _is_time_in_interval(interval, minute))
         logger.debug("Filter start:%s end:%s delta:%s",
                      start_time_str, end_time_str,
                      delta_time_str)
@@ -599,38 +1358,129 @@ class SegmentGatherer(object):
         self._pattern_configs = self._config.pop('patterns')
         self._subject = None
         self._timeliness = dt.timedelta(seconds=config.get("timeliness", 1200))
+        self._adaptive_timeliness = self._config.get("adaptive_timeliness")
 
         # This get the 'keep_parsed_keys' valid for all patterns
         self._keep_parsed_keys = self._config.get('keep_parsed_keys', [])
 
         self._patterns = self._create_patterns()
+        self._arrival_delays = {}
+        if self._adaptive_timeliness:
+            self._arrival_delays = {name: ArrivalDelays(self._adaptive_timeliness.get('window', 1000))
+                                    for name in self._patterns}
+        self._create_dispatch_index()
 
         self._elements = list(self._patterns.keys())
 
         self._time_tolerance = self._config.get("time_tolerance", 30)
+        self._repeat_cycle = None
+        if self._config.get("repeat_cycle"):
+            self._repeat_cycle = RepeatCycle(self._config["repeat_cycle"], self._time_tolerance)
+        self._slot_template = None
+        self._varying_slot_items = set()
+        self._precreated_slots = set()
+        self._last_precreated = dt.datetime.min.replace(tzinfo=dt.timezone.utc)
         self._bundle_datasets = self._config.get("bundle_datasets", False)
+        self._partial_subject = self._config.get('posttroll', {}).get('partial_publish_topic')
+        self._partial_published = set()
+        self._incremental_publish = self._config.get("incremental_publish", False)
 
         self._num_files_premature_publish = self._config.get("num_files_premature_publish", -1)
 
-        self.slots = OrderedDict()
-
         self.time_name = self._config.get('time_name', 'start_time')
+        self.slots = SlotIndex(self.time_name)
+        # Slots that need their status checked, and a min-heap of the slot timeouts
+        self._dirty_slots = {}
+        self._deadlines = []
+        self._deadline_counter = itertools.count()
+
         # Floor the scene start time to the given full minutes
         self._group_by_minutes = self._config.get('group_by_minutes', None)
 
         self._loop = False
         self._sigterm_caught = False
-        self._providing_server = self._config.get('providing_server')
+        providing_server = self._config.get('providing_server')
+        if isinstance(providing_server, str):
+            providing_server = [providing_server]
+        self._providing_servers = set(providing_server or ())
+        self._provider_arrivals = None
+        if len(self._providing_servers) > 1:
+            self._provider_arrivals = ProviderArrivals(self._providing_servers)
+        self._prefer_fastest_provider = self._config.get('prefer_fastest_provider', False)
+        self._batch_size = max(self._config.get('batch_size', 1), 1)
         self._is_first_message_after_start = True
+        self._existing_files_scan = None
+        self._existing_files = Queue()
+
+        self._snapshot_file = self._config.get('snapshot_file')
+        self._snapshot_interval = self._config.get('snapshot_interval', 60)
+        self._last_snapshot = time.monotonic()
+
+        # Received (pattern name, uid) pairs and the slots they were added to
+        self._received_uids = {}
+        self._slot_uids = {}
+        self._num_early_duplicates = 0
+
+        self._max_open_slots = self._config.get('max_open_slots')
+        self._max_files_per_slot = self._config.get('max_files_per_slot')
+        self._max_time_offset = self._config.get('max_time_offset')
+        self._eviction_policy = self._config.get('eviction_policy', 'oldest')
+        if self._eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {self._eviction_policy}, use one of {EVICTION_POLICIES}")
+        self._num_evicted_slots = 0
+        self._num_rejected_files = 0
+        self._num_rejected_times = 0
 
     def _create_patterns(self):
         return {key: Pattern(key, pattern_config, self._config)
                 for key, pattern_config in self._pattern_configs.items()}
 
+    def _create_dispatch_index(self):
+        """Index the patterns by the literal uid prefix and the topic."""
+        self._uid_prefixes = {}
+        self._topic_patterns = []
+        for pattern in self._patterns.values():
+            prefix = getattr(pattern.parser, 'prefix', None)
+            if prefix is not None:
+                prefixes = self._uid_prefixes.setdefault(len(prefix), {})
+                prefixes.setdefault(prefix, []).append(pattern.name)
+            else:
+                self._topic_patterns.append((pattern.parser.topic, pattern.name))
+
+    def _get_candidate_patterns(self, msg):
+        """Get the patterns that could match the message, in configuration order."""
+        uid = msg.data.get('uid')
+        if uid is None:
+            return self._patterns.values()
+        names = set()
+        for length, prefixes in self._uid_prefixes.items():
+            names.update(prefixes.get(uid[:length], ()))
+        for topic, name in self._topic_patterns:
+            if msg.subject.startswith(topic):
+                names.add(name)
+        return [pattern for name, pattern in self._patterns.items() if name in names]
+
     def _clear_slot(self, time_slot):
         """Clear data."""
         if time_slot in self.slots:
             del self.slots[time_slot]
+        self._dirty_slots.pop(time_slot, None)
+        self._precreated_slots.discard(time_slot)
+        self._partial_published.discard(time_slot)
+        for uid_key in self._slot_uids.pop(time_slot, ()):
+            self._received_uids.pop(uid_key, None)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Statistics: %s", self.statistics())
+
+    def statistics(self):
+        """Get statistics of the gatherer."""
+        return {'open_slots': len(self.slots),
+                'early_duplicates': self._num_early_duplicates,
+                'evicted_slots': self._num_evicted_slots,
+                'rejected_files': self._num_rejected_files,
+                'rejected_times': self._num_rejected_times,
+                'timeliness': self._get_slot_timeliness().total_seconds(),
+                'providers': self._provider_arrivals.statistics() if self._provider_arrivals else {}}
 
     def _reinitialize_gatherer(self, time_slot, missing_files_check=True):
         """Publish file dataset and reinitialize gatherer."""
@@ -655,28 +1505,45 @@ class SegmentGatherer(object):
             if len(missing_files) > 0:
                 logger.warning("Missing files: %s", ', '.join((str(missing) for missing in missing_files)))
 
-        # Remove tags that are not necessary for datasets
-        for tag in REMOVE_TAGS:
-            try:
-                del slot.output_metadata[tag]
-            except KeyError:
-                pass
+        self._remove_dataset_tags(slot)
+        if self._incremental_publish:
+            output_metadata = slot.get_increment(final=missing_files_check)
+        else:
+            output_metadata = slot.output_metadata.copy()
+
+        self._publish(self._bundle(output_metadata))
 
-        output_metadata = slot.output_metadata.copy()
+    def _publish_partial(self, time_slot):
+        """Publish the slot on the partial topic when all the critical files have been received."""
+        slot = self.slots[time_slot]
+        logger.info("Critical files received for slot %s, publishing partial collection.", time_slot)
+        self._remove_dataset_tags(slot)
+        output_metadata = self._bundle(slot.output_metadata.copy())
+        output_metadata['partial'] = True
+        self._publish(output_metadata, subject=self._partial_subject)
+        self._partial_published.add(time_slot)
+
+    @staticmethod
+    def _remove_dataset_tags(slot):
+        """Remove tags that are not necessary for datasets."""
+        for tag in REMOVE_TAGS:
+            slot.output_metadata.pop(tag, None)
 
+    def _bundle(self, output_metadata):
         if self._bundle_datasets and "dataset" not in output_metadata:
             output_metadata["dataset"] = []
             for collection in output_metadata["collection"].values():
                 output_metadata["dataset"].extend(collection['dataset'])
             del output_metadata["collection"]
+        return output_metadata
 
-        self._publish(output_metadata)
-
-    def _publish(self, metadata):
+    def _publish(self, metadata, subject=None):
+        if subject is None:
+            subject = self._subject
         if "dataset" in metadata:
-            msg = pmessage.Message(self._subject, "dataset", metadata)
+            msg = pmessage.Message(subject, "dataset", metadata)
         else:
-            msg = pmessage.Message(self._subject, "collection", metadata)
+            msg = pmessage.Message(subject, "collection", metadata)
         logger.info("Sending: %s", str(msg))
         self._publisher.send(str(msg))
 
@@ -722,44 +1589,228 @@ class SegmentGatherer(object):
         """Run SegmentGatherer."""
         self._setup_messaging()
         signal.signal(signal.SIGTERM, self._handle_sigterm)
-
-        self._loop = True
+        self._start()
         while self._keep_running():
-            self.triage_slots()
+            self._check_slots()
 
-            # Check listener for new messages
+            # Check listener for new messages, waking up for the next slot timeout
             try:
-                msg = self._listener.output_queue.get(True, 1)
-            except AttributeError:
-                msg = self._listener.queue.get(True, 1)
+                messages = self._get_messages(self._get_queue_timeout())
             except KeyboardInterrupt:
                 break
-            except Empty:
-                continue
+            self._process_messages(messages)
+        self._finish()
+        self.stop()
+
+    def _start(self):
+        if self._snapshot_file:
+            self.restore_snapshot()
+        self._loop = True
 
+    def _check_slots(self):
+        self.precreate_slots()
+        self.process_existing_files()
+        self.triage_slots()
+        self._write_snapshot_if_due()
+
+    def _process_messages(self, messages):
+        for msg in messages:
             if msg.type in ["file", "dataset"]:
-                # If providing server is configured skip message if not from providing server
-                if self._providing_server and self._providing_server != msg.host:
+                # If providing servers are configured skip message if not from one of them
+                if self._providing_servers and msg.host not in self._providing_servers:
+                    continue
+                if self._provider_arrivals is not None and not self._is_first_arrival(msg):
                     continue
                 logger.info("New message received: %s", str(msg))
                 self.process(msg)
-        self.stop()
+
+    def _is_first_arrival(self, msg):
+        """Check if the file of the message arrives first from the providing servers.
+
+        Later copies from the other servers are dropped.  With
+        ``prefer_fastest_provider``, the uri of a copy from a server that is
+        usually faster replaces the one in the open slot.
+        """
+        uid = msg.data.get('uid')
+        if msg.type != 'file' or uid is None:
+            return True
+        now = _utcnow()
+        self._provider_arrivals.expire(now - self._timeliness)
+        host = self._provider_arrivals.add(uid, msg.host, now)
+        if host is None:
+            return True
+        logger.debug("File %s from %s already received from %s", uid, msg.host, host)
+        if self._prefer_fastest_provider and self._provider_arrivals.is_faster(msg.host, host):
+            if self._use_copy(msg):
+                self._provider_arrivals.set_host(uid, msg.host)
+        return False
+
+    def _use_copy(self, msg):
+        """Replace the location of the file in its open slot with the one of the message.
+
+        Return True if the file was found.
+        """
+        slot_time = self._find_received_slot(msg)
+        if slot_time is None:
+            return False
+        metadata = self.slots[slot_time].output_metadata
+        if 'collection' in metadata:
+            datasets = itertools.chain.from_iterable(collection['dataset']
+                                                     for collection in metadata['collection'].values())
+        else:
+            datasets = metadata['dataset']
+        for dataset in datasets:
+            if dataset.get('uid') == msg.data['uid']:
+                for key in ('uri', 'path', 'filesystem'):
+                    dataset.pop(key, None)
+                    if key in msg.data:
+                        dataset[key] = msg.data[key]
+                logger.debug("Using %s from %s", msg.data['uid'], msg.host)
+                return True
+        return False
+
+    def _finish(self):
+        if self._snapshot_file:
+            self.write_snapshot()
+
+    def _get_messages(self, queue_timeout):
+        """Get the next message from the listener, and the messages queued after it up to the batch size.
+
+        The slots are triaged only after all the returned messages have been
+        processed.
+        """
+        return _get_queued_messages(_get_listener_queue(self._listener), queue_timeout, self._batch_size)
+
+    def is_subscribed(self, subject):
+        """Check if the gatherer listens to messages with the given subject."""
+        topics = self._config['posttroll'].get('topics')
+        if not topics:
+            return True
+        return any(subject.startswith(_get_subject_prefix(topic)) for topic in topics)
 
     def _handle_sigterm(self, signum, frame):
-        logging.info("Caught SIGTERM, shutting down when all collections are finished.")
+        if self._snapshot_file:
+            logging.info("Caught SIGTERM, saving the open collections and shutting down.")
+        else:
+            logging.info("Caught SIGTERM, shutting down when all collections are finished.")
         self._sigterm_caught = True
 
     def _keep_running(self):
-        if not self._loop or (self._sigterm_caught and not self.slots):
+        if not self._loop or (self._sigterm_caught and (self._snapshot_file or not self.slots)):
             return False
         return True
 
+    def _write_snapshot_if_due(self):
+        if self._snapshot_file and time.monotonic() - self._last_snapshot >= self._snapshot_interval:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Write the open slots to the snapshot file."""
+        self._last_snapshot = time.monotonic()
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'patterns': sorted(self._patterns),
+                    'slots': [(slot_time, slot) for slot_time, slot in self.slots.items()
+                              if slot_time not in self._precreated_slots],
+                    'slot_uids': self._slot_uids,
+                    'partial_published': sorted(self._partial_published)}
+        tmp_file = self._snapshot_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as fid:
+                pickle.dump(snapshot, fid, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self._snapshot_file)
+        except (OSError, pickle.PicklingError) as err:
+            logger.warning("Could not write the snapshot to %s: %s", self._snapshot_file, str(err))
+            return
+        logger.debug("Wrote %d slots to %s", len(self.slots), self._snapshot_file)
+
+    def restore_snapshot(self):
+        """Restore the open slots from the snapshot file."""
+        try:
+            with open(self._snapshot_file, 'rb') as fid:
+                snapshot = pickle.load(fid)
+        except FileNotFoundError:
+            return
+        except Exception as err:
+            logger.warning("Could not read the snapshot %s: %s", self._snapshot_file, str(err))
+            return
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('patterns') != sorted(self._patterns):
+            logger.warning("Snapshot %s does not match the configuration, ignoring it", self._snapshot_file)
+            return
+        for slot_time, slot in snapshot['slots']:
+            slot.relink_patterns(self._patterns)
+            self.slots[slot_time] = slot
+            self._schedule_timeout(slot_time)
+            self._mark_dirty(slot_time)
+        for slot_time, uid_keys in snapshot['slot_uids'].items():
+            if slot_time not in self.slots:
+                continue
+            self._slot_uids[slot_time] = list(uid_keys)
+            for uid_key in uid_keys:
+                self._received_uids[uid_key] = slot_time
+        self._partial_published.update(slot_time for slot_time in snapshot.get('partial_published', ())
+                                       if slot_time in self.slots)
+        logger.info("Restored %d slots from %s", len(snapshot['slots']), self._snapshot_file)
+
+    def get_next_timeout(self):
+        """Get the earliest timeout of the open slots, or None if no slot is open."""
+        while self._deadlines and not self._is_current_deadline(*self._deadlines[0]):
+            heapq.heappop(self._deadlines)
+        if not self._deadlines:
+            return None
+        return self._deadlines[0][0]
+
+    def _get_queue_timeout(self, max_wait=1.0):
+        """Get the time to wait for new messages before the next slot times out."""
+        timeout = self.get_next_timeout()
+        if timeout is None:
+            return max_wait
+        wait = (timeout - _utcnow()).total_seconds()
+        return min(max(wait, 0), max_wait)
+
+    def _is_current_deadline(self, timeout, _, slot_time):
+        """Check that a deadline from the heap still belongs to an open slot."""
+        slot = self.slots.get(slot_time)
+        return slot is not None and slot['timeout'] == timeout
+
+    def _schedule_timeout(self, slot_time):
+        """Add the timeout of the slot to the deadline heap."""
+        heapq.heappush(self._deadlines,
+                       (self.slots[slot_time]['timeout'], next(self._deadline_counter), slot_time))
+
+    def _mark_dirty(self, slot_time):
+        """Mark the slot for status check at the next triage."""
+        self._dirty_slots[slot_time] = None
+
+    def _pop_slots_to_triage(self):
+        """Get the slots that have changed or timed out since the last triage."""
+        slot_times = self._dirty_slots
+        self._dirty_slots = {}
+        now = _utcnow()
+        while self._deadlines and self._deadlines[0][0] < now:
+            deadline = heapq.heappop(self._deadlines)
+            if self._is_current_deadline(*deadline):
+                slot_times[deadline[2]] = None
+        return list(slot_times)
+
     def triage_slots(self):
-        """Check if there are slots ready for publication."""
-        slots = self.slots.copy()
-        for slot_time, slot in slots.items():
-            slot_time = str(slot_time)
+        """Check if there are slots ready for publication.
+
+        Only the slots that have received files or timed out since the
+        previous triage are checked.
+        """
+        for slot_time in self._pop_slots_to_triage():
+            slot = self.slots.get(slot_time)
+            if slot is None:
+                continue
+            if slot_time in self._precreated_slots:
+                if slot['timeout'] < _utcnow():
+                    # No files arrived for the precreated slot
+                    self._clear_slot(slot_time)
+                continue
             status = slot.get_status()
+            if (self._partial_subject and status not in (Status.SLOT_READY, Status.SLOT_OBSOLETE_TIMEOUT) and
+                    slot_time not in self._partial_published and slot.all_critical_received()):
+                self._publish_partial(slot_time)
             if status == Status.SLOT_READY:
                 # Collection ready, publish and remove
                 self._reinitialize_gatherer(slot_time)
@@ -769,6 +1820,9 @@ class SegmentGatherer(object):
                 self._reinitialize_gatherer(slot_time, missing_files_check=False)
             elif status == Status.SLOT_OBSOLETE_TIMEOUT:
                 # Collection unfinished and obsolete, discard
+                if self._incremental_publish and slot.has_increments:
+                    # Terminate the increments published prematurely
+                    self._reinitialize_gatherer(slot_time)
                 self._clear_slot(slot_time)
             else:
                 # Collection unfinished, wait for more data
@@ -786,6 +1840,14 @@ class SegmentGatherer(object):
 
     def process(self, msg):
         """Process message."""
+        if self._is_received(msg):
+            self._num_early_duplicates += 1
+            logger.debug("File already received")
+            return
+
+        if self._is_time_too_far(msg.data.get(self.time_name)):
+            return
+
         # Find the correct parser for this file
         try:
             message = self.message_from_posttroll(msg)
@@ -794,11 +1856,12 @@ class SegmentGatherer(object):
             logger.debug("No parser matching message, skipping.")
             return
 
+        if self._is_time_too_far(message.id_time):
+            return
+
         # Check if time of the raw is in scheduled range
-        if "_start_time_pattern" in pattern:
-            schedule_ok = self.check_if_time_is_in_interval(
-                pattern["_start_time_pattern"],
-                message.id_time)
+        if "_start_time_minutes" in pattern:
+            schedule_ok = 60 * message.id_time.hour + message.id_time.minute in pattern["_start_time_minutes"]
             if not schedule_ok:
                 logger.debug("Hour pattern '%s' skip: %s" +
                              " for start_time: %s",
@@ -806,80 +1869,249 @@ class SegmentGatherer(object):
                              message.id_time.strftime("%H:%M"))
                 return
 
-        slot_time = self._find_time_slot(ensure_utc_aware(message.id_time))
+        slot_time = self._find_message_slot(message)
 
         # Init metadata etc if this is the first file
         if slot_time not in self.slots:
-            slot = self._create_slot(message)
+            self._make_room_for_slot()
+            slot = self._create_slot(message, slot_time)
         else:
             slot = self.slots[slot_time]
+            if self._max_files_per_slot is not None and slot.num_datasets() >= self._max_files_per_slot:
+                self._num_rejected_files += 1
+                logger.warning("Slot %s is full, skipping %s", slot_time, message.uid())
+                return
+            if slot_time in self._precreated_slots:
+                self._open_precreated_slot(slot_time)
 
-        slot.add_file(message)
+        self._add_file(slot, message)
         self.check_and_add_existing_files(slot, message)
+        self.slots.reindex(slot.timestamp)
+        self._mark_dirty(slot.timestamp)
+
+    def _is_time_too_far(self, time_obj):
+        """Check if the time of a file is too far from the current time, and count the rejection."""
+        if self._max_time_offset is None or not isinstance(time_obj, dt.datetime):
+            return False
+        offset = abs(_utcnow() - ensure_utc_aware(time_obj))
+        if offset.total_seconds() <= self._max_time_offset:
+            return False
+        self._num_rejected_times += 1
+        logger.debug("Time %s too far from the current time, skipping", str(time_obj))
+        return True
+
+    def _make_room_for_slot(self):
+        """Evict slots until there is room for a new slot."""
+        if self._max_open_slots is None:
+            return
+        while self.slots and len(self.slots) >= self._max_open_slots:
+            if self._eviction_policy == 'farthest':
+                slot_time = self.slots.find_farthest(_utcnow())
+            else:
+                slot_time = self.slots.find_oldest()
+            logger.warning("Too many open slots, discarding slot %s", slot_time)
+            self._clear_slot(slot_time)
+            self._num_evicted_slots += 1
+
+    def _add_file(self, slot, message, record_delay=True):
+        """Add the file to the slot and remember its uid for early duplicate checks.
+
+        The arrival delay of the file is recorded for the adaptive timeliness
+        if *record_delay* is set.
+        """
+        received_files = slot[message.pattern.name]['received_files']
+        num_received = len(received_files)
+        slot.add_file(message)
+        if len(received_files) == num_received:
+            return
+        if record_delay and self._arrival_delays:
+            delay = _utcnow() - slot.opening_time
+            self._arrival_delays[message.pattern.name].add(delay.total_seconds())
+        if message.type == 'file':
+            uid_key = (message.pattern.name, message.uid())
+            self._received_uids[uid_key] = slot.timestamp
+            self._slot_uids.setdefault(slot.timestamp, []).append(uid_key)
+
+    def _get_slot_timeliness(self):
+        """Get the timeliness of a new slot.
+
+        With adaptive timeliness, the configured quantile of the arrival
+        delays plus the margin is used, limited by the configured timeliness.
+        """
+        if not self._arrival_delays:
+            return self._timeliness
+        adaptive = self._adaptive_timeliness
+        if any(len(delays) < adaptive.get('min_samples', 100) for delays in self._arrival_delays.values()):
+            return self._timeliness
+        quantile = adaptive.get('quantile', 0.95)
+        delay = max(delays.quantile(quantile) for delays in self._arrival_delays.values())
+        return min(self._timeliness, dt.timedelta(seconds=delay + adaptive.get('margin', 60)))
+
+    def _is_received(self, msg):
+        """Check if the file of the message has already been added to an open slot."""
+        return self._find_received_slot(msg) is not None
+
+    def _find_received_slot(self, msg):
+        """Find the open slot the file of the message has been added to, or None."""
+        if not self._received_uids or msg.type != 'file':
+            return None
+        for pattern in self._get_candidate_patterns(msg):
+            try:
+                slot_time = self._received_uids.get((pattern.name, pattern.parser.uid(msg.data)))
+            except KeyError:
+                continue
+            if slot_time is not None:
+                return slot_time
+        return None
 
     def message_from_posttroll(self, msg):
         """Create a message object from a posttroll message instance."""
-        for pattern in self._patterns.values():
+        drop_scheme = self._config.get('all_files_are_local', False)
+        for pattern in self._get_candidate_patterns(msg):
             try:
-                if pattern.parser.matches(msg):
-                    drop_scheme = self._config.get('all_files_are_local', False)
-                    return Message(msg, pattern, drop_scheme=drop_scheme)
+                parsed = pattern.parser.parse_if_matches(msg)
+                if parsed is None:
+                    continue
+                parsed_metadata = None
+                if pattern.parser.parses_uid:
+                    parsed_metadata = _ensure_mda_utc_aware(fix_start_end_time(parsed))
+                return Message(msg, pattern, drop_scheme=drop_scheme, parsed_metadata=parsed_metadata)
             except KeyError as err:
                 logger.debug("No key %s in message.", str(err))
         raise TypeError
 
+    def _find_message_slot(self, message):
+        """Find the time slot of a message."""
+        return self._find_time_slot(ensure_utc_aware(message.id_time))
+
     def _find_time_slot(self, time_obj):
         """Find time slot and return the slot as a string.
 
-        If no slots are close enough, return *str(time_obj)*
+        The nearest slot within the time tolerance is used.  If no slots are
+        close enough, return *str(time_obj)*.  With a repeat cycle, the
+        nominal time of the slot is returned.
         """
-        for slot in self.slots:
-            time_slot = self.slots[slot].output_metadata[self.time_name]
-            time_diff = time_obj - time_slot
-            if abs(time_diff.total_seconds()) < self._time_tolerance:
-                logger.debug("Found existing time slot at %s, using that",
-                             str(time_slot))
-                return slot
+        if self._repeat_cycle is not None:
+            return str(self._repeat_cycle.get_nominal_time(time_obj))
+        slot = self.slots.find_nearest(time_obj, self._time_tolerance)
+        if slot is not None:
+            logger.debug("Found existing time slot at %s, using that",
+                         str(self.slots[slot].output_metadata[self.time_name]))
+            return slot
 
         return str(time_obj)
 
-    def _create_slot(self, message):
+    def _create_slot(self, message, timestamp=None):
         """Init wanted, all and critical files."""
-        timestamp = message.id_time
+        if timestamp is None:
+            timestamp = message.id_time
         logger.debug(f"Adding new slot: {timestamp}")
 
-        slot = Slot(timestamp, message.filtered_metadata, self._patterns, self._timeliness,
+        slot = Slot(timestamp, message.filtered_metadata, self._patterns, self._get_slot_timeliness(),
                     self._num_files_premature_publish)
         self.slots[str(timestamp)] = slot
+        self._schedule_timeout(str(timestamp))
+        if self._repeat_cycle is not None:
+            self._update_slot_template(dt.datetime.fromisoformat(slot.timestamp), message.filtered_metadata)
         return slot
 
+    def _update_slot_template(self, slot_time, metadata):
+        """Keep the metadata common to all the slots created from messages as template of the precreated slots.
+
+        The times are taken from the latest slot.  The other items that
+        differ between the slots are dropped, and remembered unless they are
+        variable tags, which are not used for the expected files.
+        """
+        if self._slot_template is not None:
+            template_metadata = self._slot_template[1]
+            varying = {key for key, val in metadata.items()
+                       if not isinstance(val, dt.datetime) and
+                       (key not in template_metadata or template_metadata[key] != val)}
+            varying.update(key for key in template_metadata if key not in metadata)
+            metadata = {key: val for key, val in metadata.items() if key not in varying}
+            variable_tags = {tag for pattern in self._patterns.values() for tag in pattern.get('variable_tags', [])}
+            if varying - variable_tags - self._varying_slot_items:
+                logger.info("The slots differ in %s, not precreating the slots",
+                            ", ".join(sorted(varying - variable_tags)))
+                self._varying_slot_items.update(varying - variable_tags)
+        self._slot_template = (slot_time, metadata)
+
+    def precreate_slots(self, now=None):
+        """Create the slot of the next nominal time of the repeat cycle ahead of the first file.
+
+        The metadata of the slot are the ones common to all the slots created
+        from messages, with the times of the latest slot shifted to the new
+        nominal time.  No slots are precreated if the slots differ in other
+        items than times and variable tags, eg. in a multi-platform setup.
+        """
+        if (self._repeat_cycle is None or self._repeat_cycle.precreate is None or self._slot_template is None or
+                self._varying_slot_items):
+            return
+        if now is None:
+            now = _utcnow()
+        nominal_time = self._repeat_cycle.get_nominal_time(now + dt.timedelta(seconds=self._repeat_cycle.precreate))
+        template_time, template_metadata = self._slot_template
+        if nominal_time <= max(template_time, self._last_precreated) or str(nominal_time) in self.slots:
+            return
+        shift = nominal_time - template_time
+        metadata = {key: val + shift if isinstance(val, dt.datetime) else val
+                    for key, val in template_metadata.items()}
+        logger.debug("Creating slot %s ahead of its nominal time", nominal_time)
+        self._make_room_for_slot()
+        slot = Slot(nominal_time, metadata, self._patterns, self._get_slot_timeliness(),
+                    self._num_files_premature_publish)
+        self.slots[str(nominal_time)] = slot
+        self._schedule_timeout(str(nominal_time))
+        self._precreated_slots.add(str(nominal_time))
+        self._last_precreated = nominal_time
+
+    def _open_precreated_slot(self, slot_time):
+        """Start the timeout of a precreated slot at the arrival of its first file."""
+        self._precreated_slots.discard(slot_time)
+        slot = self.slots[slot_time]
+        slot.update_timeout()
+        self._schedule_timeout(slot_time)
+
     def check_if_time_is_in_interval(self, time_range, raw_start_time):
         """Check if raw time is inside configured interval."""
-        time_ok = False
+        return _is_time_in_interval(time_range, (60 * raw_start_time.hour) + raw_start_time.minute)
 
-        # Convert check time into int variables
-        raw_time = (60 * raw_start_time.hour) + raw_start_time.minute
-        if time_range["midnight"] and raw_time < time_range["start"]:
-            raw_time += 24 * 60
+    def check_and_add_existing_files(self, slot, message):
+        """Check for existing files in the uri basedir and add them to the slot.
 
-        # Check start and end time
-        if time_range["start"] <= raw_time <= time_range["end"]:
-            # Raw time in range, check interval
-            if ((raw_time - time_range["start"]) % time_range["delta"]) == 0:
-                time_ok = True
+        The files are listed in a background thread, and added to the slot in
+        batches by :meth:`process_existing_files`.
+        """
+        if self._should_check_for_existing_files(message):
+            self._existing_files_scan = threading.Thread(target=self._scan_existing_files,
+                                                         args=(slot.timestamp, message),
+                                                         daemon=True)
+            self._existing_files_scan.start()
 
-        return time_ok
+    def _scan_existing_files(self, slot_time, message):
+        """List the existing files and queue them in batches."""
+        try:
+            fnames = _get_existing_files_from_message(message, self._time_tolerance)
+        except Exception as err:
+            logger.warning("Could not check the existing files: %s", str(err))
+            return
+        logger.debug("Checking %d pre-existing files after restart.", len(fnames))
+        for i in range(0, len(fnames), EXISTING_FILES_BATCH_SIZE):
+            self._existing_files.put((slot_time, message, fnames[i:i + EXISTING_FILES_BATCH_SIZE]))
 
-    def check_and_add_existing_files(self, slot, message):
-        """Check for existing files in the uri basedir and add them to the slot."""
-        if self._should_check_for_existing_files(message):
-            # Disable debug logging temporarily
-            logging.disable(logging.DEBUG)
-            fnames = _get_existing_files_from_message(message)
-            logger.debug("Checking %d pre-existing files after restart.", len(fnames))
+    def process_existing_files(self):
+        """Add the queued batches of existing files to their slot."""
+        while True:
+            try:
+                slot_time, message, fnames = self._existing_files.get_nowait()
+            except Empty:
+                return
+            slot = self.slots.get(slot_time)
+            if slot is None:
+                continue
             self._add_existing_files_to_slot(slot, fnames, message)
-            # Restore the original logging level
-            logging.disable(logging.NOTSET)
+            self.slots.reindex(slot_time)
+            self._mark_dirty(slot_time)
 
     def _should_check_for_existing_files(self, message):
         if not self._config.get("check_existing_files_after_start", False):
@@ -899,17 +2131,55 @@ class SegmentGatherer(object):
                 "uri": fname,
                 "sensor": message._posttroll_message.data["sensor"]
                 }
-            msg = self.message_from_posttroll(pmessage.Message(message._posttroll_message.subject, "file", meta))
-            slot.add_file(msg)
+            try:
+                msg = self.message_from_posttroll(pmessage.Message(message._posttroll_message.subject, "file", meta))
+            except TypeError:
+                continue
+            if self._find_time_slot(ensure_utc_aware(msg.id_time)) != slot.timestamp:
+                continue
+            self._add_file(slot, msg, record_delay=False)
 
 
-def _get_existing_files_from_message(message):
-    mask = message.pattern.parser.globify({})
+def _get_existing_files_from_message(message, time_tolerance=0):
+    mask = message.pattern.parser.globify(_get_slot_mask_metadata(message, time_tolerance))
     url_parts = urlparse(message.message_data["uri"])
     storage_options = message.message_data.get("filesystem")
     return _fsspec_glob(url_parts, mask, storage_options)
 
 
+def _get_slot_mask_metadata(message, time_tolerance):
+    """Get the metadata shared by all the files that can belong to the slot of the message.
+
+    The file items, the variable tags and the times other than the partial
+    slot time are left out, as they can differ between the files of the slot.
+    """
+    ignored_keys = list(FILE_ITEM_KEYS) + list(message.pattern.get('variable_tags', []))
+    mda = {key: val for key, val in _copy_without_ignore_items(message.metadata, ignored_keys=ignored_keys).items()
+           if not isinstance(val, dt.datetime)}
+    mda.update(_get_time_prefix_metadata(message, time_tolerance))
+    return mda
+
+
+def _get_time_prefix_metadata(message, time_tolerance):
+    """Get the partial slot time shared by all the files that can belong to the slot of the message.
+
+    The result can be used with trollsift to limit the file listing to the
+    slot time.
+    """
+    slot_time = message.id_time
+    first = slot_time - dt.timedelta(seconds=time_tolerance)
+    last = slot_time + dt.timedelta(seconds=time_tolerance, minutes=message.pattern.group_by_minutes or 0)
+    shared = ''
+    for letter in 'YmdHM':
+        fmt = ''.join('%' + char for char in shared + letter)
+        if first.strftime(fmt) != last.strftime(fmt):
+            break
+        shared += letter
+    if not shared:
+        return {}
+    return {message.pattern.time_name: (slot_time, shared)}
+
+
 def _fsspec_glob(url_parts, mask, storage_options):
     import fsspec
 
@@ -925,7 +2195,12 @@ def _fsspec_glob(url_parts, mask, storage_options):
     )
     storage_options = storage_options or dict()
     fs_ = fsspec.filesystem(url_parts.scheme, **storage_options)
-    files = fs_.glob(pattern)
+    prefix = _get_listing_prefix(pattern)
+    if prefix and "prefix" in inspect.signature(fs_.find).parameters:
+        # Let the storage list only the files starting with the literal part of the mask
+        files = fs_.glob(pattern, prefix=prefix)
+    else:
+        files = fs_.glob(pattern)
     # There might be no scheme in the returned filenames, so add it if scheme is defined
     if url_parts.scheme:
         files = [url_parts.scheme + '://' + f for f in files if not f.startswith(
@@ -933,6 +2208,442 @@ def _fsspec_glob(url_parts, mask, storage_options):
     return files
 
 
+def _get_listing_prefix(pattern):
+    """Get the literal start of the first file name component of a glob pattern having wildcards."""
+    first_wildcard = min((pattern.find(char) for char in "*?[" if char in pattern), default=-1)
+    if first_wildcard < 0:
+        return ''
+    return pattern[:first_wildcard].rsplit('/', 1)[-1]
+
+
+class MultiSegmentGatherer:
+    """Run several segment gatherers in a single process.
+
+    The gatherers share a single listener, and each received message is
+    handed only to the gatherers listening to its topic.  Each gatherer
+    keeps its own publisher and service name.
+    """
+
+    def __init__(self, configs):
+        """Initialize the gatherers."""
+        _check_multi_configs(configs)
+        self.gatherers = [SegmentGatherer(config) for config in configs]
+        self._listener = None
+        self._batch_size = max(gatherer._batch_size for gatherer in self.gatherers)
+        self._loop = False
+
+    def _setup_messaging(self):
+        """Set up the shared listener and a publisher for each gatherer."""
+        self._setup_listener()
+        for gatherer in self.gatherers:
+            gatherer._subject = gatherer._config['posttroll']['publish_topic']
+            gatherer._setup_publisher()
+
+    def _setup_listener(self):
+        posttroll_configs = [gatherer._config['posttroll'] for gatherer in self.gatherers]
+        nameservers = [_get_listener_nameserver(posttroll_config) for posttroll_config in posttroll_configs]
+        if any(nameserver != nameservers[0] for nameserver in nameservers[1:]):
+            raise ValueError("The gatherers run in one process share a listener and need the same "
+                             f"nameservers, got {nameservers}")
+        nameserver = nameservers[0]
+        self._listener = ListenerContainer(
+            topics=_merge_posttroll_option(posttroll_configs, 'topics'),
+            addresses=_merge_posttroll_option(posttroll_configs, 'addresses'),
+            nameserver=nameserver,
+            services=_merge_posttroll_option(posttroll_configs, 'services') or ""
+        )
+
+    def run(self):
+        """Run the gatherers."""
+        self._setup_messaging()
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        for gatherer in self.gatherers:
+            gatherer._start()
+        self._loop = True
+        while self._keep_running():
+            for gatherer in self.gatherers:
+                gatherer._check_slots()
+
+            queue_timeout = min(gatherer._get_queue_timeout() for gatherer in self.gatherers)
+            try:
+                messages = _get_queued_messages(_get_listener_queue(self._listener), queue_timeout,
+                                                self._batch_size)
+            except KeyboardInterrupt:
+                break
+            self._route_messages(messages)
+        for gatherer in self.gatherers:
+            gatherer._finish()
+        self.stop()
+
+    def _route_messages(self, messages):
+        """Hand the messages to the gatherers listening to their topics."""
+        for gatherer in self.gatherers:
+            gatherer._process_messages([msg for msg in messages if gatherer.is_subscribed(msg.subject)])
+
+    def _handle_sigterm(self, signum, frame):
+        for gatherer in self.gatherers:
+            gatherer._handle_sigterm(signum, frame)
+
+    def _keep_running(self):
+        return self._loop and any(gatherer._keep_running() for gatherer in self.gatherers)
+
+    def stop(self):
+        """Stop the gatherers and the shared listener."""
+        logger.info("Stopping the gatherers.")
+        self._loop = False
+        for gatherer in self.gatherers:
+            gatherer.stop()
+        if self._listener is not None and self._listener.thread is not None:
+            self._listener.stop()
+
+
+def _check_multi_configs(configs):
+    """Check the configs of the gatherers run in a single process.
+
+    Worker processes are supported only for a single config, and the
+    gatherers cannot share a snapshot file.
+    """
+    if any(config.get('workers', 1) > 1 for config in configs):
+        raise ValueError("The workers option is supported only when running a single gatherer")
+    snapshot_files = [config['snapshot_file'] for config in configs if config.get('snapshot_file')]
+    duplicates = sorted({fname for fname in snapshot_files if snapshot_files.count(fname) > 1})
+    if duplicates:
+        raise ValueError(f"The gatherers need separate snapshot files, shared: {', '.join(duplicates)}")
+
+
+def _get_listener_nameserver(posttroll_config):
+    """Get the nameserver a listener uses, localhost being the posttroll default."""
+    nameserver = check_nameserver_options(posttroll_config.get('nameservers'), for_listener=True)
+    if nameserver is None:
+        return 'localhost'
+    return nameserver
+
+
+def _merge_posttroll_option(posttroll_configs, key):
+    """Merge a list-valued posttroll option of several gatherers.
+
+    None is returned if any of the gatherers does not limit the option, so
+    that the shared listener receives everything.
+    """
+    merged = []
+    for posttroll_config in posttroll_configs:
+        values = posttroll_config.get(key)
+        if not values:
+            return None
+        if isinstance(values, str):
+            values = values.split()
+        merged.extend(value for value in values if value not in merged)
+    return merged
+
+
+def _get_subject_prefix(topic):
+    """Get the message subject prefix a posttroll topic subscribes to."""
+    if topic.startswith(pmessage._MAGICK):
+        return topic[len(pmessage._MAGICK):]
+    if not topic.startswith('/'):
+        return '/' + topic
+    return topic
+
+
+def _get_listener_queue(listener):
+    try:
+        return listener.output_queue
+    except AttributeError:
+        return listener.queue
+
+
+def _get_queued_messages(queue, queue_timeout, batch_size):
+    """Get the next message from the queue, and the messages queued after it up to *batch_size*."""
+    try:
+        messages = [queue.get(True, queue_timeout)]
+    except Empty:
+        return []
+    while len(messages) < batch_size:
+        try:
+            messages.append(queue.get_nowait())
+        except Empty:
+            break
+    return messages
+
+
+class ShardedSegmentGatherer:
+    """Run the segment gathering of one configuration in several worker processes.
+
+    The front-end process receives the messages and distributes them to the
+    workers by the hash of the ``shard_key`` item of the message, so that
+    the files of a slot are handled by the same worker in the order they
+    were received.  A time ``shard_key`` is replaced by the time of the slot
+    of the file, found like the workers find it.  The collections completed
+    by the workers are published by the front-end.
+
+    On SIGTERM the front-end stops receiving messages, and waits for the
+    workers to finish their open slots or to write their snapshots.
+
+    With a time ``shard_key``, the workers use the slot times found by the
+    front-end, and report the slots they close so that the front-end
+    forgets them.
+    """
+
+    def __init__(self, config):
+        """Initialize the sharded gatherer."""
+        self._config = config
+        self._num_workers = config.get('workers', 1)
+        self._shard_key = config.get('shard_key', 'platform_name')
+        self._frontend = SegmentGatherer(config)
+        self._time_names = {pattern.time_name for pattern in self._frontend._patterns.values()}
+        self._slot_times = []
+        self._last_slot_messages = {}
+        self._num_sent = [0] * self._num_workers
+        self._missing_shard_key_logged = False
+        self._workers = []
+        self._shards = []
+        self._results = None
+        self._num_running = 0
+        self._loop = False
+        self._sigterm_caught = False
+
+    def get_shard(self, msg):
+        """Get the index of the worker handling the message.
+
+        Messages without the shard key are handled by the first worker.
+        """
+        return self._route(msg)[0]
+
+    def _route(self, msg):
+        """Get the index of the worker handling the message, and the slot time of a time shard key.
+
+        The message is parsed only if the shard key is a time or is missing
+        from the message.
+        """
+        value = msg.data.get(self._shard_key)
+        if value is not None and not isinstance(value, dt.datetime) and self._shard_key not in self._time_names:
+            return zlib.crc32(str(value).encode()) % self._num_workers, None
+        try:
+            message = self._frontend.message_from_posttroll(msg)
+        except TypeError:
+            message = None
+        slot_time = None
+        if message is not None:
+            if self._shard_key == message.pattern.time_name or isinstance(value, dt.datetime):
+                slot_time = self._get_slot_time(ensure_utc_aware(message.id_time))
+                value = slot_time
+            else:
+                value = message.metadata.get(self._shard_key, value)
+        if value is None:
+            if not self._missing_shard_key_logged:
+                logger.warning("No %s in message %s, the messages without it are handled by the first worker.",
+                               self._shard_key, str(msg))
+                self._missing_shard_key_logged = True
+            return 0, None
+        return zlib.crc32(str(value).encode()) % self._num_workers, slot_time
+
+    def _get_slot_time(self, time_obj):
+        """Get the time of the slot of a file, the nearest within the time tolerance as in the workers."""
+        if self._frontend._repeat_cycle is not None:
+            return self._frontend._repeat_cycle.get_nominal_time(time_obj)
+        pos = bisect.bisect_left(self._slot_times, time_obj)
+        nearest = min(self._slot_times[max(pos - 1, 0):pos + 1], key=lambda slot_time: abs(slot_time - time_obj),
+                      default=None)
+        if nearest is not None and abs((nearest - time_obj).total_seconds()) < self._frontend._time_tolerance:
+            return nearest
+        self._slot_times.insert(pos, time_obj)
+        if len(self._slot_times) > MAX_SHARD_SLOT_TIMES:
+            self._last_slot_messages.pop(str(self._slot_times.pop(0)), None)
+        return time_obj
+
+    def _forget_closed_slot(self, closed_slot):
+        """Forget the time of a slot closed by a worker.
+
+        The time is kept if messages of the slot were sent to the worker
+        after it closed the slot, as they open the slot again.
+        """
+        if self._last_slot_messages.get(closed_slot.slot_time, 0) > closed_slot.num_messages:
+            return
+        self._last_slot_messages.pop(closed_slot.slot_time, None)
+        slot_time = dt.datetime.fromisoformat(closed_slot.slot_time)
+        pos = bisect.bisect_left(self._slot_times, slot_time)
+        if pos < len(self._slot_times) and self._slot_times[pos] == slot_time:
+            del self._slot_times[pos]
+
+    def run(self):
+        """Run the front-end and the workers."""
+        self._frontend._setup_messaging()
+        self._start_workers()
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        self._loop = True
+        try:
+            while self._loop and not self._sigterm_caught:
+                try:
+                    messages = self._frontend._get_messages(RESULT_POLL_INTERVAL)
+                except KeyboardInterrupt:
+                    self._terminate_workers()
+                    break
+                self.distribute(messages)
+                self._publish_results()
+        finally:
+            self._stop_workers()
+            self.stop()
+
+    def _start_workers(self):
+        context = multiprocessing.get_context()
+        self._results = context.Queue()
+        for index in range(self._num_workers):
+            shard = context.Queue()
+            worker = context.Process(target=_run_shard, args=(self._config, index, shard, self._results),
+                                     name=f"segment_gatherer_shard_{index}", daemon=True)
+            worker.start()
+            self._shards.append(shard)
+            self._workers.append(worker)
+        self._num_running = self._num_workers
+
+    def distribute(self, messages):
+        """Send the messages to the workers."""
+        for msg in messages:
+            if msg.type in ["file", "dataset"]:
+                shard, slot_time = self._route(msg)
+                self._num_sent[shard] += 1
+                if slot_time is not None:
+                    slot_time = str(slot_time)
+                    self._last_slot_messages[slot_time] = self._num_sent[shard]
+                self._shards[shard].put((msg, slot_time))
+
+    def _publish_results(self, timeout=None):
+        """Publish the collections completed by the workers."""
+        while self._num_running:
+            try:
+                if timeout is None:
+                    result = self._results.get_nowait()
+                else:
+                    result = self._results.get(True, timeout)
+            except Empty:
+                return
+            if result is None:
+                self._num_running -= 1
+            elif isinstance(result, _ClosedSlot):
+                self._forget_closed_slot(result)
+            else:
+                self._frontend._publisher.send(result)
+
+    def _stop_workers(self):
+        """Let the workers finish their open slots or write their snapshots, and wait for them."""
+        for shard in self._shards:
+            shard.put(None)
+        while self._num_running:
+            self._publish_results(timeout=RESULT_POLL_INTERVAL)
+            if not any(worker.is_alive() for worker in self._workers):
+                self._publish_results()
+                break
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._shards = []
+
+    def _terminate_workers(self):
+        for worker in self._workers:
+            worker.terminate()
+        self._num_running = 0
+
+    def _handle_sigterm(self, signum, frame):
+        logging.info("Caught SIGTERM, stopping the workers.")
+        self._sigterm_caught = True
+
+    def stop(self):
+        """Stop the front-end."""
+        self._loop = False
+        self._frontend.stop()
+
+
+class _QueuePublisher:
+    """Publisher handing the published messages of a worker to the front-end."""
+
+    def __init__(self, queue):
+        self._queue = queue
+
+    def send(self, msg):
+        self._queue.put(msg)
+
+    def stop(self):
+        pass
+
+
+_ClosedSlot = namedtuple('_ClosedSlot', ['slot_time', 'num_messages'])
+
+
+class _ShardGatherer(SegmentGatherer):
+    """Segment gatherer of a worker.
+
+    The messages come with the slot time found by the front-end for a time
+    shard key, and the closed slots are reported to the front-end with the
+    number of messages received so far.
+    """
+
+    def __init__(self, config, results):
+        """Initialize the worker gatherer."""
+        super().__init__(config)
+        self._results = results
+        self._subject = config['posttroll']['publish_topic']
+        self._publisher = _QueuePublisher(results)
+        self._num_received = 0
+        self._assigned_slot_time = None
+
+    def process_shard_messages(self, items):
+        """Process the messages of the shard, with their slot times."""
+        for msg, slot_time in items:
+            self._num_received += 1
+            self._assigned_slot_time = slot_time
+            try:
+                self._process_messages([msg])
+            finally:
+                self._assigned_slot_time = None
+
+    def _find_message_slot(self, message):
+        if self._assigned_slot_time is not None:
+            return self._assigned_slot_time
+        return super()._find_message_slot(message)
+
+    def _clear_slot(self, time_slot):
+        super()._clear_slot(time_slot)
+        self._results.put(_ClosedSlot(time_slot, self._num_received))
+
+
+def _run_shard(config, index, messages, results):
+    """Run the segment gathering for the messages of one shard.
+
+    A ``None`` message makes the worker finish as on SIGTERM.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if config.get('snapshot_file'):
+        config = dict(config, snapshot_file=f"{config['snapshot_file']}.{index}")
+    gatherer = _ShardGatherer(config, results)
+    signal.signal(signal.SIGTERM, gatherer._handle_sigterm)
+    gatherer._start()
+    while gatherer._keep_running():
+        gatherer._check_slots()
+        batch = _get_queued_messages(messages, gatherer._get_queue_timeout(), gatherer._batch_size)
+        if None in batch:
+            gatherer._sigterm_caught = True
+            batch = [item for item in batch if item is not None]
+        gatherer.process_shard_messages(batch)
+    gatherer._finish()
+    results.put(None)
+
+
+def _is_time_in_interval(time_range, raw_time):
+    """Check if the time, in minutes of the day, is inside the configured interval."""
+    time_ok = False
+
+    if time_range["midnight"] and raw_time < time_range["start"]:
+        raw_time += 24 * 60
+
+    # Check start and end time
+    if time_range["start"] <= raw_time <= time_range["end"]:
+        # Raw time in range, check interval
+        if ((raw_time - time_range["start"]) % time_range["delta"]) == 0:
+            time_ok = True
+
+    return time_ok
+
+
 def _copy_without_ignore_items(the_dict, ignored_keys='ignore'):
     """Get a copy of *the_dict* without entries having substring 'ignore' in key."""
     if not isinstance(ignored_keys, (list, tuple, set)):
@@ -983,6 +2694,10 @@ def ini_to_dict(fname, section):
     posttroll['publish_port'] = publish_port
 
     posttroll['publish_topic'] = config.get(section, "publish_topic")
+    try:
+        posttroll['partial_publish_topic'] = config.get(section, "partial_publish_topic")
+    except NoOptionError:
+        pass
 
     conf['patterns'] = {section: {}}
     patterns = conf['patterns'][section]
@@ -1025,10 +2740,16 @@ def ini_to_dict(fname, section):
         pass
 
     try:
-        conf['providing_server'] = config.get(section, "providing_server")
+        providing_servers = config.get(section, "providing_server").split()
+        conf['providing_server'] = providing_servers[0] if len(providing_servers) == 1 else providing_servers or None
     except (NoOptionError, ValueError):
         conf['providing_server'] = None
 
+    try:
+        conf['prefer_fastest_provider'] = config.getboolean(section, "prefer_fastest_provider")
+    except (NoOptionError, ValueError):
+        conf['prefer_fastest_provider'] = False
+
     try:
         conf['time_name'] = config.get(section, "time_name")
     except (NoOptionError, ValueError):
@@ -1044,6 +2765,69 @@ def ini_to_dict(fname, section):
     except (NoOptionError, ValueError):
         conf['all_files_are_local'] = False
 
+    try:
+        conf['segment_keys'] = config.getboolean(section, "segment_keys")
+    except (NoOptionError, ValueError):
+        conf['segment_keys'] = False
+
+    try:
+        conf['snapshot_file'] = config.get(section, "snapshot_file")
+    except (NoOptionError, ValueError):
+        conf['snapshot_file'] = None
+
+    try:
+        conf['snapshot_interval'] = config.getint(section, "snapshot_interval")
+    except (NoOptionError, ValueError):
+        conf['snapshot_interval'] = 60
+
+    try:
+        conf['batch_size'] = config.getint(section, "batch_size")
+    except (NoOptionError, ValueError):
+        conf['batch_size'] = 1
+
+    try:
+        conf['workers'] = config.getint(section, "workers")
+    except (NoOptionError, ValueError):
+        conf['workers'] = 1
+
+    try:
+        conf['shard_key'] = config.get(section, "shard_key")
+    except (NoOptionError, ValueError):
+        conf['shard_key'] = 'platform_name'
+
+    try:
+        conf['incremental_publish'] = config.getboolean(section, "incremental_publish")
+    except (NoOptionError, ValueError):
+        conf['incremental_publish'] = False
+
+    adaptive_timeliness = {}
+    for key, getter in (('quantile', config.getfloat), ('margin', config.getfloat),
+                        ('window', config.getint), ('min_samples', config.getint)):
+        try:
+            adaptive_timeliness[key] = getter(section, "adaptive_timeliness_" + key)
+        except (NoOptionError, ValueError):
+            pass
+    conf['adaptive_timeliness'] = adaptive_timeliness or None
+
+    repeat_cycle = {}
+    for key, getter in (('minutes', config.getfloat), ('offset', config.getfloat), ('precreate', config.getfloat)):
+        try:
+            repeat_cycle[key] = getter(section, "repeat_cycle_" + key)
+        except (NoOptionError, ValueError):
+            pass
+    conf['repeat_cycle'] = repeat_cycle or None
+
+    for key in ('max_open_slots', 'max_files_per_slot', 'max_time_offset'):
+        try:
+            conf[key] = config.getint(section, key)
+        except (NoOptionError, ValueError):
+            conf[key] = None
+
+    try:
+        conf['eviction_policy'] = config.get(section, "eviction_policy")
+    except (NoOptionError, ValueError):
+        conf['eviction_policy'] = 'oldest'
+
     return conf
 
 
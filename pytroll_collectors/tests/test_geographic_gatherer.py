@@ -461,12 +461,13 @@ class TestGeographicGathererWithPosttrollTrigger:
 class FakePass:
     """A fake Pass class."""
 
-    def __init__(self, platform, start, end, instrument):
+    def __init__(self, platform, start, end, instrument, **kwargs):
         """Set up the fake pass."""
         self.platform = platform
         self.start = start
         self.end = end
         self.instrument = instrument
+        self.boundary = MagicMock(**{"contour.return_value": ([], [])})
 
     def area_coverage(self, area):
         """Compute fake area coverage."""
@@ -296,3 +296,269 @@ def test_log_overlap_message_backup_log_message(caplog):
     assert "Failed printing debug info" in caplog.text
     assert "Keys in granule_metadata" in caplog.text
     assert "['key1', 'key2']" in caplog.text
+
+
+class CountingPass:
+    """A fake Pass class counting the instances."""
+
+    instances = 0
+
+    def __init__(self, platform, start, end, instrument, **kwargs):
+        """Set up the fake pass."""
+        CountingPass.instances += 1
+        self.start = start
+        self.boundary = unittest.mock.Mock(**{"contour.return_value": ([], [])})
+
+    def area_coverage(self, area):
+        """Compute fake area coverage."""
+        return 1 if self.start.minute < 9 else 0
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+@unittest.mock.patch("pytroll_collectors.region_collector.Pass", new=CountingPass)
+def test_footprints_are_shared_between_regions(europe):
+    """Test the pass of a granule is created once for all the regions."""
+    import copy
+    from pytroll_collectors.region_collector import FootprintCache, RegionCollector
+    CountingPass.instances = 0
+    footprint_cache = FootprintCache()
+    regions = [copy.copy(europe) for _ in range(3)]
+    for i, region in enumerate(regions):
+        region.area_id = f"euro_{i}"
+    collectors = [RegionCollector(region, footprint_cache=footprint_cache) for region in regions]
+    for collector in collectors:
+        collector({**granule_metadata(0)})
+    # The granule and the predicted granules before and after the coverage
+    assert CountingPass.instances == len(footprint_cache) == 5
+    assert footprint_cache.hits == 10
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+def test_footprint_cache_drops_least_recently_used_pass():
+    """Test the footprint cache is limited in size."""
+    from pytroll_collectors.region_collector import FootprintCache
+    footprint_cache = FootprintCache(maxsize=2)
+    start = datetime.datetime(2021, 4, 11, 10, 0, tzinfo=dt.timezone.utc)
+    with unittest.mock.patch("pytroll_collectors.region_collector.Pass", new=CountingPass):
+        first = footprint_cache.get_pass("Metop-C", start, start + dt.timedelta(minutes=3), "avhrr")
+        for minute in (3, 6):
+            footprint_cache.get_pass("Metop-C", start + dt.timedelta(minutes=minute),
+                                     start + dt.timedelta(minutes=minute + 3), "avhrr")
+        assert footprint_cache.get_pass("Metop-C", start, start + dt.timedelta(minutes=3), "avhrr") is not first
+    assert len(footprint_cache) == 2
+
+
+def test_collectors_from_config_share_footprints(tmp_path):
+    """Test the collectors created from a config section share the footprint cache."""
+    from pytroll_collectors.region_collector import create_collectors_from_config_dict
+    area_file = tmp_path / "areas.yaml"
+    area_file.write_text(yaml_europe + yaml_europe.replace("euro_ma", "euro_mb"))
+    collectors = create_collectors_from_config_dict({"area_definition_file": str(area_file),
+                                                     "regions": "euro_ma euro_mb",
+                                                     "timeliness": "10"})
+    assert collectors[0].footprint_cache is collectors[1].footprint_cache
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+def test_regions_far_from_the_granule_are_rejected(europe, caplog):
+    """Test the coverage of a region far from the granule footprint is not computed."""
+    from pyresample import parse_area_file
+    from pytroll_collectors.region_collector import FootprintCache, RegionCollector
+    south_pacific = parse_area_file(yaml_europe.replace("lat_0: 45", "lat_0: -45").replace(
+        "lon_0: 15", "lon_0: -165"), "euro_ma")[0]
+    south_pacific.area_id = "south_pacific"
+    footprint_cache = FootprintCache()
+    europe_collector = RegionCollector(europe, footprint_cache=footprint_cache)
+    south_pacific_collector = RegionCollector(south_pacific, footprint_cache=footprint_cache)
+    assert len(footprint_cache.region_index) == 2
+    with caplog.at_level(logging.DEBUG):
+        south_pacific_collector.collect({**granule_metadata(0)})
+        europe_collector.collect({**granule_metadata(0)})
+    assert footprint_cache.rejected == 1
+    assert not south_pacific_collector.granules
+    assert "Granule file://0 is overlapping region euro_ma by fraction" in caplog.text
+
+
+def test_bounding_cap_of_points_not_in_a_hemisphere_is_the_whole_sphere():
+    """Test the bounding cap falls back to the whole sphere."""
+    import numpy as np
+    from pytroll_collectors.region_collector import _get_bounding_cap
+    assert _get_bounding_cap([0, 180], [0, 0])[1] == np.pi
+    assert _get_bounding_cap([0, 90, 180, 270], [10, 10, 10, 10])[1] < np.pi / 2
+    assert _get_bounding_cap([], [])[1] == np.pi
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+def test_batch_prediction_plans_the_same_granules(europe):
+    """Test the batch prediction plans the same granules with fewer passes."""
+    from pytroll_collectors.region_collector import FootprintCache, RegionCollector
+    planned = []
+    for batch_prediction in (False, True):
+        footprint_cache = FootprintCache()
+        collector = RegionCollector(europe, footprint_cache=footprint_cache, batch_prediction=batch_prediction)
+        collector({**granule_metadata(6)})
+        planned.append(collector.planned_granule_times)
+    assert planned[0] == planned[1]
+    assert len(planned[1]) == 6
+    assert footprint_cache.misses < len(planned[1])
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+@unittest.mock.patch("pytroll_collectors.region_collector.Pass", new=CountingPass)
+def test_batch_prediction_without_footprint_steps_granules(europe):
+    """Test the granules are predicted one by one when the footprint is not known."""
+    from pytroll_collectors.region_collector import RegionCollector
+    collector = RegionCollector(europe, batch_prediction=True)
+    collector({**granule_metadata(3)})
+    assert len(collector.planned_granule_times) == 3
+
+
+def test_batch_prediction_from_config(europe):
+    """Test the batch prediction is read from the configuration."""
+    from pytroll_collectors.region_collector import RegionCollector
+    collector = RegionCollector.from_dict_config(europe, {"timeliness": "10", "batch_prediction": "True"})
+    assert collector.batch_prediction
+    collector = RegionCollector.from_dict_config(europe, {"timeliness": "10"})
+    assert not collector.batch_prediction
+
+
+def _fail_to_open(url):
+    raise AssertionError(f"Tried to download {url}")
+
+
+@pytest.fixture
+def tle_dir(tmp_path):
+    """Create a directory with a TLE file."""
+    tle_dir = tmp_path / "tles"
+    tle_dir.mkdir()
+    (tle_dir / "tle_1.txt").write_bytes(tles)
+    return tle_dir
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fail_to_open)
+def test_orbit_cache_reads_the_tles_once(tle_dir):
+    """Test the orbits are read once from the local TLE directory."""
+    from pytroll_collectors.region_collector import OrbitCache
+    orbit_cache = OrbitCache(tle_dir=str(tle_dir))
+    orbital = orbit_cache.get_orbital("Metop-C")
+    assert orbit_cache.get_orbital("Metop-C") is orbital
+    assert (orbit_cache.hits, orbit_cache.misses) == (1, 1)
+    with pytest.raises(KeyError):
+        orbit_cache.get_orbital("NOAA-19")
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fail_to_open)
+def test_orbit_cache_refreshes_when_the_tles_change(tle_dir):
+    """Test the orbits are read again when a newer TLE file is there."""
+    import os
+    from pytroll_collectors.region_collector import OrbitCache
+    orbit_cache = OrbitCache(tle_dir=str(tle_dir))
+    orbital = orbit_cache.get_orbital("Metop-C")
+    newer_file = tle_dir / "tle_2.txt"
+    newer_file.write_bytes(b"")
+    os.utime(newer_file, (os.path.getmtime(tle_dir / "tle_1.txt") + 10,) * 2)
+    assert orbit_cache.get_orbital("Metop-C") is orbital
+    later = dt.datetime.now(dt.timezone.utc) + dt.timedelta(minutes=2)
+    with unittest.mock.patch("pytroll_collectors.region_collector._utcnow", return_value=later):
+        assert orbit_cache.get_orbital("Metop-C") is not orbital
+    assert orbit_cache.misses == 2
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fail_to_open)
+def test_orbit_cache_lists_the_tle_files_once_a_minute(tle_dir):
+    """Test the TLE directory is not listed again for the cached orbits within a minute."""
+    import glob
+    from pytroll_collectors.region_collector import OrbitCache
+    orbit_cache = OrbitCache(tle_dir=str(tle_dir))
+    with unittest.mock.patch("pytroll_collectors.region_collector.glob.glob", wraps=glob.glob) as list_files:
+        for _ in range(3):
+            orbit_cache.get_orbital("Metop-C")
+        assert list_files.call_count == 1
+        later = dt.datetime.now(dt.timezone.utc) + dt.timedelta(minutes=2)
+        with unittest.mock.patch("pytroll_collectors.region_collector._utcnow", return_value=later):
+            orbit_cache.get_orbital("Metop-C")
+        assert list_files.call_count == 2
+    assert (orbit_cache.hits, orbit_cache.misses) == (3, 1)
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fail_to_open)
+def test_orbit_cache_refreshes_old_orbits(tle_dir):
+    """Test the orbits are read again when they are too old."""
+    from pytroll_collectors.region_collector import OrbitCache
+    orbit_cache = OrbitCache(tle_dir=str(tle_dir), max_age=dt.timedelta(hours=1))
+    orbital = orbit_cache.get_orbital("Metop-C")
+    assert orbit_cache.get_orbital("Metop-C") is orbital
+    later = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=2)
+    with unittest.mock.patch("pytroll_collectors.region_collector._utcnow", return_value=later):
+        assert orbit_cache.get_orbital("Metop-C") is not orbital
+
+
+def test_collectors_from_config_share_the_orbit_cache(tmp_path, tle_dir):
+    """Test the orbit cache is shared by the collectors with the same TLE settings."""
+    from pytroll_collectors.region_collector import create_collectors_from_config_dict, get_orbit_cache
+    area_file = tmp_path / "areas.yaml"
+    area_file.write_text(yaml_europe)
+    config = {"area_definition_file": str(area_file), "regions": "euro_ma", "timeliness": "10",
+              "tle_dir": str(tle_dir), "tle_max_age": "12"}
+    orbit_caches = [create_collectors_from_config_dict(config)[0].footprint_cache.orbit_cache for _ in range(2)]
+    assert orbit_caches[0] is orbit_caches[1] is get_orbit_cache(str(tle_dir), dt.timedelta(hours=12))
+    assert orbit_caches[0] is not get_orbit_cache()
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+@unittest.mock.patch("pytroll_collectors.region_collector.Pass", new=CountingPass)
+def test_coverages_are_cached(europe):
+    """Test the coverage of a granule sent again is not computed again."""
+    from pytroll_collectors.region_collector import FootprintCache, RegionCollector
+    footprint_cache = FootprintCache()
+    collector = RegionCollector(europe, footprint_cache=footprint_cache)
+    collector({**granule_metadata(0)})
+    collector({**granule_metadata(0)})
+    collector({**granule_metadata(3)})
+    # The granule at 10:03 was already checked when predicting the granules
+    assert footprint_cache.coverage_misses == 5
+    assert footprint_cache.coverage_hits == 1
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+@unittest.mock.patch("pytroll_collectors.region_collector.Pass", new=CountingPass)
+def test_coverage_cache_drops_least_recently_used_coverage(europe):
+    """Test the coverage cache is limited in size, and can be disabled."""
+    from pytroll_collectors.region_collector import FootprintCache
+    start = datetime.datetime(2021, 4, 11, 10, 0, tzinfo=dt.timezone.utc)
+    for coverage_cache_size, expected_misses in ((2, 4), (0, 6)):
+        footprint_cache = FootprintCache(coverage_cache_size=coverage_cache_size)
+        for minute in (0, 3, 0, 6, 0, 3):
+            footprint_cache.get_coverage("Metop-C", start + dt.timedelta(minutes=minute),
+                                         start + dt.timedelta(minutes=minute + 3), "avhrr", europe)
+        assert footprint_cache.coverage_misses == expected_misses
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fakeopen_celestrak)
+def test_orbit_cache_refreshes_downloaded_orbits_daily(monkeypatch):
+    """Test the orbits not read from a local file are read again after a day by default."""
+    from pytroll_collectors.region_collector import OrbitCache
+    monkeypatch.delenv("TLES", raising=False)
+    orbit_cache = OrbitCache()
+    orbital = orbit_cache.get_orbital("Metop-C")
+    later = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=25)
+    with unittest.mock.patch("pytroll_collectors.region_collector._utcnow", return_value=later):
+        assert orbit_cache.get_orbital("Metop-C") is not orbital
+
+
+@unittest.mock.patch("pyorbital.tlefile.urlopen", new=_fail_to_open)
+def test_orbit_cache_does_not_retry_a_failed_refresh(tle_dir):
+    """Test the previous orbit is kept when the refresh fails, without trying again on every call."""
+    import os
+    from pytroll_collectors.region_collector import OrbitCache
+    orbit_cache = OrbitCache(tle_dir=str(tle_dir))
+    orbital = orbit_cache.get_orbital("Metop-C")
+    (tle_dir / "tle_1.txt").unlink()
+    newer_file = tle_dir / "tle_2.txt"
+    newer_file.write_bytes(b"")
+    os.utime(newer_file, (os.path.getmtime(tle_dir) + 10,) * 2)
+    later = dt.datetime.now(dt.timezone.utc) + dt.timedelta(minutes=2)
+    with unittest.mock.patch("pytroll_collectors.region_collector._utcnow", return_value=later):
+        assert orbit_cache.get_orbital("Metop-C") is orbital
+        assert orbit_cache.get_orbital("Metop-C") is orbital
+    assert (orbit_cache.hits, orbit_cache.misses) == (1, 2)
@@ -0,0 +1,69 @@
+"""Tests for replaying message streams through the segment gatherer."""
+
+import datetime as dt
+
+import pytest
+
+from pytroll_collectors import segments
+from pytroll_collectors.scripts.segment_gatherer_replay import (SYNTHETIC_STREAMS, SimulatedClock, main, read_stream,
+                                                                replay, simulated_time, write_stream)
+
+
+@pytest.mark.parametrize("name", sorted(SYNTHETIC_STREAMS))
+def test_replay_synthetic_stream(name):
+    """Test that all the slots of a complete synthetic stream are published when the last file arrives."""
+    config, create_stream = SYNTHETIC_STREAMS[name]
+    result = replay(config, create_stream(slots=3))
+    assert result["published"] == 3
+    assert result["latencies"] == [0, 0, 0]
+    assert result["gatherer"]["open_slots"] == 0
+
+
+def test_replay_publishes_incomplete_slots_at_timeout():
+    """Test that a slot missing files is published in simulated time when it times out."""
+    config, create_stream = SYNTHETIC_STREAMS["msg"]
+    stream = create_stream(slots=2)
+    last_epilogue = max(i for i, (_, msg) in enumerate(stream) if "IR_134___-000008" in msg.data["uid"])
+    del stream[last_epilogue]
+    result = replay(config, stream)
+    assert result["published"] == 2
+    assert max(result["latencies"]) > 100
+
+
+def test_replay_restores_the_clock():
+    """Test that the gatherer uses the real time again after a replay."""
+    config, create_stream = SYNTHETIC_STREAMS["fci"]
+    replay(config, create_stream(slots=1))
+    assert abs(segments._utcnow() - dt.datetime.now(dt.timezone.utc)) < dt.timedelta(seconds=10)
+
+
+def test_simulated_clock_does_not_go_backwards():
+    """Test that the simulated clock only moves forward."""
+    start = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+    clock = SimulatedClock(start)
+    with simulated_time(clock):
+        clock.set(start + dt.timedelta(minutes=1))
+        clock.set(start)
+        assert segments._utcnow() == start + dt.timedelta(minutes=1)
+
+
+def test_write_and_read_stream(tmp_path):
+    """Test that a written stream is read back."""
+    _, create_stream = SYNTHETIC_STREAMS["himawari"]
+    stream = create_stream(slots=1)[:5]
+    fname = tmp_path / "stream.jsonl"
+    write_stream(fname, stream)
+    read_back = read_stream(fname)
+    assert [receive_time for receive_time, _ in read_back] == [receive_time for receive_time, _ in stream]
+    assert [msg.data["uid"] for _, msg in read_back] == [msg.data["uid"] for _, msg in stream]
+
+
+def test_main_reports_statistics(tmp_path, capsys):
+    """Test replaying a recorded synthetic stream from the command line."""
+    fname = tmp_path / "stream.jsonl"
+    main(["--synthetic", "fci", "--slots", "1", "--record", str(fname)])
+    output = capsys.readouterr().out
+    assert "Throughput:" in output
+    assert "Published: 1" in output
+    assert "Peak memory:" in output
+    assert len(read_stream(fname)) == 40
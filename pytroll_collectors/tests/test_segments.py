@@ -10,7 +10,10 @@ import pytest
 
 import posttroll.message
 from pytroll_collectors.helper_functions import read_yaml
-from pytroll_collectors.segments import SegmentGatherer, ini_to_dict, Status, Message, DO_NOT_COPY_KEYS
+from pytroll_collectors.segments import (SegmentGatherer, ini_to_dict, Status, Message, DO_NOT_COPY_KEYS, SlotIndex,
+                                         ReceivedFiles, MaskTemplate, MultiSegmentGatherer,
+                                         ShardedSegmentGatherer, RepeatCycle, _get_existing_files_from_message,
+                                         _ShardGatherer)
 from pytroll_collectors.utils import ensure_utc_aware
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -315,6 +318,18 @@ class TestSegmentGatherer:
         res = func()
         assert res == Status.SLOT_READY
 
+    def test_slot_is_ready_for_premature_publish_after_a_batch(self):
+        """Test the premature publication when several files are added between the checks."""
+        message = Message(FakeMessage(self.mda_msg0deg.copy()), self.msg0deg._patterns['msg'])
+        slot = self.msg0deg._create_slot(message)
+        slot['msg']['files_till_premature_publish'] = 2
+        slot['msg']['is_critical_set'] = False
+        slot['msg']['received_files'] |= set(['H-000-MSG3__-MSG3________-VIS006___-000001___-201611281100-__',
+                                              'H-000-MSG3__-MSG3________-VIS006___-000002___-201611281100-__',
+                                              'H-000-MSG3__-MSG3________-VIS006___-000003___-201611281100-__'])
+        assert slot.get_status() == Status.SLOT_READY_BUT_WAIT_FOR_MORE
+        assert slot.get_status() == Status.SLOT_NONCRITICAL_NOT_READY
+
     def test_get_collection_status(self):
         """Test getting the collection status."""
         mda = self.mda_msg0deg.copy()
@@ -608,6 +623,10 @@ class TestSegmentGatherer:
         assert self.msg0deg.check_if_time_is_in_interval(hour, dt.time(4, 15))
         assert not self.msg0deg.check_if_time_is_in_interval(hour, dt.time(4, 30))
         assert not self.msg0deg.check_if_time_is_in_interval(hour, dt.time(11, 0))
+        minutes = self.msg0deg_iodc._patterns['iodc']['_start_time_minutes']
+        assert 4 * 60 + 15 in minutes
+        assert 4 * 60 + 30 not in minutes
+        assert 11 * 60 not in minutes
 
     def test_copy_metadata(self):
         """Test combining metadata from a message and parsed from filename."""
@@ -658,8 +677,8 @@ class TestSegmentGatherer:
         self.msg0deg._config['check_existing_files_after_start'] = True
 
         self.msg0deg.check_and_add_existing_files(slot, message)
-        assert call(logging.DEBUG) in logging.disable.mock_calls
-        assert call(logging.NOTSET) in logging.disable.mock_calls
+        _finish_existing_files_scan(self.msg0deg)
+        logging.disable.assert_not_called()
         for fname in existing_files[:-1]:
             assert os.path.basename(fname) in slot._info['msg']['received_files']
         assert os.path.basename(existing_files[-1]) not in slot._info['msg']['received_files']
@@ -677,6 +696,7 @@ class TestSegmentGatherer:
         self.msg0deg._config['check_existing_files_after_start'] = True
 
         self.msg0deg.check_and_add_existing_files(slot, message)
+        _finish_existing_files_scan(self.msg0deg)
         # Clear the received files and rerun, now the files should not be added
         slot._info['msg']['received_files'] = {}
         self.msg0deg.check_and_add_existing_files(slot, message)
@@ -714,7 +734,8 @@ class TestSegmentGatherer:
         self.msg0deg._config['check_existing_files_after_start'] = True
 
         self.msg0deg.check_and_add_existing_files(slot, message)
-        mask_call = 's3://bucket-name/H-000-????__-????________-?????????-?????????-????????????-__'
+        _finish_existing_files_scan(self.msg0deg)
+        mask_call = 's3://bucket-name/H-000-MSG3__-MSG3________-?????????-?????????-20161128????-__'
         filesystem.return_value.glob.assert_called_with(mask_call)
         for fname in existing_files[:-1]:
             assert os.path.basename(fname) in slot._info['msg']['received_files']
@@ -722,6 +743,50 @@ class TestSegmentGatherer:
         for dset in slot.output_metadata['dataset']:
             assert dset['uri'].startswith('s3://')
 
+    @patch("fsspec.filesystem")
+    def test_existing_files_are_listed_in_background(self, filesystem):
+        """Test the existing files are listed in a background thread and added to the slot later."""
+        import threading
+        listing = threading.Event()
+        existing_files = [
+            "/home/lahtinep/data/satellite/geo/msg/H-000-MSG3__-MSG3________-VIS006___-000007___-201611281100-__",
+            # A file from another slot
+            "/home/lahtinep/data/satellite/geo/msg/H-000-MSG3__-MSG3________-VIS006___-000007___-201611281115-__"]
+        filesystem.return_value.glob.side_effect = lambda pattern: listing.wait() and existing_files
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, check_existing_files_after_start=True))
+        gatherer.process(FakeMessage(self.mda_msg0deg.copy()))
+        slot = gatherer.slots["2016-11-28 11:00:00+00:00"]
+        assert len(slot["msg"]["received_files"]) == 1
+
+        listing.set()
+        _finish_existing_files_scan(gatherer)
+        assert len(slot["msg"]["received_files"]) == 2
+        assert len(gatherer.slots) == 1
+
+    @patch("fsspec.filesystem")
+    def test_existing_files_listing_is_limited_to_literal_prefix(self, filesystem):
+        """Test the storage lists only the files starting with the literal part of the slot mask."""
+        filesystem.return_value.glob.return_value = []
+        filesystem.return_value.find = lambda path, maxdepth=None, prefix="", **kwargs: []
+        message = _get_message_from_metadata_and_patterns(self.mda_msg0deg_s3, self.msg0deg._patterns['msg'])
+        _get_existing_files_from_message(message, 30)
+        filesystem.return_value.glob.assert_called_once_with(
+            's3://bucket-name/H-000-MSG3__-MSG3________-?????????-?????????-20161128????-__',
+            prefix='H-000-MSG3__-MSG3________-')
+
+    @pytest.mark.parametrize(("start_time", "group_by_minutes", "expected"),
+                             [(dt.datetime(2016, 11, 28, 11, 0), None, "20161128????"),
+                              (dt.datetime(2016, 11, 28, 11, 20), 10, "2016112811??"),
+                              (dt.datetime(2016, 12, 31, 23, 59, 45), None, "????????????")])
+    def test_existing_files_listing_is_limited_to_slot_time(self, start_time, group_by_minutes, expected):
+        """Test the existing files are listed only for the time of the slot."""
+        from pytroll_collectors.segments import _get_time_prefix_metadata
+        pattern = self.msg0deg._patterns["msg"]
+        pattern._group_by_minutes = group_by_minutes
+        message = MagicMock(pattern=pattern, id_time=start_time)
+        mda = _get_time_prefix_metadata(message, 30)
+        assert pattern.parser.globify(mda).split("-")[-2] == expected
+
     def test_messaging(self):
         """Test that messaging is initialized correctly."""
         with patch('pytroll_collectors.utils.create_publisher_from_dict_config') as creator:
@@ -756,6 +821,22 @@ class TestSegmentGatherer:
             self.msg0deg._setup_listener()
         assert_messaging(None, None, None, 'localhost', None, ListenerContainer)
 
+    @pytest.mark.parametrize(("batch_size", "expected"), [(None, [1]), (3, [3, 2]), (10, [5])])
+    def test_get_messages_in_batches(self, batch_size, expected):
+        """Test the queued messages are received in batches."""
+        from queue import Queue
+        config = CONFIG_SINGLE.copy()
+        if batch_size is not None:
+            config['batch_size'] = batch_size
+        gatherer = SegmentGatherer(config)
+        gatherer._listener = MagicMock(output_queue=Queue())
+        for i in range(5):
+            gatherer._listener.output_queue.put(i)
+        for num in expected:
+            assert len(gatherer._get_messages(0.01)) == num
+        if batch_size is not None:
+            assert gatherer._get_messages(0.01) == []
+
     def test_sigterm(self):
         """Test that SIGTERM signal is handled."""
         import os
@@ -808,6 +889,11 @@ def _fake_triage_slots(self):
         time.sleep(1)
 
 
+def _finish_existing_files_scan(gatherer):
+    gatherer._existing_files_scan.join()
+    gatherer.process_existing_files()
+
+
 def _get_message_from_metadata_and_patterns(mda, patterns):
     fake_message = FakeMessage(mda)
     return Message(fake_message, patterns)
@@ -1210,6 +1296,48 @@ class TestSegmentGathererCollections:
         assert message.data['collection'] == slot.output_metadata['collection']
         assert message.type == "collection"
 
+    def test_only_changed_slots_are_triaged(self):
+        """Test the slot status is checked only after the slot has received a file."""
+        from posttroll.message import Message as Message_p
+        viirs_msg = Message_p(rawstr=viirs_message)
+
+        self.collection_gatherer.process(viirs_msg)
+        slot = self.collection_gatherer.slots['2020-10-13 05:17:21.200000+00:00']
+        with patch.object(slot, "get_status", return_value=Status.SLOT_NOT_READY) as get_status:
+            self.collection_gatherer.triage_slots()
+            self.collection_gatherer.triage_slots()
+        get_status.assert_called_once()
+
+    def test_timed_out_slot_is_triaged(self):
+        """Test the slot status is checked when the slot times out."""
+        from posttroll.message import Message as Message_p
+        viirs_msg = Message_p(rawstr=viirs_message)
+
+        self.collection_gatherer.process(viirs_msg)
+        self.collection_gatherer.triage_slots()
+        slot = self.collection_gatherer.slots['2020-10-13 05:17:21.200000+00:00']
+        slot['timeout'] = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=1)
+        self.collection_gatherer._schedule_timeout(slot.timestamp)
+        with patch.object(slot, "get_status", return_value=Status.SLOT_OBSOLETE_TIMEOUT) as get_status:
+            self.collection_gatherer.triage_slots()
+        get_status.assert_called_once()
+        assert not self.collection_gatherer.slots
+
+    def test_queue_timeout_follows_next_deadline(self):
+        """Test the wait for new messages ends at the next slot timeout."""
+        from posttroll.message import Message as Message_p
+        viirs_msg = Message_p(rawstr=viirs_message)
+
+        assert self.collection_gatherer._get_queue_timeout() == 1.0
+        self.collection_gatherer._timeliness = dt.timedelta(seconds=0.5)
+        self.collection_gatherer.process(viirs_msg)
+        assert 0 < self.collection_gatherer._get_queue_timeout() <= 0.5
+        slot = self.collection_gatherer.slots['2020-10-13 05:17:21.200000+00:00']
+        assert self.collection_gatherer.get_next_timeout() == slot['timeout']
+        self.collection_gatherer._clear_slot('2020-10-13 05:17:21.200000+00:00')
+        assert self.collection_gatherer._get_queue_timeout() == 1.0
+        assert self.collection_gatherer.get_next_timeout() is None
+
     def test_bundled_dataset_is_published(self):
         """Test one bundled dataset is published."""
         from posttroll.message import Message as Message_p
@@ -1327,6 +1455,817 @@ class TestStartTimes:
         assert len(list(collection_gatherer.slots.values())[0].output_metadata['dataset']) == 2
 
 
+def _msg_segment_metadata(channel_name, segment, platform_shortname="MSG3"):
+    uid = f"H-000-MSG3__-{platform_shortname}________-{channel_name:_<9s}-{segment:_<9s}-201611281100-__"
+    return {"uid": uid, "uri": "/data/" + uid, "platform_name": "Meteosat-10", "sensor": ["seviri"],
+            "start_time": dt.datetime(2016, 11, 28, 11, 0, 0)}
+
+
+class TestSegmentKeys:
+    """Test identifying the files with structured segment keys."""
+
+    def setup_method(self):
+        """Set up the test case."""
+        self.gatherer = SegmentGatherer(dict(CONFIG_SINGLE, segment_keys=True))
+        self.slot_time = "2016-11-28 11:00:00+00:00"
+
+    def _process(self, channel_name, segment, **kwargs):
+        self.gatherer.process(FakeMessage(_msg_segment_metadata(channel_name, segment, **kwargs)))
+
+    def test_expected_files_are_shared_between_slots(self):
+        """Test the expected files are computed once for all the slots."""
+        self._process("", "PRO")
+        slot = self.gatherer.slots[self.slot_time]
+        pattern = self.gatherer._patterns["msg"]
+        assert slot["msg"]["all_files"] is pattern.segment_key_sets["all_files"]
+        assert len(slot["msg"]["critical_files"]) == 2
+        assert len(slot["msg"]["wanted_files"]) == 10
+        assert ("_________", "PRO______") in slot["msg"]["received_files"]
+
+    def test_slot_is_ready(self):
+        """Test the slot is ready when all the wanted files are received."""
+        self._process("", "PRO")
+        self._process("", "EPI")
+        slot = self.gatherer.slots[self.slot_time]
+        assert slot.get_status() == Status.SLOT_NOT_READY
+        for segment in range(1, 9):
+            self._process("VIS006", f"{segment:06d}")
+        assert slot.get_status() == Status.SLOT_READY
+
+    def test_duplicate_and_unknown_files_are_not_added(self, caplog):
+        """Test duplicate files and files not belonging to the slot are not added."""
+        self._process("", "PRO")
+        with caplog.at_level(logging.DEBUG):
+            self._process("", "PRO")
+            self._process("VIS006", "000009")
+        assert "File already received" in caplog.text
+        slot = self.gatherer.slots[self.slot_time]
+        assert len(slot["msg"]["received_files"]) == 1
+        assert len(slot.output_metadata["dataset"]) == 1
+
+    def test_other_platform_does_not_match_slot(self):
+        """Test that a file differing outside the channel and segment is not added to the slot."""
+        self._process("", "PRO")
+        slot = self.gatherer.slots[self.slot_time]
+        slot.add_file(Message(FakeMessage(_msg_segment_metadata("", "EPI", platform_shortname="MSG4")),
+                              self.gatherer._patterns["msg"]))
+        assert len(slot["msg"]["received_files"]) == 1
+
+    def test_missing_files_are_reported_by_channel_and_segment(self, caplog):
+        """Test the missing files are reported as channel:segment."""
+        self._process("", "PRO")
+        self.gatherer._publisher = MagicMock()
+        self.gatherer._subject = "/bar"
+        with caplog.at_level(logging.WARNING):
+            self.gatherer._reinitialize_gatherer(self.slot_time)
+        assert "VIS006:000008" in caplog.text
+        assert ":EPI" in caplog.text
+        assert ":PRO" not in caplog.text
+
+    def test_ini_to_dict(self):
+        """Test the segment keys are off by default in ini configs."""
+        assert CONFIG_INI["segment_keys"] is False
+
+
+class TestMaskTemplate:
+    """Test the precompiled file mask templates."""
+
+    fmt = "H-000-{hrit_format:4s}__-{platform_shortname:4s}________-{channel_name:_<9s}-{segment:_<9s}-{start_time:%Y%m%d%H%M}-__"  # noqa
+
+    def setup_method(self):
+        """Set up the test case."""
+        self.mda = {"hrit_format": "MSG3", "platform_shortname": "MSG3", "start_time": dt.datetime(2016, 11, 28, 11, 0)}
+
+    @pytest.mark.parametrize("fmt", [fmt,
+                                     "S_NWC_CMA_{platform_shortname}_{orbit_number:05d}_{start_time:%Y%m%dT%H%M%S}.nc",
+                                     "{start_time:%Y%m%d_%H%M}_{segment:0>3s}_{foo}"])
+    def test_globify_is_same_as_trollsift(self, fmt):
+        """Test the masks are identical to the ones from trollsift."""
+        import trollsift
+        template = MaskTemplate(fmt)
+        assert template.compiled
+        for mda in ({}, self.mda, {"start_time": (self.mda["start_time"], "Ymd"), "segment": "EPI"}):
+            assert template.globify(mda) == trollsift.globify(fmt, mda)
+
+    def test_bind(self):
+        """Test filling in the items to a template bound to the metadata."""
+        import trollsift
+        fill = MaskTemplate(self.fmt).bind(self.mda)
+        mda = dict(self.mda, channel_name="VIS006", segment="000001")
+        assert fill(("VIS006", "000001")) == trollsift.globify(self.fmt, mda)
+
+    def test_bind_without_items(self):
+        """Test binding a template without item fields."""
+        fill = MaskTemplate("hrpt_{platform_shortname}_{start_time:%Y%m%d_%H%M}.l1b").bind(self.mda)
+        assert fill(("", "")) == "hrpt_MSG3_20161128_1100.l1b"
+
+    def test_fallback_for_nested_fields(self):
+        """Test templates with nested fields are formatted by trollsift."""
+        template = MaskTemplate("{foo:{bar}}_{start_time:%Y}")
+        assert not template.compiled
+        assert template.bind(self.mda) is None
+        assert template.globify(self.mda) == "*_2016"
+
+
+class TestReceivedFiles:
+    """Test the counting of the received files."""
+
+    def setup_method(self):
+        """Set up the test case."""
+        self.received = ReceivedFiles(required={"EPI", "PRO", "VIS1", "VIS2"}, critical={"EPI", "PRO"})
+
+    def test_counts_follow_additions(self):
+        """Test the counts are updated when files are added."""
+        self.received.add("EPI")
+        self.received.add("EPI")
+        self.received |= {"VIS1", "extra"}
+        assert self.received.num_required == 2
+        assert self.received.num_critical == 1
+        assert not self.received.all_critical_received
+        self.received.update(["PRO", "VIS2"])
+        assert self.received.all_critical_received
+        assert self.received.all_required_received
+
+    def test_counts_follow_removals(self):
+        """Test the counts are updated when files are removed."""
+        self.received.update(["EPI", "PRO", "VIS1", "VIS2", "extra"])
+        self.received.discard("VIS1")
+        self.received.remove("extra")
+        assert self.received.num_required == 3
+        self.received -= {"EPI"}
+        assert self.received.num_critical == 1
+        self.received &= {"PRO"}
+        assert self.received.num_required == 1
+        self.received.clear()
+        assert self.received.num_required == 0
+        assert self.received.num_critical == 0
+
+
+class TestSnapshot:
+    """Test the snapshots of the open slots."""
+
+    slot_time = "2016-11-28 11:00:00+00:00"
+
+    def _create_gatherer(self, tmp_path, **kwargs):
+        return SegmentGatherer(dict(CONFIG_SINGLE, snapshot_file=os.fspath(tmp_path / "slots.pickle"), **kwargs))
+
+    @pytest.mark.parametrize("segment_keys", [False, True])
+    def test_restore_snapshot(self, tmp_path, segment_keys):
+        """Test the open slots are restored from the snapshot."""
+        gatherer = self._create_gatherer(tmp_path, segment_keys=segment_keys)
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "EPI")))
+        gatherer.write_snapshot()
+
+        restored = self._create_gatherer(tmp_path, segment_keys=segment_keys)
+        restored.restore_snapshot()
+        slot = restored.slots[self.slot_time]
+        assert slot["timeout"] == gatherer.slots[self.slot_time]["timeout"]
+        assert slot.output_metadata == gatherer.slots[self.slot_time].output_metadata
+        assert len(slot["msg"]["received_files"]) == 2
+        assert restored._get_queue_timeout() <= 1.0
+
+        with patch.object(restored, "message_from_posttroll") as message_from_posttroll:
+            restored.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        message_from_posttroll.assert_not_called()
+        for segment in range(1, 9):
+            restored.process(FakeMessage(_msg_segment_metadata("VIS006", f"{segment:06d}")))
+        assert slot.get_status() == Status.SLOT_READY
+
+    def test_snapshot_for_other_patterns_is_ignored(self, tmp_path, caplog):
+        """Test a snapshot written with different patterns is not restored."""
+        gatherer = self._create_gatherer(tmp_path)
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer.write_snapshot()
+
+        restored = SegmentGatherer(dict(CONFIG_DOUBLE, snapshot_file=gatherer._snapshot_file))
+        with caplog.at_level(logging.WARNING):
+            restored.restore_snapshot()
+        assert "does not match the configuration" in caplog.text
+        assert not restored.slots
+
+    def test_missing_snapshot(self, tmp_path):
+        """Test starting without a snapshot file."""
+        gatherer = self._create_gatherer(tmp_path)
+        gatherer.restore_snapshot()
+        assert not gatherer.slots
+
+    def test_sigterm_stops_immediately_with_snapshot(self, tmp_path):
+        """Test the gatherer does not wait for the open slots on SIGTERM when they are saved in a snapshot."""
+        gatherer = self._create_gatherer(tmp_path)
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer._loop = True
+        gatherer._handle_sigterm(None, None)
+        assert not gatherer._keep_running()
+
+
+class TestMultiSegmentGatherer:
+    """Test running several gatherers in one process."""
+
+    def test_messaging(self):
+        """Test the gatherers share a listener and have their own publishers."""
+        gatherers = MultiSegmentGatherer([CONFIG_SINGLE, CONFIG_PPS])
+        with patch('pytroll_collectors.utils.create_publisher_from_dict_config') as creator:
+            with patch('pytroll_collectors.segments.ListenerContainer') as ListenerContainer:
+                gatherers._setup_messaging()
+        ListenerContainer.assert_called_once_with(topics=['/foo/bar', '/segment/CF/2'], addresses=None,
+                                                  nameserver='localhost', services='')
+        names = [call_args[0][0]['name'] for call_args in creator.call_args_list]
+        assert names == ['segment_gatherer_msg', 'segment_gatherer_pps']
+        assert [gatherer._subject for gatherer in gatherers.gatherers] == ['/bar', '/segment-foo/bar']
+
+    def test_different_nameservers_are_rejected(self):
+        """Test the gatherers sharing a listener cannot have different nameservers."""
+        config = dict(CONFIG_PPS, posttroll=dict(CONFIG_PPS['posttroll'], nameservers=['other']))
+        gatherers = MultiSegmentGatherer([CONFIG_SINGLE, config])
+        with patch('pytroll_collectors.segments.ListenerContainer') as ListenerContainer:
+            with pytest.raises(ValueError, match="same nameservers"):
+                gatherers._setup_listener()
+        ListenerContainer.assert_not_called()
+
+    def test_workers_are_rejected(self):
+        """Test the workers option is refused with several gatherers."""
+        with pytest.raises(ValueError, match="workers option"):
+            MultiSegmentGatherer([CONFIG_SINGLE, dict(CONFIG_PPS, workers=2)])
+
+    def test_shared_snapshot_file_is_rejected(self, tmp_path):
+        """Test the gatherers cannot write the same snapshot file."""
+        snapshot_file = str(tmp_path / "snapshot.pickle")
+        with pytest.raises(ValueError, match="separate snapshot files"):
+            MultiSegmentGatherer([dict(CONFIG_SINGLE, snapshot_file=snapshot_file),
+                                  dict(CONFIG_PPS, snapshot_file=snapshot_file)])
+        MultiSegmentGatherer([dict(CONFIG_SINGLE, snapshot_file=snapshot_file), CONFIG_PPS])
+
+    def test_messages_are_routed_by_topic(self):
+        """Test the messages are processed only by the gatherers listening to their topics."""
+        gatherers = MultiSegmentGatherer([CONFIG_SINGLE, CONFIG_PPS])
+        msg = FakeMessage({}, subject='/foo/bar/baz')
+        pps_msg = FakeMessage({}, subject='/segment/CF/2')
+        other_msg = FakeMessage({}, subject='/other')
+        for gatherer in gatherers.gatherers:
+            gatherer.process = MagicMock()
+        gatherers._route_messages([msg, pps_msg, other_msg])
+        gatherers.gatherers[0].process.assert_called_once_with(msg)
+        gatherers.gatherers[1].process.assert_called_once_with(pps_msg)
+
+    @pytest.mark.parametrize(("topics", "subject", "expected"),
+                             [(['/foo/bar'], '/foo/bar', True),
+                              (['pytroll://foo'], '/foo/bar', True),
+                              (['foo'], '/foo/bar', True),
+                              (['/foo/baz', '/bar'], '/foo/bar', False),
+                              (None, '/foo/bar', True)])
+    def test_is_subscribed(self, topics, subject, expected):
+        """Test matching the message subjects to the topics of a gatherer."""
+        config = dict(CONFIG_SINGLE, posttroll=dict(CONFIG_SINGLE['posttroll'], topics=topics))
+        assert SegmentGatherer(config).is_subscribed(subject) is expected
+
+    def test_read_configs(self, tmp_path):
+        """Test reading several configs from files and directories."""
+        import yaml
+        from pytroll_collectors.scripts.segment_gatherer import read_configs
+        config_dir = tmp_path / "configs"
+        config_dir.mkdir()
+        (config_dir / "msg.yaml").write_text(yaml.dump(CONFIG_SINGLE))
+        (config_dir / "pps.yml").write_text(yaml.dump(CONFIG_PPS))
+        (config_dir / "notes.txt").write_text("not a config")
+        (tmp_path / "list.yaml").write_text(yaml.dump([CONFIG_PPS, CONFIG_SINGLE]))
+        configs = read_configs([os.fspath(config_dir), os.fspath(tmp_path / "list.yaml")])
+        assert configs == [CONFIG_SINGLE, CONFIG_PPS, CONFIG_PPS, CONFIG_SINGLE]
+        assert len(MultiSegmentGatherer(configs).gatherers) == 4
+
+
+def _msg_slot_messages(platform_shortname, platform_name):
+    segments = [("", "PRO"), ("", "EPI")] + [("VIS006", f"{segment:06d}") for segment in range(1, 9)]
+    return [FakeMessage(dict(_msg_segment_metadata(channel, segment, platform_shortname), platform_name=platform_name))
+            for channel, segment in segments]
+
+
+def _msg_message_at(slot_time):
+    mda = _msg_segment_metadata("VIS006", "000001")
+    mda["uid"] = mda["uid"].replace("201611281100", slot_time)
+    del mda["start_time"]
+    return FakeMessage(mda)
+
+
+class TestShardedSegmentGatherer:
+    """Test sharding the segment gathering to worker processes."""
+
+    def test_messages_of_a_slot_go_to_the_same_worker(self):
+        """Test the messages are sharded by the configured key."""
+        gatherer = ShardedSegmentGatherer(dict(CONFIG_SINGLE, workers=4))
+        shards = {gatherer.get_shard(msg) for msg in _msg_slot_messages("MSG3", "Meteosat-10")}
+        assert len(shards) == 1
+        shards = {gatherer.get_shard(_msg_slot_messages("MSG3", f"Meteosat-{i}")[0]) for i in range(8, 12)}
+        assert len(shards) > 1
+
+    def test_shard_by_floored_time(self):
+        """Test sharding by a time floored to the slot length."""
+        gatherer = ShardedSegmentGatherer(dict(CONFIG_SINGLE, workers=4, shard_key="start_time",
+                                               group_by_minutes=15))
+        messages = [_msg_message_at("201611281100"), _msg_message_at("201611281107"),
+                    _msg_message_at("201611281114")]
+        assert len({gatherer.get_shard(msg) for msg in messages}) == 1
+
+    def test_shard_by_slot_time_within_tolerance(self):
+        """Test the files of a slot with times on both sides of a minute go to the same worker."""
+        gatherer = ShardedSegmentGatherer(dict(CONFIG_SINGLE, workers=4, shard_key="start_time", time_tolerance=120))
+        times = ["201611281100", "201611281059", "201611281101"]
+        times += [f"2016112811{minute}" for minute in range(10, 60, 5)]
+        shards = [gatherer.get_shard(_msg_message_at(slot_time)) for slot_time in times]
+        assert len(set(shards[:3])) == 1
+        assert len(set(shards)) > 1
+        assert gatherer._slot_times[0] == dt.datetime(2016, 11, 28, 11, 0, tzinfo=dt.timezone.utc)
+
+    def test_shard_key_in_message_is_not_parsed(self):
+        """Test the message is not parsed when the shard key is in the message data."""
+        gatherer = ShardedSegmentGatherer(dict(CONFIG_SINGLE, workers=4))
+        with patch.object(gatherer._frontend, "message_from_posttroll") as message_from_posttroll:
+            gatherer.get_shard(_msg_slot_messages("MSG3", "Meteosat-10")[0])
+        message_from_posttroll.assert_not_called()
+
+    def _run_in_process(self, config):
+        from queue import Queue
+        gatherer = ShardedSegmentGatherer(config)
+        gatherer._frontend._publisher = MagicMock()
+        gatherer._results = Queue()
+        gatherer._shards = [Queue() for _ in range(gatherer._num_workers)]
+        gatherer._num_running = gatherer._num_workers
+        workers = [_ShardGatherer(config, gatherer._results) for _ in range(gatherer._num_workers)]
+        return gatherer, workers
+
+    @staticmethod
+    def _process_shards(gatherer, workers):
+        for shard, worker in zip(gatherer._shards, workers):
+            while not shard.empty():
+                worker.process_shard_messages([shard.get()])
+
+    @staticmethod
+    def _time_out_slots(gatherer, workers):
+        for worker in workers:
+            for slot_time, slot in worker.slots.items():
+                slot["timeout"] = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=1)
+                worker._schedule_timeout(slot_time)
+            worker.triage_slots()
+        gatherer._publish_results()
+
+    def test_slot_times_drifting_after_timeout(self):
+        """Test the files of a slot opened after a timeout go to the same worker."""
+        gatherer, workers = self._run_in_process(dict(CONFIG_SINGLE, workers=4, shard_key="start_time",
+                                                      time_tolerance=150))
+        gatherer.distribute([_msg_message_at("201611281100")])
+        self._process_shards(gatherer, workers)
+        self._time_out_slots(gatherer, workers)
+        assert not gatherer._slot_times
+
+        gatherer.distribute([_msg_message_at("201611281102"), _msg_message_at("201611281104")])
+        self._process_shards(gatherer, workers)
+        slots = [slot for worker in workers for slot in worker.slots.values()]
+        assert len(slots) == 1
+        assert slots[0].timestamp == "2016-11-28 11:02:00+00:00"
+
+    def test_slot_reopened_by_late_file_is_remembered(self):
+        """Test the front-end keeps a slot closed by a worker before receiving a file sent to it."""
+        gatherer, workers = self._run_in_process(dict(CONFIG_SINGLE, workers=4, shard_key="start_time",
+                                                      time_tolerance=150))
+        gatherer.distribute([_msg_message_at("201611281100")])
+        self._process_shards(gatherer, workers)
+        gatherer.distribute([_msg_message_at("201611281102")])
+        self._time_out_slots(gatherer, workers)
+        assert gatherer._slot_times == [dt.datetime(2016, 11, 28, 11, 0, tzinfo=dt.timezone.utc)]
+
+        self._process_shards(gatherer, workers)
+        gatherer.distribute([_msg_message_at("201611281101")])
+        self._process_shards(gatherer, workers)
+        assert [list(worker.slots) for worker in workers if worker.slots] == [["2016-11-28 11:00:00+00:00"]]
+
+    def test_messages_without_shard_key_are_logged(self, caplog):
+        """Test the messages without the shard key go to the first worker with a warning."""
+        gatherer = ShardedSegmentGatherer(dict(CONFIG_SINGLE, workers=4, shard_key="orbit_number"))
+        with caplog.at_level(logging.WARNING):
+            shards = {gatherer.get_shard(msg) for msg in _msg_slot_messages("MSG3", "Meteosat-10")}
+        assert shards == {0}
+        assert caplog.text.count("No orbit_number in message") == 1
+
+    def test_collections_are_published_by_the_frontend(self):
+        """Test the workers gather the slots and the front-end publishes them."""
+        gatherer = ShardedSegmentGatherer(dict(CONFIG_SINGLE, workers=2))
+        gatherer._frontend._publisher = MagicMock()
+        gatherer._start_workers()
+        try:
+            gatherer.distribute(_msg_slot_messages("MSG3", "Meteosat-10") + _msg_slot_messages("MSG4", "Meteosat-11"))
+        finally:
+            gatherer._stop_workers()
+
+        published = [posttroll.message.Message(rawstr=call_args[0][0])
+                     for call_args in gatherer._frontend._publisher.send.call_args_list]
+        assert sorted(msg.data["platform_name"] for msg in published) == ["Meteosat-10", "Meteosat-11"]
+        assert all(len(msg.data["dataset"]) == 10 for msg in published)
+        assert all(msg.subject == "/bar" for msg in published)
+
+
+class TestIncrementalPublish:
+    """Test publishing only the new files of a slot."""
+
+    def _process(self, gatherer, segments):
+        for channel, segment in segments:
+            gatherer.process(FakeMessage(_msg_segment_metadata(channel, segment)))
+        gatherer.triage_slots()
+
+    def _get_published(self, gatherer):
+        return [posttroll.message.Message(rawstr=call_args[0][0]).data
+                for call_args in gatherer._publisher.send.call_args_list]
+
+    @pytest.mark.parametrize("incremental", [False, True])
+    def test_premature_and_final_publication(self, incremental):
+        """Test the premature publication and the later ones carry only the new files."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, num_files_premature_publish=3,
+                                        incremental_publish=incremental))
+        gatherer._publisher = MagicMock()
+        gatherer._subject = "/bar"
+        self._process(gatherer, [("", "PRO"), ("", "EPI"), ("VIS006", "000001")])
+        self._process(gatherer, [("VIS006", f"{segment:06d}") for segment in range(2, 9)])
+
+        first, last = self._get_published(gatherer)
+        assert len(first["dataset"]) == 3
+        if not incremental:
+            assert len(last["dataset"]) == 10
+            assert "sequence_number" not in last
+            return
+        assert len(last["dataset"]) == 7
+        assert not {dataset["uid"] for dataset in first["dataset"]} & {dataset["uid"] for dataset in last["dataset"]}
+        assert [(mda["sequence_number"], mda["final"], mda["incremental"]) for mda in (first, last)] == [
+            (0, False, True), (1, True, True)]
+        assert first["slot_id"] == last["slot_id"] == "msg_20161128110000"
+
+    def test_final_increment_at_timeout(self):
+        """Test a prematurely published slot sends its final increment when it times out."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, num_files_premature_publish=3, incremental_publish=True))
+        gatherer._publisher = MagicMock()
+        gatherer._subject = "/bar"
+        self._process(gatherer, [("VIS006", f"{segment:06d}") for segment in range(1, 4)])
+        gatherer.process(FakeMessage(_msg_segment_metadata("VIS006", "000004")))
+        slot_time = "2016-11-28 11:00:00+00:00"
+        gatherer.slots[slot_time]["timeout"] = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=1)
+        gatherer._schedule_timeout(slot_time)
+        gatherer.triage_slots()
+
+        first, last = self._get_published(gatherer)
+        assert len(first["dataset"]) == 3
+        assert [dataset["uid"] for dataset in last["dataset"]] == [_msg_segment_metadata("VIS006", "000004")["uid"]]
+        assert [(mda["sequence_number"], mda["final"]) for mda in (first, last)] == [(0, False), (1, True)]
+        assert not gatherer.slots
+
+    def test_no_publication_at_timeout_without_increments(self):
+        """Test a slot timing out without premature publication is discarded silently."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, incremental_publish=True))
+        gatherer._publisher = MagicMock()
+        self._process(gatherer, [("VIS006", "000001")])
+        slot_time = "2016-11-28 11:00:00+00:00"
+        gatherer.slots[slot_time]["timeout"] = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=1)
+        gatherer._schedule_timeout(slot_time)
+        gatherer.triage_slots()
+        gatherer._publisher.send.assert_not_called()
+        assert not gatherer.slots
+
+    def test_increment_of_collection(self):
+        """Test the increments are computed for each pattern of a collection."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, incremental_publish=True))
+        slot = gatherer._create_slot(Message(FakeMessage(_msg_segment_metadata("", "PRO")), gatherer._patterns["msg"]))
+        slot.output_metadata["collection"] = {"a": {"dataset": [1, 2]}, "b": {"dataset": [3]}}
+        assert slot.get_increment(final=False)["collection"] == {"a": {"dataset": [1, 2]}, "b": {"dataset": [3]}}
+        slot.output_metadata["collection"]["b"]["dataset"].append(4)
+        assert slot.get_increment(final=True)["collection"] == {"a": {"dataset": []}, "b": {"dataset": [4]}}
+
+
+class TestPartialPublish:
+    """Test publishing a partial collection when the critical files are in."""
+
+    def _create_gatherer(self):
+        posttroll = dict(CONFIG_SINGLE['posttroll'], partial_publish_topic='/bar/partial')
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, posttroll=posttroll))
+        gatherer._publisher = MagicMock()
+        gatherer._subject = "/bar"
+        return gatherer
+
+    def _get_published(self, gatherer):
+        return [posttroll.message.Message(rawstr=call_args[0][0])
+                for call_args in gatherer._publisher.send.call_args_list]
+
+    def test_partial_and_full_publication(self):
+        """Test the partial collection is published once, before the full one."""
+        gatherer = self._create_gatherer()
+        for segment in ("PRO", "EPI"):
+            gatherer.process(FakeMessage(_msg_segment_metadata("", segment)))
+        gatherer.triage_slots()
+        gatherer.process(FakeMessage(_msg_segment_metadata("VIS006", "000001")))
+        gatherer.triage_slots()
+        for segment in range(2, 9):
+            gatherer.process(FakeMessage(_msg_segment_metadata("VIS006", f"{segment:06d}")))
+        gatherer.triage_slots()
+
+        partial, full = self._get_published(gatherer)
+        assert partial.subject == "/bar/partial"
+        assert partial.data["partial"] is True
+        assert len(partial.data["dataset"]) == 2
+        assert full.subject == "/bar"
+        assert "partial" not in full.data
+        assert len(full.data["dataset"]) == 10
+
+    def test_no_partial_publication_for_complete_slot(self):
+        """Test only the full collection is published when all the files are in at once."""
+        gatherer = self._create_gatherer()
+        for channel, segment in [("", "PRO"), ("", "EPI")] + [("VIS006", f"{i:06d}") for i in range(1, 9)]:
+            gatherer.process(FakeMessage(_msg_segment_metadata(channel, segment)))
+        gatherer.triage_slots()
+        assert [msg.subject for msg in self._get_published(gatherer)] == ["/bar"]
+
+
+def _msg_metadata_at(start_time, channel_name="", segment="PRO"):
+    data = dict(_msg_segment_metadata(channel_name, segment), start_time=start_time)
+    data["uid"] = data["uid"].replace("201611281100", start_time.strftime("%Y%m%d%H%M"))
+    return data
+
+
+class TestSlotLimits:
+    """Test the limits of the open slots."""
+
+    def test_oldest_slot_is_evicted(self):
+        """Test the oldest slot is discarded when there are too many open slots."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, max_open_slots=2))
+        for minute in (30, 0, 15):
+            gatherer.process(FakeMessage(_msg_metadata_at(dt.datetime(2016, 11, 28, 11, minute))))
+        assert list(gatherer.slots) == ["2016-11-28 11:30:00+00:00", "2016-11-28 11:15:00+00:00"]
+        assert gatherer.statistics()["evicted_slots"] == 1
+
+    def test_files_per_slot_are_limited(self):
+        """Test the files are rejected when the slot is full."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, max_files_per_slot=2))
+        for segment in ("PRO", "EPI"):
+            gatherer.process(FakeMessage(_msg_segment_metadata("", segment)))
+        gatherer.process(FakeMessage(_msg_segment_metadata("VIS006", "000001")))
+        assert gatherer.slots["2016-11-28 11:00:00+00:00"].num_datasets() == 2
+        assert gatherer.statistics()["rejected_files"] == 1
+
+    def test_times_far_from_now_are_rejected(self):
+        """Test the files with times too far from the current time are rejected before creating a slot."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, max_time_offset=3600))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        assert not gatherer.slots
+        now = dt.datetime.now(dt.timezone.utc).replace(second=0, microsecond=0, tzinfo=None)
+        data = _msg_metadata_at(now)
+        del data["start_time"]
+        gatherer.process(FakeMessage(data))
+        assert len(gatherer.slots) == 1
+        assert gatherer.statistics()["rejected_times"] == 1
+
+    def test_unknown_eviction_policy(self):
+        """Test an unknown eviction policy is refused."""
+        with pytest.raises(ValueError):
+            SegmentGatherer(dict(CONFIG_SINGLE, eviction_policy="newest"))
+
+
+def _msg_from_host(host, channel_name="", segment="PRO"):
+    data = _msg_segment_metadata(channel_name, segment)
+    data["uri"] = f"ssh://{host}/data/{data['uid']}"
+    msg = FakeMessage(data)
+    msg.host = host
+    return msg
+
+
+class TestProviders:
+    """Test gathering the files from several providing servers."""
+
+    def _create_gatherer(self, **kwargs):
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, providing_server=["a", "b"], **kwargs))
+        gatherer._publisher = MagicMock()
+        gatherer._subject = "/bar"
+        return gatherer
+
+    def test_first_arrival_is_used(self):
+        """Test the file from the first server is used and the copies from the others are dropped."""
+        gatherer = self._create_gatherer()
+        gatherer._process_messages([_msg_from_host("b"), _msg_from_host("a"), _msg_from_host("c", "", "EPI")])
+        slot = gatherer.slots["2016-11-28 11:00:00+00:00"]
+        assert [dataset["uri"] for dataset in slot.output_metadata["dataset"]] == [
+            "ssh://b/data/H-000-MSG3__-MSG3________-_________-PRO______-201611281100-__"]
+        providers = gatherer.statistics()["providers"]
+        assert providers["b"]["first"] == 1
+        assert providers["a"]["duplicates"] == 1
+
+    def test_copies_after_publication_are_dropped(self):
+        """Test the copies of the files of a published slot do not open a new slot."""
+        gatherer = self._create_gatherer()
+        items = [("", "PRO"), ("", "EPI")] + [("VIS006", f"{i:06d}") for i in range(1, 9)]
+        gatherer._process_messages([_msg_from_host("a", channel, segment) for channel, segment in items])
+        gatherer.triage_slots()
+        assert gatherer._publisher.send.call_count == 1
+        gatherer._process_messages([_msg_from_host("b", channel, segment) for channel, segment in items])
+        assert not gatherer.slots
+
+    def test_faster_provider_is_preferred(self):
+        """Test the copy from a server with a smaller lag replaces the first arrival."""
+        gatherer = self._create_gatherer(prefer_fastest_provider=True)
+        start = dt.datetime(2016, 11, 28, 11, 15, tzinfo=dt.timezone.utc)
+        arrivals = [("b", "PRO", 0), ("a", "PRO", 5), ("a", "EPI", 6), ("b", "EPI", 7)]
+        for host, segment, seconds in arrivals:
+            with patch("pytroll_collectors.segments._utcnow", return_value=start + dt.timedelta(seconds=seconds)):
+                gatherer._process_messages([_msg_from_host(host, "", segment)])
+        slot = gatherer.slots["2016-11-28 11:00:00+00:00"]
+        assert [dataset["uri"].split("/")[2] for dataset in slot.output_metadata["dataset"]] == ["b", "b"]
+        assert gatherer.statistics()["providers"]["a"]["median_lag"] == 5
+
+
+class TestAdaptiveTimeliness:
+    """Test learning the timeliness from the arrival delays."""
+
+    def _create_gatherer(self, **kwargs):
+        adaptive_timeliness = dict(dict(quantile=0.5, margin=2, window=10, min_samples=3), **kwargs)
+        return SegmentGatherer(dict(CONFIG_SINGLE, timeliness=600, adaptive_timeliness=adaptive_timeliness))
+
+    def test_configured_timeliness_is_used_without_enough_samples(self):
+        """Test the configured timeliness is used until there are enough samples."""
+        gatherer = self._create_gatherer()
+        gatherer._arrival_delays["msg"].add(1.)
+        assert gatherer._get_slot_timeliness() == dt.timedelta(seconds=600)
+        assert SegmentGatherer(CONFIG_SINGLE)._arrival_delays == {}
+
+    def test_timeliness_from_quantile(self):
+        """Test the timeliness is the quantile of the delays plus the margin."""
+        gatherer = self._create_gatherer()
+        for delay in (5., 1., 3., 100., 4.):
+            gatherer._arrival_delays["msg"].add(delay)
+        assert gatherer._get_slot_timeliness() == dt.timedelta(seconds=6)
+        assert gatherer.statistics()["timeliness"] == 6.
+
+    def test_timeliness_is_limited(self):
+        """Test the learned timeliness is not longer than the configured one."""
+        gatherer = self._create_gatherer(margin=1000)
+        for delay in (5., 1., 3.):
+            gatherer._arrival_delays["msg"].add(delay)
+        assert gatherer._get_slot_timeliness() == dt.timedelta(seconds=600)
+
+    def test_arrival_delays_are_recorded(self):
+        """Test the delays of the added files are recorded and used for the new slots."""
+        gatherer = self._create_gatherer(margin=10)
+        for segment in ("PRO", "EPI", "EPI"):
+            gatherer.process(FakeMessage(_msg_segment_metadata("", segment)))
+        gatherer.process(FakeMessage(_msg_segment_metadata("VIS006", "000001")))
+        assert len(gatherer._arrival_delays["msg"]) == 3
+        slot = gatherer._create_slot(Message(FakeMessage(_msg_segment_metadata("", "PRO", "MSG4")),
+                                             gatherer._patterns["msg"]))
+        assert slot._timeliness < dt.timedelta(seconds=11)
+
+
+class TestRepeatCycle:
+    """Test the slot calendar of a repeat cycle."""
+
+    @pytest.mark.parametrize(("config", "time", "expected"),
+                             [({"minutes": 15}, dt.datetime(2016, 11, 28, 11, 0), dt.datetime(2016, 11, 28, 11, 0)),
+                              ({"minutes": 15}, dt.datetime(2016, 11, 28, 11, 14, 29),
+                               dt.datetime(2016, 11, 28, 11, 0)),
+                              ({"minutes": 15}, dt.datetime(2016, 11, 28, 11, 14, 45),
+                               dt.datetime(2016, 11, 28, 11, 15)),
+                              ({"minutes": 10, "offset": 5}, dt.datetime(2016, 11, 28, 11, 3),
+                               dt.datetime(2016, 11, 28, 10, 55)),
+                              ({"minutes": 60}, dt.datetime(2016, 11, 28, 23, 59, 50), dt.datetime(2016, 11, 29))])
+    def test_nominal_time(self, config, time, expected):
+        """Test finding the nominal slot time."""
+        repeat_cycle = RepeatCycle(config, time_tolerance=30)
+        utc = dt.timezone.utc
+        assert repeat_cycle.get_nominal_time(time.replace(tzinfo=utc)) == expected.replace(tzinfo=utc)
+
+    def test_messages_are_gathered_to_nominal_slots(self):
+        """Test the messages are gathered to the slot of their nominal time."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, repeat_cycle={"minutes": 15}))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "EPI")))
+        assert list(gatherer.slots) == ["2016-11-28 11:00:00+00:00"]
+        assert len(gatherer.slots["2016-11-28 11:00:00+00:00"]["msg"]["received_files"]) == 2
+
+    def test_precreated_slot(self):
+        """Test a slot is created ahead of its nominal time and opened by its first file."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, repeat_cycle={"minutes": 15, "precreate": 120}))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer.precreate_slots(now=dt.datetime(2016, 11, 28, 11, 12, tzinfo=dt.timezone.utc))
+        assert len(gatherer.slots) == 1
+        gatherer.precreate_slots(now=dt.datetime(2016, 11, 28, 11, 13, 30, tzinfo=dt.timezone.utc))
+        slot_time = "2016-11-28 11:15:00+00:00"
+        assert slot_time in gatherer._precreated_slots
+        slot = gatherer.slots[slot_time]
+        assert "H-000-MSG3__-MSG3________-_________-PRO______-201611281115-__" in slot["msg"]["critical_files"]
+
+        data = dict(_msg_segment_metadata("", "PRO"), start_time=dt.datetime(2016, 11, 28, 11, 15))
+        data["uid"] = data["uid"].replace("201611281100", "201611281115")
+        gatherer.process(FakeMessage(data))
+        assert slot_time not in gatherer._precreated_slots
+        assert len(slot["msg"]["received_files"]) == 1
+
+    def test_no_precreated_slot_for_varying_platforms(self, caplog):
+        """Test no slot is precreated when the platform of the slots varies."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, repeat_cycle={"minutes": 15, "precreate": 120}))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        data = dict(_msg_segment_metadata("", "PRO", platform_shortname="MSG4"), platform_name="Meteosat-11",
+                    start_time=dt.datetime(2016, 11, 28, 11, 15))
+        data["uid"] = data["uid"].replace("201611281100", "201611281115")
+        with caplog.at_level(logging.INFO):
+            gatherer.process(FakeMessage(data))
+        assert "The slots differ in platform_name, platform_shortname" in caplog.text
+        gatherer.precreate_slots(now=dt.datetime(2016, 11, 28, 11, 28, 30, tzinfo=dt.timezone.utc))
+        assert list(gatherer.slots) == ["2016-11-28 11:00:00+00:00", "2016-11-28 11:15:00+00:00"]
+
+    def test_unused_precreated_slot_is_dropped(self):
+        """Test a precreated slot without files is removed at its timeout without publishing."""
+        gatherer = SegmentGatherer(dict(CONFIG_SINGLE, repeat_cycle={"minutes": 15, "precreate": 120}))
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer.precreate_slots(now=dt.datetime(2016, 11, 28, 11, 14, tzinfo=dt.timezone.utc))
+        gatherer._publisher = MagicMock()
+        slot_time = "2016-11-28 11:15:00+00:00"
+        gatherer._mark_dirty(slot_time)
+        gatherer.triage_slots()
+        assert slot_time in gatherer.slots
+        gatherer.slots[slot_time]["timeout"] = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=1)
+        gatherer._schedule_timeout(slot_time)
+        gatherer.triage_slots()
+        assert list(gatherer.slots) == ["2016-11-28 11:00:00+00:00"]
+        assert not gatherer._precreated_slots
+        gatherer._publisher.send.assert_not_called()
+
+
+class FakeSlot:
+    """Fake slot."""
+
+    def __init__(self, start_time):
+        """Set up fake slot."""
+        self.output_metadata = {"start_time": start_time}
+
+
+class TestSlotIndex:
+    """Test the time index of the slots."""
+
+    def setup_method(self):
+        """Set up the test case."""
+        self.slots = SlotIndex("start_time")
+        self.times = [dt.datetime(2016, 11, 28, 11, minute, tzinfo=dt.timezone.utc) for minute in (30, 0, 15)]
+        for start_time in self.times:
+            self.slots[str(start_time)] = FakeSlot(start_time)
+
+    def test_keeps_insertion_order(self):
+        """Test the slots are iterated in insertion order."""
+        assert list(self.slots) == [str(start_time) for start_time in self.times]
+
+    def test_find_nearest(self):
+        """Test the nearest slot within the tolerance is found."""
+        time_obj = dt.datetime(2016, 11, 28, 11, 14, 50, tzinfo=dt.timezone.utc)
+        assert self.slots.find_nearest(time_obj, 30) == str(self.times[2])
+        assert self.slots.find_nearest(time_obj, 5) is None
+
+    def test_find_nearest_prefers_earlier_slot_on_tie(self):
+        """Test the earlier slot is used when two slots are equally close."""
+        time_obj = dt.datetime(2016, 11, 28, 11, 7, 30, tzinfo=dt.timezone.utc)
+        assert self.slots.find_nearest(time_obj, 1000) == str(self.times[1])
+
+    def test_removed_slots_are_not_found(self):
+        """Test the index follows the removal of slots."""
+        del self.slots[str(self.times[0])]
+        self.slots.pop(str(self.times[1]))
+        assert self.slots.find_nearest(self.times[0], 30) is None
+        assert self.slots.find_nearest(self.times[1], 30) is None
+        self.slots.clear()
+        assert self.slots.find_nearest(self.times[2], 30) is None
+
+    def test_copy_keeps_index(self):
+        """Test a copy of the slots has its own index."""
+        slots = self.slots.copy()
+        slots.popitem()
+        assert isinstance(slots, SlotIndex)
+        assert slots.find_nearest(self.times[2], 30) is None
+        assert self.slots.find_nearest(self.times[2], 30) == str(self.times[2])
+
+    def test_reindex(self):
+        """Test the index is updated when the slot time changes."""
+        key = str(self.times[0])
+        self.slots[key].output_metadata["start_time"] = self.times[0] + dt.timedelta(minutes=5)
+        self.slots.reindex(key)
+        assert self.slots.find_nearest(self.times[0], 30) is None
+        assert self.slots.find_nearest(self.times[0] + dt.timedelta(minutes=5), 30) == key
+
+    def test_find_eviction_candidates(self):
+        """Test finding the oldest slot and the slot farthest from a time."""
+        assert self.slots.find_oldest() == str(self.times[1])
+        assert self.slots.find_farthest(dt.datetime(2016, 11, 28, 11, 20, tzinfo=dt.timezone.utc)) == str(
+            self.times[1])
+        assert self.slots.find_farthest(dt.datetime(2016, 11, 28, 11, 10, tzinfo=dt.timezone.utc)) == str(
+            self.times[0])
+        assert SlotIndex().find_oldest() is None
+
+    def test_unindexed_values(self):
+        """Test values without slot metadata are stored but not indexed."""
+        self.slots["foo"] = "bar"
+        self.slots.reindex("foo")
+        assert self.slots["foo"] == "bar"
+        del self.slots["foo"]
+
+
 class TestMessage:
     """Test the message object."""
 
@@ -1337,12 +2276,85 @@ class TestMessage:
         message = Message(fake_message, self.collection_gatherer._patterns['pps'])
         assert message
 
+    def test_message_data_is_copied_once(self):
+        """Test the posttroll message is not modified and the derived metadata are computed once."""
+        gatherer = SegmentGatherer(CONFIG_SINGLE)
+        data = _msg_segment_metadata("VIS006", "000001")
+        data["uri"] = "ssh://host" + data["uri"]
+        fake_message = FakeMessage(data)
+        message = Message(fake_message, gatherer._patterns["msg"], drop_scheme=True)
+        assert message.message_data["uri"] == "/data/" + data["uid"]
+        assert fake_message.data["uri"] == data["uri"]
+        assert message.filtered_metadata is message.filtered_metadata
+        assert message.mask == "H-000-MSG3__-MSG3________-VIS006___-000001___-201611281100-__"
+
     def test_message_from_posttroll(self):
         """Test creating a message from a posttroll message."""
         fake_message = FakeMessage(pps_message_data)
         self.collection_gatherer = SegmentGatherer(CONFIG_COLLECTIONS)
         assert isinstance(self.collection_gatherer.message_from_posttroll(fake_message), Message)
 
+    def test_message_from_posttroll_tries_only_plausible_patterns(self):
+        """Test only the patterns with a matching uid prefix are tried."""
+        gatherer = SegmentGatherer(CONFIG_NO_SEG)
+        fake_message = FakeMessage({"uid": "S_NWC_CMA_metopb_28538_20180319T0955387Z_20180319T1009544Z.nc",
+                                    "uri": "/data/S_NWC_CMA_metopb_28538_20180319T0955387Z_20180319T1009544Z.nc",
+                                    "sensor": ["avhrr/3"]})
+        assert [pattern.name for pattern in gatherer._get_candidate_patterns(fake_message)] == ["pps"]
+        with patch.object(gatherer._patterns["hrpt"].parser, "parse_if_matches") as hrpt_matches:
+            message = gatherer.message_from_posttroll(fake_message)
+        hrpt_matches.assert_not_called()
+        assert message.pattern.name == "pps"
+
+    def test_matching_leaves_no_state_in_the_parser(self):
+        """Test the parser result does not depend on previous matches."""
+        gatherer = SegmentGatherer(CONFIG_NO_SEG)
+        parser = gatherer._patterns["pps"].parser
+        uid = "S_NWC_CMA_metopb_28538_20180319T0955387Z_20180319T1009544Z.nc"
+        other_uid = uid.replace("28538", "28539")
+        assert parser.matches(FakeMessage({"uid": uid}))
+        assert parser.parse({"uid": other_uid})["orbit_number"] == 28539
+        assert parser.parse_if_matches(FakeMessage({"uid": uid}))["orbit_number"] == 28538
+        assert parser.parse_if_matches(FakeMessage({"uid": "not_a_pps_file.nc"})) is None
+
+    def test_message_from_posttroll_parses_uid_once(self):
+        """Test the uid is parsed only once when the message is matched and created."""
+        import trollsift
+        gatherer = SegmentGatherer(CONFIG_NO_SEG)
+        fake_message = FakeMessage({"uid": "hrpt_metop01_20180319_0955_28538.l1b",
+                                    "uri": "/data/hrpt_metop01_20180319_0955_28538.l1b",
+                                    "sensor": ["avhrr/3"]})
+        with patch.object(trollsift.Parser, "parse", autospec=True, side_effect=trollsift.Parser.parse) as parse:
+            message = gatherer.message_from_posttroll(fake_message)
+        assert parse.call_count == 1
+        assert message.metadata["orbit_number"] == 28538
+
+    def test_repeated_uid_is_rejected_before_parsing(self):
+        """Test a file already added to an open slot is rejected without creating a message."""
+        gatherer = SegmentGatherer(CONFIG_SINGLE)
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        with patch.object(gatherer, "message_from_posttroll") as message_from_posttroll:
+            gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        message_from_posttroll.assert_not_called()
+        assert gatherer.statistics()["early_duplicates"] == 1
+
+    def test_statistics_are_computed_only_for_debug_logging(self, caplog):
+        """Test the statistics are not computed at slot clearing when they are not logged."""
+        gatherer = SegmentGatherer(CONFIG_SINGLE)
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        with patch.object(gatherer, "statistics") as statistics, caplog.at_level(logging.INFO):
+            gatherer._clear_slot("2016-11-28 11:00:00+00:00")
+        statistics.assert_not_called()
+
+    def test_repeated_uid_is_accepted_after_slot_is_cleared(self):
+        """Test a file can be added again when its slot has been cleared."""
+        gatherer = SegmentGatherer(CONFIG_SINGLE)
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        gatherer._clear_slot("2016-11-28 11:00:00+00:00")
+        gatherer.process(FakeMessage(_msg_segment_metadata("", "PRO")))
+        slot = gatherer.slots["2016-11-28 11:00:00+00:00"]
+        assert len(slot["msg"]["received_files"]) == 1
+
     def test_message_type_dataset(self):
         """Test creating a message from a posttroll message gives the right type."""
         self.collection_gatherer = SegmentGatherer(CONFIG_COLLECTIONS)
@@ -1577,6 +2589,7 @@ def test_remote_file_with_filesystem_passes_filesystem_info(filesystem):
         expected_uids.add(fci_msg.data['uid'])
         msg = FakeMessage(fci_msg.data)
         segment_gatherer.process(msg)
+        _finish_existing_files_scan(segment_gatherer)
 
     timestamp = '2025-06-26 07:30:00+00:00'
     assert timestamp in segment_gatherer.slots